@@ -0,0 +1,400 @@
+"""
+Benchmarks of the fetchers against a local, throttled HTTP/S3 stand-in.
+
+A server process serves synthetic file populations, with configurable
+latency, bandwidth cap per connection and injected failures (503 errors
+and connections cut mid-transfer), and supports Range requests. It also
+answers the S3 requests of boto (bucket and key listings, HEAD, GET) so
+that AmazonS3Fetcher runs against it.
+
+Populations:
+
+- small: many small files, one url each
+- huge: a few large files
+- archive: one zip archive shared by many target files
+
+Each population is fetched by HttpFetcher (sequentially and with n_jobs
+threads), by AmazonS3Fetcher (if boto is installed) and by the fetch() of
+a DiffusionDataset, into an empty directory. Wall time, CPU time of the
+client, bytes moved and retries are reported.
+
+    python benchmarks/bench_fetchers.py [--latency 0.02] [--bandwidth 50]
+        [--fail-rate 0] [--n-small 200] [--huge-size 64] [--n-jobs 8]
+"""
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import zipfile
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from nidata.core.datasets import DiffusionDataset
+from nidata.core.fetchers import instrumentation
+from nidata.core.fetchers.aws_fetcher import AmazonS3Fetcher
+from nidata.core.fetchers.http_fetcher import HttpFetcher
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+BUCKET = 'bench'
+
+
+def make_population(n_small=200, small_size=16 * 1024, n_huge=2,
+                    huge_size=64 * 2 ** 20, n_members=100, seed=0):
+    """Files of the populations, by path (/<bucket>/<population>/...)."""
+    rng = np.random.RandomState(seed)
+    files = dict()
+    for i in range(n_small):
+        files['/%s/small/%04d.bin' % (BUCKET, i)] = rng.bytes(small_size)
+    for i in range(n_huge):
+        files['/%s/huge/%d.bin' % (BUCKET, i)] = rng.bytes(huge_size)
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as testzip:
+        for i in range(n_members):
+            testzip.writestr('archive/%04d.bin' % i, rng.bytes(small_size))
+    files['/%s/archive/archive.zip' % BUCKET] = archive.getvalue()
+    return files
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandIn(object):
+    """Throttled HTTP server of files, also answering S3 requests.
+
+    Parameters
+    ----------
+    files: dict
+        Content of the files, by path (/<bucket>/<key> for S3).
+
+    latency: float
+        Seconds waited before answering each request.
+
+    bandwidth: float or None
+        Bytes per second sent on each connection.
+
+    fail_rate: float
+        Fraction of GET requests of files that fail, half with a 503 error,
+        half with the connection cut in the middle of the file.
+    """
+    def __init__(self, files, latency=0., bandwidth=None, fail_rate=0.,
+                 seed=0):
+        self.files = files
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fail_rate = fail_rate
+        self.stats = dict(requests=0, bytes=0, errors=0, cuts=0)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.server = _Server(('127.0.0.1', 0), self._handler())
+        self.port = self.server.server_address[1]
+
+    def _fail(self):
+        with self._lock:
+            if self._rng.random() >= self.fail_rate:
+                return None
+            return self._rng.choice(['error', 'cut'])
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, code, body=b'', headers=()):
+                self.send_response(code)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def _send(self, body):
+                """Write body, within the bandwidth cap."""
+                t0 = time.time()
+                chunk_size = 16 * 1024
+                for start in range(0, len(body), chunk_size):
+                    self.wfile.write(body[start:start + chunk_size])
+                    with stand_in._lock:
+                        stand_in.stats['bytes'] += len(
+                            body[start:start + chunk_size])
+                    if stand_in.bandwidth:
+                        delay = ((start + chunk_size) / stand_in.bandwidth
+                                 - (time.time() - t0))
+                        if delay > 0:
+                            time.sleep(delay)
+
+            def _listing(self, bucket, query):
+                prefix = query.get('prefix', [''])[0]
+                delimiter = query.get('delimiter', [None])[0]
+                keys, prefixes = [], set()
+                for path in sorted(stand_in.files):
+                    if not path.startswith('/%s/' % bucket):
+                        continue
+                    key = path[len(bucket) + 2:]
+                    if not key.startswith(prefix):
+                        continue
+                    rest = key[len(prefix):]
+                    if delimiter and delimiter in rest:
+                        prefixes.add(prefix + rest.split(delimiter)[0]
+                                     + delimiter)
+                    else:
+                        keys.append(key)
+                return ''.join(
+                    ['<?xml version="1.0" encoding="UTF-8"?>',
+                     '<ListBucketResult><Name>%s</Name>' % bucket,
+                     '<Prefix>%s</Prefix><IsTruncated>false</IsTruncated>'
+                     % escape(prefix)] +
+                    ['<Contents><Key>%s</Key><Size>%d</Size>'
+                     '<ETag>"%s"</ETag></Contents>'
+                     % (escape(key), len(stand_in.files['/%s/%s' % (
+                         bucket, key)]), hashlib.md5(stand_in.files[
+                             '/%s/%s' % (bucket, key)]).hexdigest())
+                     for key in keys] +
+                    ['<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>'
+                     % escape(p) for p in sorted(prefixes)] +
+                    ['</ListBucketResult>']).encode('utf-8')
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                with stand_in._lock:
+                    stand_in.stats['requests'] += 1
+                if stand_in.latency:
+                    time.sleep(stand_in.latency)
+                parsed = urlparse(self.path)
+                path, query = parsed.path, parse_qs(parsed.query)
+                if path == '/_stats':
+                    return self._reply(
+                        200, json.dumps(stand_in.stats).encode('utf-8'))
+                if path == '/':  # S3: list buckets
+                    return self._reply(200, (
+                        '<?xml version="1.0" encoding="UTF-8"?>'
+                        '<ListAllMyBucketsResult><Buckets><Bucket>'
+                        '<Name>%s</Name></Bucket></Buckets>'
+                        '</ListAllMyBucketsResult>' % BUCKET).encode('utf-8'))
+                if path.strip('/') == BUCKET:  # S3: list keys
+                    return self._reply(200, self._listing(BUCKET, query))
+                if path not in stand_in.files:
+                    return self._reply(404)
+
+                body = stand_in.files[path]
+                headers = [('ETag', '"%s"' % hashlib.md5(body).hexdigest()),
+                           ('Last-Modified',
+                            'Thu, 01 Jan 2015 00:00:00 GMT'),
+                           ('Accept-Ranges', 'bytes')]
+                if self.command == 'HEAD':
+                    return self._reply(200, body, headers)
+                failure = stand_in._fail()
+                if failure == 'error':
+                    with stand_in._lock:
+                        stand_in.stats['errors'] += 1
+                    return self._reply(503)
+
+                code, start = 200, 0
+                range_ = self.headers.get('Range')
+                if range_ and range_.startswith('bytes='):
+                    first, _, last = range_[len('bytes='):].partition('-')
+                    start = int(first)
+                    stop = int(last) + 1 if last else len(body)
+                    if start >= len(body):
+                        return self._reply(416)
+                    headers.append(('Content-Range', 'bytes %d-%d/%d' % (
+                        start, stop - 1, len(body))))
+                    body = body[start:stop]
+                    code = 206
+                self.send_response(code)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                if failure == 'cut':
+                    with stand_in._lock:
+                        stand_in.stats['cuts'] += 1
+                    self._send(body[:len(body) // 2])
+                    self.close_connection = True
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    return
+                self._send(body)
+
+        return Handler
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+
+def _serve(population, options, queue):
+    files = make_population(**population)
+    stand_in = StandIn(files, **options)
+    queue.put(dict(port=stand_in.port,
+                   md5s=dict((path, hashlib.md5(body).hexdigest())
+                             for path, body in files.items())))
+    stand_in.serve_forever()
+
+
+class _Counter(object):
+    """Instrumentation listener counting bytes and retries."""
+    def __init__(self):
+        self.bytes = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            if event['event'] == 'transfer':
+                self.bytes += event.get('bytes', 0)
+            elif event['event'] == 'retry':
+                self.retries += 1
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def run(name, fetch, report):
+    """Run fetch() into an empty directory and report its costs."""
+    data_dir = tempfile.mkdtemp()
+    counter = _Counter()
+    instrumentation.add_listener(counter)
+    t0, cpu0 = time.time(), _cpu_time()
+    error = ''
+    try:
+        fetch(data_dir)
+    except Exception as e:
+        error = repr(e)[:60]
+    finally:
+        instrumentation.remove_listener(counter)
+        shutil.rmtree(data_dir)
+    wall, cpu = time.time() - t0, _cpu_time() - cpu0
+    report.append(dict(name=name, wall=wall, cpu=cpu, bytes=counter.bytes,
+                       retries=counter.retries, error=error))
+    print('%-28s %8.2f %8.2f %10.1f %8.1f %7d  %s' % (
+        name, wall, cpu, counter.bytes / 2. ** 20,
+        counter.bytes / 2. ** 20 / max(wall, 1e-6), counter.retries, error))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds before each response')
+    parser.add_argument('--bandwidth', type=float, default=50,
+                        help='MB/s per connection (0: unlimited)')
+    parser.add_argument('--fail-rate', type=float, default=0.,
+                        help='fraction of failed file requests')
+    parser.add_argument('--n-small', type=int, default=200)
+    parser.add_argument('--huge-size', type=int, default=64,
+                        help='size of the large files, in MB')
+    parser.add_argument('--n-jobs', type=int, default=8)
+    parser.add_argument('--output', help='JSON file of the results')
+    args = parser.parse_args(argv)
+
+    population = dict(n_small=args.n_small,
+                      huge_size=args.huge_size * 2 ** 20)
+    options = dict(latency=args.latency,
+                   bandwidth=args.bandwidth * 2 ** 20 or None,
+                   fail_rate=args.fail_rate)
+    queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=_serve,
+                                     args=(population, options, queue))
+    server.daemon = True
+    server.start()
+    try:
+        served = queue.get(timeout=600)
+        base_url = 'http://127.0.0.1:%d' % served['port']
+        paths = sorted(served['md5s'])
+
+        def http_files(population):
+            if population == 'archive':
+                url = base_url + '/%s/archive/archive.zip' % BUCKET
+                return [('archive/%04d.bin' % i, url, {'uncompress': True})
+                        for i in range(100)]
+            prefix = '/%s/%s/' % (BUCKET, population)
+            return [(p[len(prefix):], base_url + p, {})
+                    for p in paths if p.startswith(prefix)]
+
+        def s3_files(population):
+            prefix = '/%s/%s/' % (BUCKET, population)
+            return [(p[len(prefix):], p[len(BUCKET) + 2:],
+                     {'bucket': BUCKET})
+                    for p in paths if p.startswith(prefix)]
+
+        small_prefix = '/%s/small/' % BUCKET
+
+        class BenchDataset(DiffusionDataset):
+            files = [(p, p[len(small_prefix):], base_url + p,
+                      served['md5s'][p])
+                     for p in paths if p.startswith(small_prefix)]
+
+        try:
+            import boto  # noqa
+        except ImportError:
+            boto = None
+
+        report = []
+        print('%-28s %8s %8s %10s %8s %7s' % (
+            'benchmark', 'wall (s)', 'cpu (s)', 'MB', 'MB/s', 'retries'))
+        for population in ('small', 'huge', 'archive'):
+            for n_jobs in (1, args.n_jobs):
+                run('http %s n_jobs=%d' % (population, n_jobs),
+                    lambda data_dir: HttpFetcher(data_dir=data_dir).fetch(
+                        http_files(population), n_jobs=n_jobs, verbose=0),
+                    report)
+            if boto is not None and population != 'archive':
+                run('s3 %s' % population,
+                    lambda data_dir: AmazonS3Fetcher(
+                        data_dir=data_dir, access_key='bench',
+                        secret_access_key='bench', host='127.0.0.1',
+                        port=served['port'], is_secure=False).fetch(
+                        s3_files(population), verbose=0),
+                    report)
+        run('dataset small n_jobs=%d' % args.n_jobs,
+            lambda data_dir: BenchDataset(data_dir=data_dir).fetch(
+                n_jobs=args.n_jobs, verbose=0),
+            report)
+        if boto is None:
+            print('boto is not installed: S3 benchmarks skipped.')
+
+        stats = json.loads(_get(base_url + '/_stats'))
+        print('server: %(requests)d requests, %(errors)d errors, '
+              '%(cuts)d cut connections' % stats)
+        if args.output:
+            with open(args.output, 'w') as fp:
+                json.dump(dict(args=vars(args), results=report,
+                               server=stats), fp, indent=1)
+    finally:
+        server.terminate()
+
+
+def _get(url):
+    try:
+        from urllib.request import urlopen
+    except ImportError:  # Python 2
+        from urllib2 import urlopen
+    return urlopen(url).read().decode('utf-8')
+
+
+if __name__ == '__main__':
+    main()
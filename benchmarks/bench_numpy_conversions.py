@@ -0,0 +1,64 @@
+"""
+Micro-benchmarks of nidata.core._utils.numpy_conversions.as_ndarray.
+
+Times as_ndarray on C- and F-ordered ndarrays and memmaps, for all the
+dtype/order combinations, with and without allow_memmap.
+
+    python benchmarks/bench_numpy_conversions.py [--size 64] [--repeat 5]
+"""
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+import timeit
+
+import numpy as np
+
+from nidata.core._utils.numpy_conversions import as_ndarray
+
+
+def make_inputs(size, tmp_dir):
+    shape = (size, size, size, 4)
+    data = np.random.RandomState(0).rand(*shape)
+    inputs = dict()
+    for layout in ('C', 'F'):
+        arr = np.asarray(data, order=layout)
+        inputs[('ndarray', layout)] = arr
+        filename = os.path.join(tmp_dir, 'data_%s.npy' % layout)
+        np.save(filename, arr)
+        inputs[('memmap', layout)] = np.load(filename, mmap_mode='r')
+    return inputs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=int, default=64,
+                        help='side of the 4D test arrays (size**3 x 4)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        inputs = make_inputs(args.size, tmp_dir)
+        print('%-8s %-6s %-8s %-6s %-6s %10s' % (
+            'input', 'layout', 'dtype', 'order', 'mmap', 'best (ms)'))
+        for (kind, layout), dtype, order, allow_memmap in itertools.product(
+                sorted(inputs), (None, np.float64, np.float32),
+                ('K', 'C', 'F'), (False, True)):
+            if allow_memmap and kind != 'memmap':
+                continue
+            arr = inputs[(kind, layout)]
+            times = timeit.repeat(
+                lambda: as_ndarray(arr, dtype=dtype, order=order,
+                                   allow_memmap=allow_memmap),
+                number=1, repeat=args.repeat)
+            print('%-8s %-6s %-8s %-6s %-6s %10.2f' % (
+                kind, layout, np.dtype(dtype).name if dtype else '-', order,
+                'yes' if allow_memmap else 'no', 1000 * min(times)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Command line interface of nidata.
+
+    python -m nidata cache stats CACHEDIR
+    python -m nidata cache prune CACHEDIR [--max-bytes 10G] [--max-age 7d]
+                                 [--policy lfu] [--quota FUNC=1G] [--save]
+"""
+import argparse
+import sys
+import time
+
+from .core._utils.cache_manager import CacheManager, parse_age, parse_size
+
+
+def _format_size(size):
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            return '%.1f%s' % (size, unit)
+        size /= 1024.
+    return '%.1fT' % size
+
+
+def _format_age(timestamp):
+    if not timestamp:
+        return '-'
+    return '%.1fh' % ((time.time() - timestamp) / 3600.)
+
+
+def _size(value):
+    try:
+        return parse_size(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid size: %r' % value)
+
+
+def _age(value):
+    try:
+        return parse_age(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid age: %r' % value)
+
+
+def _quota(value):
+    func, sep, size = value.partition('=')
+    if not func or not sep:
+        raise argparse.ArgumentTypeError('invalid quota: %r, expected '
+                                         'FUNC=SIZE' % value)
+    return func, _size(size)
+
+
+def cache_stats(args):
+    manager = CacheManager.from_config(args.cachedir)
+    if manager is None:
+        manager = CacheManager(args.cachedir)
+    stats = manager.stats()
+    total = stats.pop(None)
+    print('%-60s %8s %10s %8s %10s' % ('function', 'entries', 'size',
+                                       'hits', 'idle'))
+    for func_id in sorted(stats, key=lambda f: -stats[f]['bytes']):
+        func_stats = stats[func_id]
+        print('%-60s %8d %10s %8d %10s' % (
+            func_id, func_stats['entries'], _format_size(func_stats['bytes']),
+            func_stats['hits'], _format_age(func_stats['last_access'])))
+    print('%-60s %8d %10s %8d' % ('total', total['entries'],
+                                  _format_size(total['bytes']),
+                                  total['hits']))
+    if manager.bounded:
+        print('budget: max_bytes=%s max_age=%s policy=%s quotas=%s' % (
+            manager.max_bytes, manager.max_age, manager.policy,
+            manager.quotas))
+
+
+def cache_prune(args):
+    config = CacheManager.from_config(args.cachedir)
+    quotas = dict(config.quotas) if config is not None else dict()
+    quotas.update(args.quota)
+    manager = CacheManager(
+        args.cachedir,
+        max_bytes=(args.max_bytes if args.max_bytes is not None
+                   else getattr(config, 'max_bytes', None)),
+        max_age=(args.max_age if args.max_age is not None
+                 else getattr(config, 'max_age', None)),
+        policy=args.policy or getattr(config, 'policy', 'lru'),
+        quotas=quotas)
+    if args.save:
+        manager.save_config()
+    evicted = manager.prune(dry_run=args.dry_run)
+    for entry in evicted:
+        print('%s %s' % ('would evict' if args.dry_run else 'evicted',
+                         entry.path))
+    print('%d entries, %s %s' % (
+        len(evicted), _format_size(sum(e.size for e in evicted)),
+        'to free' if args.dry_run else 'freed'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='nidata')
+    commands = parser.add_subparsers(dest='command')
+    cache_parser = commands.add_parser('cache', help='manage a joblib cache')
+    cache_commands = cache_parser.add_subparsers(dest='cache_command')
+
+    stats_parser = cache_commands.add_parser(
+        'stats', help='report the size of the cache per function')
+    stats_parser.add_argument('cachedir')
+    stats_parser.set_defaults(func=cache_stats)
+
+    prune_parser = cache_commands.add_parser(
+        'prune', help='evict cached results exceeding the budgets (by '
+                      'default, those saved in the cache directory)')
+    prune_parser.add_argument('cachedir')
+    prune_parser.add_argument('--max-bytes', type=_size,
+                              help='e.g. 500M or 10G')
+    prune_parser.add_argument('--max-age', type=_age, help='e.g. 12h or 7d')
+    prune_parser.add_argument('--policy', choices=('lru', 'lfu'))
+    prune_parser.add_argument('--quota', action='append', default=[],
+                              type=_quota, metavar='FUNC=SIZE',
+                              help='byte budget of a single function')
+    prune_parser.add_argument('--dry-run', action='store_true',
+                              help='only list the results to evict')
+    prune_parser.add_argument('--save', action='store_true',
+                              help='save the budgets in the cache directory, '
+                                   'to be enforced when results are cached')
+    prune_parser.set_defaults(func=cache_prune)
+
+    args = parser.parse_args(argv)
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        return 1
+    args.func(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,13 +5,95 @@ Utilities to download anatomical MRI datasets
 # Author: Alexandre Abraham, Philippe Gervais
 # License: simplified BSD
 
+import hashlib
+import json
 import os
+import warnings
 
+import nibabel
 import numpy as np
 from sklearn.datasets.base import Bunch
+from sklearn.externals.joblib import Parallel, delayed
 
 from ...core.datasets import HttpDataset
 from ...core.fetchers import (format_time, md5_sum_file)
+from ...core._utils.compat import in1d
+
+
+# All the subjects of the cross-sectional study
+_SUBJECTS = np.arange(1, 457)
+# missing subjects create shifts in subjects ids
+_MISSING_SUBJECTS = np.array([
+    8, 24, 36, 48, 89, 93, 100, 118, 128, 149, 154, 171, 172, 175, 187, 194,
+    196, 215, 219, 225, 242, 245, 248, 251, 252, 257, 276, 297, 306, 320, 324,
+    334, 347, 360, 364, 391, 393, 412, 414, 427, 436])
+# DARTEL produces outliers that are hidden by nilearn API
+_DARTEL_OUTLIERS = np.array([27, 57, 66, 83, 122, 157, 222, 269, 282, 287,
+                             309, 428])
+# only one gross outlier produced by SPM8 normalization
+_OUTLIERS = np.array([390])
+
+
+def _get_subject_ids(dartel_version=True):
+    """Sorted numbers of the subjects available in a version of the data."""
+    outliers = _DARTEL_OUTLIERS if dartel_version else _OUTLIERS
+    excluded = np.union1d(_MISSING_SUBJECTS, outliers)
+    return _SUBJECTS[~in1d(_SUBJECTS, excluded)]
+
+
+def _subject_numbers(csv_ids):
+    """Subject numbers of OAS1_xxxx_MR1 ids (-1 for other sessions)."""
+    numbers = np.empty(len(csv_ids), dtype=int)
+    for i, csv_id in enumerate(csv_ids):
+        if hasattr(csv_id, 'decode'):
+            csv_id = csv_id.decode()
+        numbers[i] = int(csv_id[5:9]) if csv_id[9:] in ('', '_MR1') else -1
+    return numbers
+
+
+def _select_ext_vars(ext_vars, ext_vars_ids, subject_ids):
+    """Rows of the covariates of some subjects.
+
+    Parameters
+    ----------
+    ext_vars: np.recarray
+        Covariates, sorted by subject.
+
+    ext_vars_ids: np.ndarray
+        Sorted subject numbers of the rows of ext_vars.
+
+    subject_ids: np.ndarray
+        Numbers of the subjects to select.
+    """
+    if not len(ext_vars_ids):
+        return ext_vars[:0]
+    rows = np.searchsorted(ext_vars_ids, subject_ids)
+    rows = np.minimum(rows, len(ext_vars_ids) - 1)
+    # Subjects without covariates are skipped
+    rows = rows[ext_vars_ids[rows] == subject_ids]
+    return ext_vars[rows]
+
+
+def _nonzero_map(map_file):
+    return np.asarray(nibabel.load(map_file).dataobj) != 0
+
+
+def _mask_map(map_file, mask, output_file, row):
+    """Write the masked voxels of a map in a row of a .npy file."""
+    matrix = np.load(output_file, mmap_mode='r+')
+    matrix[row] = np.asarray(nibabel.load(map_file).dataobj)[mask]
+    matrix.flush()
+
+
+def _file_stats(files):
+    return [[os.stat(f).st_size, os.stat(f).st_mtime] for f in files]
+
+
+def _save_manifest(manifest, manifest_file):
+    temp_file = manifest_file + '.part'
+    with open(temp_file, 'w') as fp:
+        json.dump(manifest, fp)
+    os.rename(temp_file, manifest_file)
 
 
 class OasisVbmDataset(HttpDataset):
@@ -100,6 +182,119 @@ class OasisVbmDataset(HttpDataset):
 
     """
 
+    def _load_ext_vars(self, csv_file):
+        """Load the covariates, sorted by subject, and the subject numbers.
+
+        The parsed table is cached in the data directory, until the CSV
+        file changes.
+        """
+        cache_file = os.path.join(self.data_dir, 'ext_vars.npz')
+        stats = [os.stat(csv_file).st_size, os.stat(csv_file).st_mtime]
+        if os.path.exists(cache_file):
+            try:
+                with np.load(cache_file) as cached:
+                    if cached['source_stats'].tolist() == stats:
+                        return (cached['ext_vars'].view(np.recarray),
+                                cached['ext_vars_ids'])
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+
+        csv_data = np.recfromcsv(csv_file)
+        ext_vars_ids = _subject_numbers(csv_data['id'])
+        order = np.argsort(ext_vars_ids, kind='mergesort')
+        order = order[ext_vars_ids[order] >= 0]
+        csv_data, ext_vars_ids = csv_data[order], ext_vars_ids[order]
+        try:
+            with open(cache_file, 'wb') as fp:
+                np.savez(fp, ext_vars=csv_data, ext_vars_ids=ext_vars_ids,
+                         source_stats=stats)
+        except (IOError, OSError):
+            pass
+        return csv_data, ext_vars_ids
+
+    def group_matrix(self, maps, mask_img=None, n_jobs=1, force=False,
+                     verbose=0):
+        """Return the (subjects, masked voxels) float32 matrix of maps.
+
+        The matrix is built once, masking the maps in parallel, and stored
+        in the data directory; later calls with the same maps and mask
+        memory-map it, without reading the maps.
+
+        Parameters
+        ----------
+        maps: list of strings
+            Paths of maps of the dataset, e.g. gray_matter_maps.
+
+        mask_img: string, optional
+            Path of the mask image. Default: the voxels that are non-zero in
+            any of the maps.
+
+        n_jobs: int, optional
+            Number of worker processes (-1: as many as CPUs).
+
+        force: bool, optional
+            If True, build the matrix again.
+
+        Returns
+        -------
+        data: Bunch
+            Dictionary-like object, the interest attributes are :
+            'matrix': np.memmap
+                Masked maps, one row per map.
+            'mask_img': nibabel.Nifti1Image
+                Mask of the columns of the matrix.
+        """
+        key = [os.path.relpath(f, self.data_dir) for f in maps]
+        if mask_img is not None:
+            key.append(os.path.abspath(mask_img))
+        key = hashlib.md5(json.dumps(key).encode('utf-8')).hexdigest()
+        output_file = os.path.join(self.data_dir, 'group_matrix',
+                                   '%s.npy' % key)
+        mask_file = output_file[:-len('.npy')] + '_mask.nii.gz'
+        manifest_file = output_file[:-len('.npy')] + '.json'
+        sources = list(maps) + ([mask_img] if mask_img is not None else [])
+
+        if not force and os.path.exists(manifest_file):
+            with open(manifest_file, 'r') as fp:
+                manifest = json.load(fp)
+            if (manifest['source_stats'] == _file_stats(sources) and
+                    os.path.exists(output_file) and
+                    os.path.exists(mask_file)):
+                return Bunch(matrix=np.load(output_file, mmap_mode='r'),
+                             mask_img=nibabel.load(mask_file))
+
+        if os.path.exists(manifest_file):
+            # Stale until the matrix is built again
+            os.remove(manifest_file)
+        if not os.path.exists(os.path.dirname(output_file)):
+            os.makedirs(os.path.dirname(output_file))
+        ref_img = nibabel.load(maps[0])
+        if mask_img is None:
+            mask = np.zeros(ref_img.shape, dtype=bool)
+            for nonzero in Parallel(n_jobs=n_jobs, verbose=verbose)(
+                    delayed(_nonzero_map)(f) for f in maps):
+                mask |= nonzero
+        else:
+            mask = np.asarray(nibabel.load(mask_img).dataobj) != 0
+        nibabel.save(nibabel.Nifti1Image(mask.astype(np.uint8),
+                                         ref_img.get_affine()), mask_file)
+
+        temp_file = output_file[:-len('.npy')] + '.part.npy'
+        matrix = np.lib.format.open_memmap(
+            temp_file, mode='w+', dtype=np.float32,
+            shape=(len(maps), int(mask.sum())))
+        del matrix
+        Parallel(n_jobs=n_jobs, verbose=verbose)(
+            delayed(_mask_map)(f, mask, temp_file, row)
+            for row, f in enumerate(maps))
+        os.rename(temp_file, output_file)
+        _save_manifest(dict(maps=[os.path.relpath(f, self.data_dir)
+                                  for f in maps],
+                            source_stats=_file_stats(sources)),
+                       manifest_file)
+        return Bunch(matrix=np.load(output_file, mmap_mode='r'),
+                     mask_img=nibabel.load(mask_file))
+
     def fetch(self, n_subjects=None, dartel_version=True,
               url=None, resume=True, force=False, verbose=1):
         # check number of subjects
@@ -144,55 +339,22 @@ class OasisVbmDataset(HttpDataset):
                 url_images = url + "/archive.tgz"
 
         opts = {'uncompress': True}
-
-        # missing subjects create shifts in subjects ids
-        missing_subjects = [8, 24, 36, 48, 89, 93, 100, 118, 128, 149, 154,
-                            171, 172, 175, 187, 194, 196, 215, 219, 225, 242,
-                            245, 248, 251, 252, 257, 276, 297, 306, 320, 324,
-                            334, 347, 360, 364, 391, 393, 412, 414, 427, 436]
-
+        subject_ids = _get_subject_ids(dartel_version)[:n_subjects]
+        n_subjects = len(subject_ids)
         if dartel_version:
-            # DARTEL produces outliers that are hidden by nilearn API
-            removed_outliers = [27, 57, 66, 83, 122, 157, 222, 269, 282, 287,
-                                309, 428]
-            missing_subjects = sorted(missing_subjects + removed_outliers)
-            file_names_gm = [
-                (os.path.join(
-                        "OAS1_%04d_MR1",
-                        "mwrc1OAS1_%04d_MR1_mpr_anon_fslswapdim_bet.nii.gz")
-                 % (s, s),
-                 url_images, opts)
-                for s in range(1, 457) if s not in missing_subjects][:n_subjects]
-            file_names_wm = [
-                (os.path.join(
-                        "OAS1_%04d_MR1",
-                        "mwrc2OAS1_%04d_MR1_mpr_anon_fslswapdim_bet.nii.gz")
-                 % (s, s),
-                 url_images, opts)
-                for s in range(1, 457) if s not in missing_subjects]
+            gm_pattern = "mwrc1OAS1_%04d_MR1_mpr_anon_fslswapdim_bet.nii.gz"
+            wm_pattern = "mwrc2OAS1_%04d_MR1_mpr_anon_fslswapdim_bet.nii.gz"
         else:
-            # only one gross outlier produced, hidden by nilearn API
-            removed_outliers = [390]
-            missing_subjects = sorted(missing_subjects + removed_outliers)
-            file_names_gm = [
-                (os.path.join(
-                        "OAS1_%04d_MR1",
-                        "mwc1OAS1_%04d_MR1_mpr_anon_fslswapdim_bet.nii.gz")
-                 % (s, s),
-                 url_images, opts)
-                for s in range(1, 457) if s not in missing_subjects][:n_subjects]
-            file_names_wm = [
-                (os.path.join(
-                        "OAS1_%04d_MR1",
-                        "mwc2OAS1_%04d_MR1_mpr_anon_fslswapdim_bet.nii.gz")
-                 % (s, s),
-                 url_images, opts)
-                for s in range(1, 457) if s not in missing_subjects]
+            gm_pattern = "mwc1OAS1_%04d_MR1_mpr_anon_fslswapdim_bet.nii.gz"
+            wm_pattern = "mwc2OAS1_%04d_MR1_mpr_anon_fslswapdim_bet.nii.gz"
+        file_names_gm = [
+            (os.path.join("OAS1_%04d_MR1" % s, gm_pattern % s),
+             url_images, opts) for s in subject_ids]
+        file_names_wm = [
+            (os.path.join("OAS1_%04d_MR1" % s, wm_pattern % s),
+             url_images, opts) for s in subject_ids]
         file_names_extvars = [("oasis_cross-sectional.csv", url_csv, {})]
         file_names_dua = [("data_usage_agreement.txt", url_dua, {})]
-        # restrict to user-specified number of subjects
-        file_names_gm = file_names_gm[:n_subjects]
-        file_names_wm = file_names_wm[:n_subjects]
 
         file_names = (file_names_gm + file_names_wm
                       + file_names_extvars + file_names_dua)
@@ -206,15 +368,8 @@ class OasisVbmDataset(HttpDataset):
         data_usage_agreement = files[-1]
 
         # Keep CSV information only for selected subjects
-        csv_data = np.recfromcsv(ext_vars_file)
-        # Comparisons to recfromcsv data must be bytes.
-        actual_subjects_ids = [("OAS1" +
-                                str.split(os.path.basename(x),
-                                          "OAS1")[1][:9]).encode()
-                               for x in gm_maps]
-        subject_mask = np.asarray([subject_id in actual_subjects_ids
-                                   for subject_id in csv_data['id']])
-        csv_data = csv_data[subject_mask]
+        ext_vars, ext_vars_ids = self._load_ext_vars(ext_vars_file)
+        csv_data = _select_ext_vars(ext_vars, ext_vars_ids, subject_ids)
 
         return Bunch(
             gray_matter_maps=gm_maps,
@@ -7,6 +7,7 @@ Test the datasets module
 import numpy as np
 
 from nose import with_setup
+from nose.tools import assert_equal, assert_true, assert_raises
 
 from nidata.core import fetchers
 from nidata.core._utils.testing import (assert_raises_regex)
@@ -45,3 +46,72 @@ def test_fetch_oasis_vbm():
     assert_true(isinstance(dataset.ext_vars, np.recarray))
     assert_true(isinstance(dataset.data_usage_agreement, _basestring))
     assert_equal(len(get_url_request().urls), 4)
+
+
+def test_oasis_subject_selection():
+    from nidata.anatomical.oasis_vbm.datasets import (
+        _get_subject_ids, _subject_numbers, _select_ext_vars)
+    assert_equal(len(_get_subject_ids(dartel_version=True)), 403)
+    assert_equal(len(_get_subject_ids(dartel_version=False)), 414)
+    assert_true(390 not in _get_subject_ids(dartel_version=False))
+
+    csv_ids = np.array([b'OAS1_0001_MR1', b'OAS1_0002_MR1', b'OAS1_0002_MR2',
+                        b'OAS1_0004_MR1'])
+    ext_vars_ids = _subject_numbers(csv_ids)
+    np.testing.assert_array_equal(ext_vars_ids, [1, 2, -1, 4])
+    order = np.argsort(ext_vars_ids)[1:]
+    selected = _select_ext_vars(csv_ids[order], ext_vars_ids[order],
+                                np.array([1, 3, 4, 5]))
+    np.testing.assert_array_equal(selected, [b'OAS1_0001_MR1',
+                                             b'OAS1_0004_MR1'])
+
+
+@with_setup(setup_tmpdata, teardown_tmpdata)
+def test_oasis_group_matrix():
+    import os
+    import nibabel
+    from nidata.anatomical.oasis_vbm.datasets import OasisVbmDataset
+    dataset = OasisVbmDataset(data_dir=get_tmpdir())
+    rng = np.random.RandomState(0)
+    maps = []
+    for subject in range(3):
+        data = rng.rand(4, 5, 6).astype(np.float32)
+        data[0] = 0
+        maps.append(os.path.join(dataset.data_dir, 'map%d.nii.gz' % subject))
+        nibabel.save(nibabel.Nifti1Image(data, np.eye(4)), maps[-1])
+
+    group = dataset.group_matrix(maps, n_jobs=2)
+    assert_equal(group.matrix.shape, (3, 4 * 5 * 6 - 5 * 6))
+    mask = group.mask_img.get_data().astype(bool)
+    np.testing.assert_array_equal(
+        group.matrix[1], np.asarray(nibabel.load(maps[1]).dataobj)[mask])
+
+    # The stored matrix is memory-mapped until a map changes.
+    assert_true(isinstance(dataset.group_matrix(maps).matrix, np.memmap))
+    nibabel.save(nibabel.Nifti1Image(np.ones((4, 5, 6), dtype=np.float32),
+                                     np.eye(4)), maps[1])
+    os.utime(maps[1], (0, 0))
+    group = dataset.group_matrix(maps)
+    np.testing.assert_array_equal(group.matrix[1], 1)
+
+    # Deleted stored files are built again.
+    matrix_file = group.matrix.filename
+    del group
+    for f in (matrix_file, matrix_file[:-len('.npy')] + '_mask.nii.gz'):
+        os.remove(f)
+        group = dataset.group_matrix(maps)
+        np.testing.assert_array_equal(group.matrix[1], 1)
+        del group
+
+    # An interrupted build is not used.
+    from nidata.anatomical.oasis_vbm import datasets
+
+    def interrupted(*args):
+        raise KeyboardInterrupt
+    mask_map, datasets._mask_map = datasets._mask_map, interrupted
+    try:
+        assert_raises(KeyboardInterrupt, dataset.group_matrix, maps,
+                      force=True)
+    finally:
+        datasets._mask_map = mask_map
+    np.testing.assert_array_equal(dataset.group_matrix(maps).matrix[1], 1)
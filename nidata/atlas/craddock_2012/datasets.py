@@ -7,10 +7,10 @@ Utilities to download NeuroImaging-based atlases
 
 from sklearn.datasets.base import Bunch
 
-from ...core.datasets import HttpDataset
+from ...core.datasets import AtlasDataset
 
 
-class Craddock2012Dataset(HttpDataset):
+class Craddock2012Dataset(AtlasDataset):
     """Download and return file names for the Craddock 2012 parcellation
 
     The provided images are in MNI152 space.
@@ -7,14 +7,48 @@ Utilities to download NeuroImaging-based atlases
 
 import os
 
+import nibabel
 import numpy as np
+from scipy import ndimage
 from sklearn.datasets.base import Bunch
 
-from ...core.datasets import HttpDataset
+from ...core.datasets import AtlasDataset
 from ...core.fetchers import get_dataset_dir
+from ...core._utils.niimg import check_niimg, new_img_like
 
 
-class HarvardOxfordDataset(HttpDataset):
+def _symmetric_split(atlas):
+    """Split the regions of a label array crossing the median plane.
+
+    Voxels of these regions lying in the first half of the first axis get
+    new labels, numbered from max(atlas) + 1 in the order of the original
+    labels, and the median plane is set to background. The relabelling is
+    a single lookup table gather over the first half of the volume.
+    """
+    atlas = np.array(atlas, copy=True)
+    if atlas.dtype.kind not in 'iu':
+        atlas = atlas.astype(np.int32)
+    middle_ind = (atlas.shape[0] - 1) // 2
+    n_labels = int(atlas.max()) + 1
+
+    # ndimage.find_objects returns None for labels that do not exist
+    # Assumes that the background label is zero.
+    crossing = [label for label, s in enumerate(ndimage.find_objects(atlas),
+                                                start=1)
+                if s is not None
+                and s[0].start < middle_ind and s[0].stop > middle_ind]
+    if n_labels + len(crossing) > np.iinfo(atlas.dtype).max:
+        atlas = atlas.astype(np.int32)
+    lut = np.arange(n_labels, dtype=atlas.dtype)
+    lut[crossing] = np.arange(n_labels, n_labels + len(crossing))
+
+    # Put zeros on the median plane
+    atlas[middle_ind, ...] = 0
+    atlas[:middle_ind] = lut[atlas[:middle_ind]]
+    return atlas
+
+
+class HarvardOxfordDataset(AtlasDataset):
     """Load Harvard-Oxford parcellation from FSL if installed or download it.
 
     This function looks up for Harvard Oxford atlas in the system and load it
@@ -62,6 +96,12 @@ class HarvardOxfordDataset(HttpDataset):
         self.data_dir = get_dataset_dir(self.name, data_dir=data_dir,
                                         env_vars=['FSL_DIR', 'FSLDIR'])
 
+    def label_index(self, atlas_file, maps=None, volume=None, force=False):
+        if maps is None:
+            maps = '-prob-' in os.path.basename(atlas_file)
+        return super(HarvardOxfordDataset, self).label_index(
+            atlas_file, maps=maps, volume=volume, force=force)
+
     def fetch(self, atlas_name=None, symmetric_split=False,
               resume=True, force=False, verbose=1):
 
@@ -107,30 +147,21 @@ class HarvardOxfordDataset(HttpDataset):
             raise ValueError("Region splitting not supported for probabilistic "
                              "atlases")
 
-        atlas_img = check_niimg(atlas_img)
-        atlas = atlas_img.get_data()
-
-        labels = np.unique(atlas)
-        # ndimage.find_objects output contains None elements for labels
-        # that do not exist
-        found_slices = (s for s in ndimage.find_objects(atlas)
-                        if s is not None)
-        middle_ind = (atlas.shape[0] - 1) // 2
-        crosses_middle = [s.start < middle_ind and s.stop > middle_ind
-                          for s, _, _ in found_slices]
-
-        # Split every zone crossing the median plane into two parts.
-        # Assumes that the background label is zero.
-        half = np.zeros(atlas.shape, dtype=np.bool)
-        half[:middle_ind, ...] = True
-        new_label = max(labels) + 1
-        # Put zeros on the median plane
-        atlas[middle_ind, ...] = 0
-        for label, crosses in zip(labels[1:], crosses_middle):
-            if not crosses:
-                continue
-            atlas[np.logical_and(atlas == label, half)] = new_label
-            new_label += 1
+        # The split atlas is stored next to the original one
+        split_file = atlas_img.replace('.nii.gz', '-split.nii.gz')
+        if (not force and os.path.exists(split_file) and
+                os.path.getmtime(split_file) >= os.path.getmtime(atlas_img)):
+            split_img = nibabel.load(split_file)
+        else:
+            atlas_img = check_niimg(atlas_img)
+            split_img = new_img_like(atlas_img,
+                                     _symmetric_split(atlas_img.get_data()),
+                                     atlas_img.get_affine())
+            try:
+                split_img.to_filename(split_file)
+            except (IOError, OSError):
+                # e.g. read-only FSL installation
+                pass
 
         # Duplicate labels for right and left
         new_names = [names[0]]
@@ -139,7 +170,7 @@ class HarvardOxfordDataset(HttpDataset):
         for n in names[1:]:
             new_names.append(n + ', left part')
 
-        return new_img_like(atlas_img, atlas, atlas_img.get_affine()), new_names
+        return split_img, new_names
 
 
 def fetch_harvard_oxford(atlas_name, data_dir=None, symmetric_split=False,
@@ -9,10 +9,10 @@ import os
 
 from sklearn.datasets.base import Bunch
 
-from ...core.datasets import HttpDataset
+from ...core.datasets import AtlasDataset
 
 
-class MSDLDataset(HttpDataset):
+class MSDLDataset(AtlasDataset):
     """Download and load the MSDL brain atlas.
 
     Parameters
@@ -50,6 +50,8 @@ class MSDLDataset(HttpDataset):
         Gaël Varoquaux, R.C. Craddock NeuroImage, 2013.
 
     """
+    maps = True
+
     def fetch(self, url=None, resume=True, verbose=1):
         url = 'https://team.inria.fr/parietal/files/2015/01/MSDL_rois.zip'
         opts = {'uncompress': True}
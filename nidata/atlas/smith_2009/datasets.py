@@ -7,10 +7,10 @@ Utilities to download resting state MRI datasets
 
 from sklearn.datasets.base import Bunch
 
-from ...core.datasets import HttpDataset
+from ...core.datasets import AtlasDataset
 
 
-class Smith2009Dataset(HttpDataset):
+class Smith2009Dataset(AtlasDataset):
 
     """Download and load the Smith ICA and BrainMap atlas (dated 2009)
 
@@ -56,6 +56,8 @@ class Smith2009Dataset(HttpDataset):
     For more information about this dataset's structure:
     http://www.fmrib.ox.ac.uk/analysis/brainmap+rsns/
     """
+    maps = True
+
     def fetch(self, url=None, resume=True, verbose=1):
         if url is None:
             url = "http://www.fmrib.ox.ac.uk/analysis/brainmap+rsns/"
@@ -9,6 +9,7 @@ import numpy as np
 
 import nibabel
 from nose import with_setup
+from nose.tools import assert_equal, assert_true, assert_false
 
 from nidata.core._utils.compat import _basestring
 from nidata.core._utils.testing import assert_raises_regex
@@ -49,6 +50,96 @@ def test_fail_fetch_harvard_oxford():
     assert_true(len(arr) > 0)
 
 
+def test_harvard_oxford_symmetric_split():
+    from nidata.atlas.harvard_oxford.datasets import _symmetric_split
+    atlas = np.zeros((9, 4, 4), dtype=np.uint8)
+    atlas[1:8, :2] = 1  # crosses the median plane
+    atlas[5:8, 2:] = 2  # right part only
+    atlas[0:6, 2:] = 3  # crosses the median plane
+
+    split = _symmetric_split(atlas)
+    np.testing.assert_array_equal(split[4], 0)
+    np.testing.assert_array_equal(np.unique(split[:4]), [0, 4, 5])
+    np.testing.assert_array_equal(np.unique(split[5:]), [0, 1, 2, 3])
+    np.testing.assert_array_equal(split[:4] == 4, atlas[:4] == 1)
+    # The input is left untouched
+    assert_equal(atlas[4, 0, 0], 1)
+
+
+@with_setup(setup_tmpdata, teardown_tmpdata)
+def test_atlas_index():
+    from nidata.core._utils.atlas_index import get_atlas_index, index_filename
+    atlas = np.zeros((10, 12, 8), dtype=np.int16)
+    atlas[2:5, 3:9, 1:4] = 3
+    atlas[6:9, 0:2, 5:8] = 7
+    affine = np.diag([2., 2., 2., 1.])
+    atlas_file = os.path.join(get_tmpdir(), 'atlas.nii.gz')
+    nibabel.Nifti1Image(atlas, affine).to_filename(atlas_file)
+
+    index = get_atlas_index(atlas_file)
+    assert_true(os.path.exists(index_filename(atlas_file)))
+    np.testing.assert_array_equal(index.labels, [3, 7])
+    np.testing.assert_array_equal(index.sizes, [54, 18])
+    np.testing.assert_array_almost_equal(index.volumes, [432., 144.])
+    np.testing.assert_array_equal(index.bbox[0], [[2, 5], [3, 9], [1, 4]])
+    np.testing.assert_array_almost_equal(index.centroids[1], [14., 1., 12.])
+    np.testing.assert_array_equal(index.region(0),
+                                  np.flatnonzero(atlas.ravel() == 3))
+
+    # The stored index is reused
+    stored = get_atlas_index(atlas_file)
+    np.testing.assert_array_equal(stored.indices, index.indices)
+    assert_equal(stored.shape, atlas.shape)
+    assert_false(stored.maps)
+
+    # Maps and labels of the same file have their own index
+    maps_file = os.path.join(get_tmpdir(), 'maps.nii.gz')
+    maps = np.zeros(atlas.shape + (2, ), dtype=np.float32)
+    maps[..., 0] = atlas == 3
+    maps[..., 1] = 7 * (atlas == 7)
+    nibabel.Nifti1Image(maps, affine).to_filename(maps_file)
+    maps_index = get_atlas_index(maps_file, maps=True)
+    assert_true(maps_index.maps)
+    np.testing.assert_array_equal(maps_index.sizes, [54, 18])
+    assert_true(get_atlas_index(maps_file, maps=True).maps)
+    # 4D label atlases need a volume
+    assert_raises_regex(ValueError, 'volume', get_atlas_index, maps_file)
+    labels = get_atlas_index(maps_file, volume=1)
+    assert_false(labels.maps)
+    np.testing.assert_array_equal(labels.sizes, [18])
+    assert_true(os.path.exists(index_filename(maps_file, maps=True)))
+    assert_true(os.path.exists(index_filename(maps_file, volume=1)))
+
+
+@with_setup(setup_tmpdata, teardown_tmpdata)
+def test_extract_region_signals():
+    from nidata.core._utils.atlas_index import AtlasIndex
+    from nidata.core._utils.region_signals import (extract_region_signals,
+                                                   load_region_signals)
+    rng = np.random.RandomState(0)
+    atlas = np.zeros((10, 12, 8), dtype=np.int16)
+    atlas[2:5, 3:9, 1:4] = 3
+    atlas[6:9, 0:2, 5:8] = 7
+    index = AtlasIndex.from_img(nibabel.Nifti1Image(atlas, np.eye(4)))
+
+    imgs, expected = [], []
+    for n_scans in (5, 20):
+        data = rng.rand(10, 12, 8, n_scans).astype(np.float32)
+        imgs.append(nibabel.Nifti1Image(data, np.eye(4)))
+        expected.append(np.array([data[atlas == 3].mean(axis=0),
+                                  data[atlas == 7].mean(axis=0)]).T)
+
+    for signals in (extract_region_signals(index, imgs, chunk_size=8),
+                    extract_region_signals(
+                        index, imgs, chunk_size=8,
+                        output_file=os.path.join(get_tmpdir(), 'sig.npy'))):
+        for signal, exp in zip(signals, expected):
+            np.testing.assert_array_almost_equal(signal, exp, decimal=5)
+
+    packed = load_region_signals(os.path.join(get_tmpdir(), 'sig.npy'))
+    assert_equal([s.shape for s in packed], [(5, 2), (20, 2)])
+
+
 # Smoke tests for the rest of the fetchers
 
 
@@ -9,10 +9,10 @@ import os
 
 from sklearn.datasets.base import Bunch
 
-from ...core.datasets import HttpDataset
+from ...core.datasets import AtlasDataset
 
 
-class Yeo2011Dataset(HttpDataset):
+class Yeo2011Dataset(AtlasDataset):
     """Download and return file names for the Yeo 2011 parcellation.
 
     The provided images are in MNI152 space.
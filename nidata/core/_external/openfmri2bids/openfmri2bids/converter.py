@@ -1,17 +1,25 @@
 from __future__ import print_function
 
 import errno
+import hashlib
 import os
 import shutil
 import json
 import re
+from fnmatch import fnmatch
+from io import StringIO
+from multiprocessing import Pool
 from os import path
-from glob import glob
 
 import pandas as pd
 import numpy as np
 
 NII_HANDLING_OPTS = ['empty', 'move', 'copy', 'link']  # first entry is default
+ANATOMY_MAPPING = {"highres": "T1w",
+                   "inplane": "inplaneT2"}
+STATE_FILE = ".openfmri2bids_state.json"
+# Marks subject outputs holding the only copy of images moved from the sources
+MOVED_FILE = ".openfmri2bids_moved"
 
 
 def sanitize_label(label):
@@ -32,39 +40,67 @@ def handle_nii(opt, src=None, dest=None):
     else:
         raise NotImplementedError('Unrecognized nii_handling value: %s' % opt)
 
-def convert(source_dir, dest_dir, nii_handling=NII_HANDLING_OPTS[0], warning=print, ses=""):
-    if ses:
-        folder_ses = "ses-%s"%ses
-        filename_ses = "%s_"%folder_ses
-    else:
-        folder_ses = ""
-        filename_ses = ""
+def _mkdir(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc: # Python >2.5
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else: raise
+
+def read_onsets(fpath):
+    """Parses an OpenfMRI onset file (onset, duration, weight columns)."""
+    with open(fpath) as f:
+        text = f.read()
+    if not isinstance(text, type(u"")):
+        text = text.decode("utf-8")
+    # r"\s+" is handled by the C engine
+    df = pd.read_csv(StringIO(text),
+                     sep=r"\s+",
+                     names=["onset", "duration", "weight"],
+                     header=None,
+                     index_col=False,
+                     skip_blank_lines=True)
+    if df.duration.isnull().sum() > 0:
+        df = pd.read_csv(StringIO(text),
+                         sep=" ",
+                         names=["onset", "duration", "weight"],
+                         header=None,
+                         index_col=False)
+    return df
 
-    def mkdir(path):
+def _fingerprint(source_dir, openfmri_s, nii_handling):
+    """Digest of the sources of a subject: names, sizes and mtimes of its
+    files, and of the dataset-level key files."""
+    md5 = hashlib.md5(nii_handling.encode("utf-8"))
+    paths = [path.join(source_dir, f) for f in
+             ("task_key.txt", "scan_key.txt",
+              path.join("models", "model001", "condition_key.txt"))]
+    for root, dirs, files in os.walk(path.join(source_dir, openfmri_s)):
+        dirs.sort()
+        paths.extend(path.join(root, f) for f in sorted(files))
+    for fpath in paths:
         try:
-            os.makedirs(path)
-        except OSError as exc: # Python >2.5
-            if exc.errno == errno.EEXIST and os.path.isdir(path):
-                pass
-            else: raise
-    
-    openfmri_subjects = [s.split(os.sep)[-1] for s in glob(path.join(source_dir, "sub*"))]
-    print("OpenfMRI subject IDs: " + str(openfmri_subjects))
-    n_digits = len(str(len(openfmri_subjects)))
-    subject_template = "sub-%0" + str(n_digits) + "d"
-    BIDS_subjects = [subject_template%int(s[-3:]) for s in openfmri_subjects]
-    print("BIDS subject IDs: " + str(BIDS_subjects))
-    
-    mkdir(dest_dir)
-    for openfmri_s, BIDS_s in zip(openfmri_subjects, BIDS_subjects):
-        mkdir(path.join(dest_dir, BIDS_s))
-        
-    tasks = set([s[:7] for s in os.listdir(path.join(source_dir, openfmri_subjects[0], "BOLD")) if s.startswith("task")])
-    
+            stat = os.stat(fpath)
+        except OSError:
+            continue
+        md5.update(("%s %d %d\n" % (path.relpath(fpath, source_dir),
+                                     stat.st_size,
+                                     stat.st_mtime)).encode("utf-8"))
+    return md5.hexdigest()
+
+def _dataset_info(source_dir):
+    """Reads the subjects, tasks, runs, conditions and scan parameters."""
+    openfmri_subjects = sorted(s for s in os.listdir(source_dir)
+                               if s.startswith("sub"))
+
+    bold_dir = os.listdir(path.join(source_dir, openfmri_subjects[0], "BOLD"))
+    tasks = set([s[:7] for s in bold_dir if s.startswith("task")])
+
     tasks_dict = {}
     for task in tasks:
-        tasks_dict[task] = {"runs": set([s[8:] for s in os.listdir(path.join(source_dir, openfmri_subjects[0], "BOLD")) if s.startswith(task)])}
-    
+        tasks_dict[task] = {"runs": set([s[8:] for s in bold_dir if s.startswith(task)])}
+
     with open(os.path.join(source_dir, "models", "model001", "condition_key.txt")) as f:
         for line in f:
             if line.strip() == "":
@@ -76,74 +112,12 @@ def convert(source_dir, dest_dir, nii_handling=NII_HANDLING_OPTS[0], warning=pri
             if "conditions" not in tasks_dict[task]:
                 tasks_dict[task]["conditions"] = {}
             tasks_dict[task]["conditions"][condition] = condition_name
-    
+
     with open(os.path.join(source_dir, "task_key.txt")) as f:
         for line in f:
             words = line.split()
             tasks_dict[words[0]]['name'] = " ".join(words[1:])
-    
-    for openfmri_s, BIDS_s in zip(openfmri_subjects, BIDS_subjects):
-        for task in tasks:
-            for run in tasks_dict[task]["runs"]:
-                if len(tasks_dict[task]["runs"]) == 1:
-                    trg_run = ""
-                else:
-                    trg_run = "_run%s"%run[4:]
-                mkdir(path.join(dest_dir, BIDS_s, folder_ses, "functional"))
-                dst = path.join(dest_dir, 
-                                BIDS_s,
-                                folder_ses, 
-                                "functional",
-                                "%s_%s%s%s_bold.nii.gz"%(BIDS_s, filename_ses, "task-%s"%sanitize_label(tasks_dict[task]['name']), trg_run))
-                src = path.join(source_dir, 
-                                openfmri_s, 
-                                "BOLD", 
-                                "%s_%s"%(task, run), 
-                                "bold.nii.gz")
-                if not os.path.exists(src):
-                    warning("%s does not exist"%src)
-                    continue
 
-                handle_nii(nii_handling, src=src, dest=dst)
-    
-    anatomy_mapping = {"highres": "T1w",
-                       "inplane": "inplaneT2"}
-                    
-    for openfmri_s, BIDS_s in zip(openfmri_subjects, BIDS_subjects):
-        mkdir(path.join(dest_dir, BIDS_s, folder_ses, "anatomy"))
-        for anatomy_openfmri, anatomy_bids in anatomy_mapping.iteritems():
-            runs = [s[-10:-7] for s in glob(path.join(source_dir, 
-                                                      openfmri_s, 
-                                                      "anatomy", 
-                                                      "%s*.nii.gz"%anatomy_openfmri))]
-            for run in runs:
-                src_run = run
-                if run == anatomy_openfmri[-3:]:
-                    run = "001"
-                    src_run=""
-                # dirty hack
-                try:
-                    int(run)
-                except:
-                    continue
-                
-                if len([s for s in runs if s.isdigit()]) <= 1:
-                    trg_run = ""
-                else:
-                    trg_run = "_run%s"%run[1:]
-                    
-                dst = path.join(dest_dir, 
-                                BIDS_s,
-                                folder_ses,
-                                "anatomy",
-                                "%s_%s%s%s.nii.gz"%(BIDS_s, filename_ses, anatomy_bids, trg_run))
-                src = path.join(source_dir, 
-                                openfmri_s, 
-                                "anatomy", 
-                                "%s%s.nii.gz"%(anatomy_openfmri, src_run))
-
-                handle_nii(nii_handling, src=src, dest=dst)
-    
     scan_parameters_dict = {}
     with open(os.path.join(source_dir, "scan_key.txt")) as f:
         for line in f:
@@ -151,171 +125,311 @@ def convert(source_dir, dest_dir, nii_handling=NII_HANDLING_OPTS[0], warning=pri
             if items[0] == "TR":
                 scan_parameters_dict["RepetitionTime"] = float(items[1])
 
-    for openfmri_s, BIDS_s in zip(openfmri_subjects, BIDS_subjects):
-        scans_dfs = []
-        for task in tasks_dict.keys():
-            for run in tasks_dict[task]["runs"]:
-                if len(tasks_dict[task]["runs"]) == 1:
-                    trg_run = ""
+    return openfmri_subjects, tasks, tasks_dict, scan_parameters_dict
+
+def convert_subject(source_dir, dest_dir, openfmri_s, BIDS_s, tasks,
+                    tasks_dict, scan_parameters_dict,
+                    nii_handling=NII_HANDLING_OPTS[0], warning=print, ses=""):
+    """Converts the data of one subject."""
+    if ses:
+        folder_ses = "ses-%s"%ses
+        filename_ses = "%s_"%folder_ses
+    else:
+        folder_ses = ""
+        filename_ses = ""
+
+    # Outputs of a previous conversion are outdated, unless they hold images
+    # moved out of the sources.
+    subject_dir = path.join(dest_dir, BIDS_s, folder_ses)
+    if path.exists(path.join(subject_dir, MOVED_FILE)):
+        raise IOError("%s holds images moved from %s: not converting it "
+                      "again" % (subject_dir, path.join(source_dir,
+                                                        openfmri_s)))
+    if path.isdir(subject_dir):
+        shutil.rmtree(subject_dir)
+    _mkdir(subject_dir)
+    if nii_handling == 'move':
+        open(path.join(subject_dir, MOVED_FILE), "w").close()
+
+    for task in tasks:
+        for run in tasks_dict[task]["runs"]:
+            if len(tasks_dict[task]["runs"]) == 1:
+                trg_run = ""
+            else:
+                trg_run = "_run%s"%run[4:]
+            _mkdir(path.join(dest_dir, BIDS_s, folder_ses, "functional"))
+            dst = path.join(dest_dir, 
+                            BIDS_s,
+                            folder_ses, 
+                            "functional",
+                            "%s_%s%s%s_bold.nii.gz"%(BIDS_s, filename_ses, "task-%s"%sanitize_label(tasks_dict[task]['name']), trg_run))
+            src = path.join(source_dir, 
+                            openfmri_s, 
+                            "BOLD", 
+                            "%s_%s"%(task, run), 
+                            "bold.nii.gz")
+            if not os.path.exists(src):
+                warning("%s does not exist"%src)
+                continue
+
+            handle_nii(nii_handling, src=src, dest=dst)
+
+
+    _mkdir(path.join(dest_dir, BIDS_s, folder_ses, "anatomy"))
+    anat_dir = path.join(source_dir, openfmri_s, "anatomy")
+    anat_files = os.listdir(anat_dir) if path.isdir(anat_dir) else []
+    for anatomy_openfmri, anatomy_bids in ANATOMY_MAPPING.items():
+        runs = [s[-10:-7] for s in anat_files
+                if fnmatch(s, "%s*.nii.gz"%anatomy_openfmri)]
+        for run in runs:
+            src_run = run
+            if run == anatomy_openfmri[-3:]:
+                run = "001"
+                src_run=""
+            # dirty hack
+            try:
+                int(run)
+            except:
+                continue
+
+            if len([s for s in runs if s.isdigit()]) <= 1:
+                trg_run = ""
+            else:
+                trg_run = "_run%s"%run[1:]
+
+            dst = path.join(dest_dir, 
+                            BIDS_s,
+                            folder_ses,
+                            "anatomy",
+                            "%s_%s%s%s.nii.gz"%(BIDS_s, filename_ses, anatomy_bids, trg_run))
+            src = path.join(source_dir, 
+                            openfmri_s, 
+                            "anatomy", 
+                            "%s%s.nii.gz"%(anatomy_openfmri, src_run))
+
+            handle_nii(nii_handling, src=src, dest=dst)
+
+
+    scans_dfs = []
+    for task in tasks_dict.keys():
+        for run in tasks_dict[task]["runs"]:
+            if len(tasks_dict[task]["runs"]) == 1:
+                trg_run = ""
+            else:
+                trg_run = "_run%s"%run[4:]
+
+            dfs = []
+            parametric_columns = []
+            for condition_id, condition_name in tasks_dict[task]["conditions"].items():
+                # TODO: check if onsets are in seconds
+                fpath = os.path.join(source_dir, 
+                                   openfmri_s, 
+                                   "model", 
+                                   "model001", 
+                                   "onsets", 
+                                   "%s_%s"%(task, run), 
+                                   "%s.txt"%condition_id)
+                if not os.path.exists(fpath):
+                    warning("%s does not exist"%fpath)
+                    continue
+                if os.stat(fpath).st_size == 0:
+                    warning("%s is empty"%fpath)
+                    continue
+                tmp_df = read_onsets(fpath)
+                tmp_df["trial_type"] = condition_name
+                if len(tmp_df["weight"].unique()) != 1:
+                    tmp_df[condition_name] = tmp_df["weight"]
+                    parametric_columns.append(condition_name)
+                dfs.append(tmp_df)
+            if dfs:
+                events_df = pd.concat(dfs, ignore_index=True)
+                if(parametric_columns):
+                    events_df = events_df.sort(parametric_columns, na_position="first").drop_duplicates(["onset", "duration"], take_last=True)
+                events_df.drop('weight', axis=1, inplace=True)
+            else:
+                continue
+
+
+            beh_path = os.path.join(source_dir, 
+                                    openfmri_s, 
+                                    "behav",
+                                    "%s_%s"%(task, run),
+                                    "behavdata.txt")
+            if os.path.exists(beh_path):
+                # There is a timing discrepancy between cond and behav - we need to use approximation to match them
+                if os.stat(beh_path).st_size == 0:
+                    warning("%s is empty"%beh_path)
+                    all_df = events_df
                 else:
-                    trg_run = "_run%s"%run[4:]
-
-                dfs = []
-                parametric_columns = []
-                for condition_id, condition_name in tasks_dict[task]["conditions"].iteritems():
-                    # TODO: check if onsets are in seconds
-                    fpath = os.path.join(source_dir, 
-                                       openfmri_s, 
-                                       "model", 
-                                       "model001", 
-                                       "onsets", 
-                                       "%s_%s"%(task, run), 
-                                       "%s.txt"%condition_id)
-                    if not os.path.exists(fpath):
-                        warning("%s does not exist"%fpath)
-                        continue
-                    if os.stat(fpath).st_size == 0:
-                        warning("%s is empty"%fpath)
-                        continue
-                    tmp_df = pd.read_csv(fpath,
-                                         delimiter=r"\s+",
-                                         names=["onset", "duration", "weight"], 
-                                         header=None,
-                                         engine="python",
-                                         index_col=False,
-                                         skip_blank_lines=True
-                                        )
-                    if tmp_df.duration.isnull().sum() > 0:
-                        tmp_df = pd.read_csv(os.path.join(source_dir, 
-                                                      openfmri_s, 
-                                                      "model", 
-                                                      "model001", 
-                                                      "onsets", 
-                                                      "%s_%s"%(task, run), 
-                                                      "%s.txt"%condition_id),
-                                         sep=" ",
-                                         names=["onset", "duration", "weight"], 
-                                         header=None,
+                    unlabeled_beh = False
+                    beh_df = pd.read_csv(beh_path,
+                                         sep=None,
+                                         #delimiter=r"\s+",
                                          engine="python",
                                          index_col=False
-                                        )
-                    tmp_df["trial_type"] = condition_name
-                    if len(tmp_df["weight"].unique()) != 1:
-                        tmp_df[condition_name] = tmp_df["weight"]
-                        parametric_columns.append(condition_name)
-                    dfs.append(tmp_df)
-                if dfs:
-                    events_df = pd.concat(dfs, ignore_index=True)
-                    if(parametric_columns):
-                        events_df = events_df.sort(parametric_columns, na_position="first").drop_duplicates(["onset", "duration"], take_last=True)
-                    events_df.drop('weight', axis=1, inplace=True)
-                else:
-                    continue
-                
-                
-                beh_path = os.path.join(source_dir, 
-                                        openfmri_s, 
-                                        "behav",
-                                        "%s_%s"%(task, run),
-                                        "behavdata.txt")
-                if os.path.exists(beh_path):
-                    # There is a timing discrepancy between cond and behav - we need to use approximation to match them
-                    if os.stat(beh_path).st_size == 0:
-                        warning("%s is empty"%beh_path)
-                        all_df = events_df
-                    else:
-                        unlabeled_beh = False
-                        beh_df = pd.read_csv(beh_path,
-                                             sep=None,
-                                             #delimiter=r"\s+",
+                                         )
+                    if 'TrialOnset' in beh_df.columns:
+                        beh_df.rename(columns={'TrialOnset': 'Onset'}, inplace=True)
+                    if 'TR' in beh_df.columns:
+                        beh_df["TR"] = (beh_df["TR"]-1)*scan_parameters_dict["RepetitionTime"]
+                        beh_df["duration"] = beh_df['TR'].map(lambda x: scan_parameters_dict["RepetitionTime"])
+                        beh_df.rename(columns={'TR': 'onset'}, inplace=True)
+                        all_df = pd.concat([events_df, beh_df])
+                        unlabeled_beh = True
+
+                    if "Onset" not in beh_df.columns:
+                        if "onset" not in beh_df.columns:
+                            beh_df_no_header = pd.read_csv(beh_path, sep=None, engine="python", index_col=False, header=None)
+                            if len(beh_df_no_header.index) == len(events_df.index):
+                                events_df.sort(columns=["onset"], inplace=True)
+                                events_df.index = range(len(events_df))
+                                all_df = pd.concat([events_df, beh_df_no_header], axis=1)
+                                unlabeled_beh = True
+                            elif len(beh_df.index) == len(events_df.index):
+                                events_df.sort(columns=["onset"], inplace=True)
+                                events_df.index = range(len(events_df))
+                                all_df = pd.concat([events_df, beh_df], axis=1)
+                                unlabeled_beh = True
+                            else:
+                                # behdata are not events
+                                try:
+                                    beh_df = pd.read_csv(beh_path,
+                                             sep=" ",
                                              engine="python",
                                              index_col=False
                                              )
-                        if 'TrialOnset' in beh_df.columns:
-                            beh_df.rename(columns={'TrialOnset': 'Onset'}, inplace=True)
-                        if 'TR' in beh_df.columns:
-                            beh_df["TR"] = (beh_df["TR"]-1)*scan_parameters_dict["RepetitionTime"]
-                            beh_df["duration"] = beh_df['TR'].map(lambda x: scan_parameters_dict["RepetitionTime"])
-                            beh_df.rename(columns={'TR': 'onset'}, inplace=True)
-                            all_df = pd.concat([events_df, beh_df])
-                            unlabeled_beh = True
-                            
-                        if "Onset" not in beh_df.columns:
-                            if "onset" not in beh_df.columns:
-                                beh_df_no_header = pd.read_csv(beh_path, sep=None, engine="python", index_col=False, header=None)
-                                if len(beh_df_no_header.index) == len(events_df.index):
-                                    events_df.sort(columns=["onset"], inplace=True)
-                                    events_df.index = range(len(events_df))
-                                    all_df = pd.concat([events_df, beh_df_no_header], axis=1)
-                                    unlabeled_beh = True
-                                elif len(beh_df.index) == len(events_df.index):
-                                    events_df.sort(columns=["onset"], inplace=True)
-                                    events_df.index = range(len(events_df))
-                                    all_df = pd.concat([events_df, beh_df], axis=1)
-                                    unlabeled_beh = True
-                                else:
-                                    # behdata are not events
-                                    try:
-                                        beh_df = pd.read_csv(beh_path,
-                                                 sep=" ",
-                                                 engine="python",
-                                                 index_col=False
-                                                 )
-                                    except:
-                                        beh_df = pd.read_csv(beh_path,
-                                                 sep=",",
-                                                 engine="python",
-                                                 index_col=False
-                                                 )
-                                    beh_df["filename"] = path.join("functional",
-                                                                   "%s_%s%s.nii.gz"%(BIDS_s, "task-%s"%sanitize_label(tasks_dict[task]['name']), trg_run))
-                                    beh_df.set_index("filename", inplace=True)
-                                    scans_dfs.append(beh_df)
-                                    all_df = events_df
-                            else:
-                                beh_df.rename(columns={'onset': 'Onset'}, inplace=True)
-                    
-                        if not scans_dfs and not unlabeled_beh:
-                            events_df["approx_onset"] = np.around(events_df["onset"],1)
-                            beh_df["approx_onset"] = np.around(beh_df["Onset"],1)
-        
-                            all_df = pd.merge(left=events_df, right=beh_df, left_on="approx_onset", right_on="approx_onset", how="outer")
-        
-                            # Set onset to the average of onsets reported in cond and behav since we do not know which one is true
-                            all_df["onset"].fillna(all_df["Onset"], inplace=True)
-                            all_df["Onset"].fillna(all_df["onset"], inplace=True)
-                            all_df["onset"] = (all_df["onset"]+all_df["Onset"])/2.0
-                            all_df = all_df.drop(["Onset","approx_onset"], axis=1)
-                else:
-                    all_df = events_df
-                
-                all_df.sort(columns=["onset"], inplace=True)
-                dest = path.join(dest_dir, 
-                                 BIDS_s,
-                                 folder_ses,
-                                 "functional",
-                                 "%s_%s%s%s_events.tsv"%(BIDS_s, filename_ses, "task-%s"%sanitize_label(tasks_dict[task]['name']), trg_run))
-                #remove rows with zero duration:
-                if (all_df.duration == 0).sum() > 0:
-                    warning("%s original data had events with zero duration - removing."%dest)
-                    warning(str(all_df[all_df.duration == 0] ))
-                    all_df = all_df[all_df.duration != 0]
-                # put onset, duration and trial_type in front
-                cols = all_df.columns.tolist()
-                cols.insert(0, cols.pop(cols.index("onset")))
-                cols.insert(1, cols.pop(cols.index("duration")))
-                cols.insert(2, cols.pop(cols.index("trial_type")))
-                all_df = all_df[cols]
-                
-                all_df.to_csv(dest, sep="\t", na_rep="n/a", index=False)
-                
-        if scans_dfs:
-            all_df = pd.concat(scans_dfs)
-            all_df.to_csv(path.join(dest_dir, 
-                                    BIDS_s,
-                                    folder_ses,
-                                    "%s%s_scans.tsv"%(filename_ses, BIDS_s)), sep="\t", na_rep="n/a", index=True)
-            
+                                except:
+                                    beh_df = pd.read_csv(beh_path,
+                                             sep=",",
+                                             engine="python",
+                                             index_col=False
+                                             )
+                                beh_df["filename"] = path.join("functional",
+                                                               "%s_%s%s.nii.gz"%(BIDS_s, "task-%s"%sanitize_label(tasks_dict[task]['name']), trg_run))
+                                beh_df.set_index("filename", inplace=True)
+                                scans_dfs.append(beh_df)
+                                all_df = events_df
+                        else:
+                            beh_df.rename(columns={'onset': 'Onset'}, inplace=True)
+
+                    if not scans_dfs and not unlabeled_beh:
+                        events_df["approx_onset"] = np.around(events_df["onset"],1)
+                        beh_df["approx_onset"] = np.around(beh_df["Onset"],1)
+
+                        all_df = pd.merge(left=events_df, right=beh_df, left_on="approx_onset", right_on="approx_onset", how="outer")
+
+                        # Set onset to the average of onsets reported in cond and behav since we do not know which one is true
+                        all_df["onset"].fillna(all_df["Onset"], inplace=True)
+                        all_df["Onset"].fillna(all_df["onset"], inplace=True)
+                        all_df["onset"] = (all_df["onset"]+all_df["Onset"])/2.0
+                        all_df = all_df.drop(["Onset","approx_onset"], axis=1)
+            else:
+                all_df = events_df
+
+            all_df.sort(columns=["onset"], inplace=True)
+            dest = path.join(dest_dir, 
+                             BIDS_s,
+                             folder_ses,
+                             "functional",
+                             "%s_%s%s%s_events.tsv"%(BIDS_s, filename_ses, "task-%s"%sanitize_label(tasks_dict[task]['name']), trg_run))
+            #remove rows with zero duration:
+            if (all_df.duration == 0).sum() > 0:
+                warning("%s original data had events with zero duration - removing."%dest)
+                warning(str(all_df[all_df.duration == 0] ))
+                all_df = all_df[all_df.duration != 0]
+            # put onset, duration and trial_type in front
+            cols = all_df.columns.tolist()
+            cols.insert(0, cols.pop(cols.index("onset")))
+            cols.insert(1, cols.pop(cols.index("duration")))
+            cols.insert(2, cols.pop(cols.index("trial_type")))
+            all_df = all_df[cols]
+
+            all_df.to_csv(dest, sep="\t", na_rep="n/a", index=False)
+
+    if scans_dfs:
+        all_df = pd.concat(scans_dfs)
+        all_df.to_csv(path.join(dest_dir, 
+                                BIDS_s,
+                                folder_ses,
+                                "%s%s_scans.tsv"%(filename_ses, BIDS_s)), sep="\t", na_rep="n/a", index=True)
+
+
+def _convert_subject(args):
+    """Converts a subject, returns the fingerprint of its sources once
+    converted (moved images are no longer part of them)."""
+    convert_subject(*args[:-1], **args[-1])
+    source_dir, openfmri_s = args[0], args[2]
+    return openfmri_s, args[3], _fingerprint(source_dir, openfmri_s,
+                                             args[-1]["nii_handling"])
+
+def convert(source_dir, dest_dir, nii_handling=NII_HANDLING_OPTS[0], warning=print, ses="",
+            n_jobs=1, force=False):
+    """Converts an OpenfMRI dataset to BIDS, incrementally.
+
+    The digest of the sources of each converted subject is stored in
+    dest_dir: subjects whose sources did not change since their last
+    conversion are skipped (unless force is True). Subjects are converted
+    by n_jobs processes (warning must then be picklable).
+
+    Subjects converted with nii_handling='move' hold the only copy of their
+    images: they are never converted again, but skipped with a warning.
+    """
+    if ses:
+        folder_ses = "ses-%s"%ses
+        filename_ses = "%s_"%folder_ses
+    else:
+        folder_ses = ""
+        filename_ses = ""
+
+    openfmri_subjects, tasks, tasks_dict, scan_parameters_dict = \
+        _dataset_info(source_dir)
+    print("OpenfMRI subject IDs: " + str(openfmri_subjects))
+    n_digits = len(str(len(openfmri_subjects)))
+    subject_template = "sub-%0" + str(n_digits) + "d"
+    BIDS_subjects = [subject_template%int(s[-3:]) for s in openfmri_subjects]
+    print("BIDS subject IDs: " + str(BIDS_subjects))
+
+    _mkdir(dest_dir)
+    state_file = path.join(dest_dir, STATE_FILE)
+    state = {}
+    if path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+
+    todo = []
+    for openfmri_s, BIDS_s in zip(openfmri_subjects, BIDS_subjects):
+        _mkdir(path.join(dest_dir, BIDS_s))
+        fingerprint = _fingerprint(source_dir, openfmri_s, nii_handling)
+        if not force and state.get(filename_ses + BIDS_s) == fingerprint:
+            continue
+        if path.exists(path.join(dest_dir, BIDS_s, folder_ses, MOVED_FILE)):
+            warning("%s changed, but %s holds images moved from it: not "
+                    "converted again" % (path.join(source_dir, openfmri_s),
+                                         path.join(dest_dir, BIDS_s,
+                                                   folder_ses)))
+            continue
+        todo.append((source_dir, dest_dir, openfmri_s, BIDS_s, tasks,
+                     tasks_dict, scan_parameters_dict,
+                     dict(nii_handling=nii_handling, warning=warning, ses=ses)))
+    print("Subjects to convert: " + str([args[3] for args in todo]))
+
+    if n_jobs != 1 and len(todo) > 1:
+        pool = Pool(n_jobs if n_jobs > 0 else None)
+        done = pool.imap_unordered(_convert_subject, todo)
+    else:
+        pool = None
+        done = (_convert_subject(args) for args in todo)
+    try:
+        # Progress is saved after every subject
+        for openfmri_s, BIDS_s, fingerprint in done:
+            state[filename_ses + BIDS_s] = fingerprint
+            with open(state_file, "w") as f:
+                json.dump(state, f, sort_keys=True, indent=4)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
     dem_file = os.path.join(source_dir,"demographics.txt")
     if not os.path.exists(dem_file):
         warning("%s does not exist"%dem_file)
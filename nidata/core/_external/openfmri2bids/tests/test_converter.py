@@ -0,0 +1,111 @@
+import json
+import os
+
+import pytest
+from openfmri2bids import converter
+
+
+def _write(fpath, text=""):
+    if not os.path.isdir(os.path.dirname(fpath)):
+        os.makedirs(os.path.dirname(fpath))
+    with open(fpath, "w") as f:
+        f.write(text)
+
+
+def _touch_later(fpath):
+    # Don't depend on the resolution of file times
+    stat = os.stat(fpath)
+    os.utime(fpath, (stat.st_atime, stat.st_mtime + 10))
+
+
+@pytest.fixture
+def dataset(tmpdir):
+    source = str(tmpdir.join("ds000"))
+    _write(os.path.join(source, "task_key.txt"), "task001 stop signal\n")
+    _write(os.path.join(source, "scan_key.txt"), "TR 2.0\n")
+    _write(os.path.join(source, "models", "model001", "condition_key.txt"),
+           "task001 cond001 go\n")
+    subject = os.path.join(source, "sub001")
+    _write(os.path.join(subject, "BOLD", "task001_run001", "bold.nii.gz"),
+           "bold")
+    _write(os.path.join(subject, "anatomy", "highres001.nii.gz"), "anat")
+    _write(os.path.join(subject, "model", "model001", "onsets",
+                        "task001_run001", "cond001.txt"),
+           "0 1 1\n10 1 1\n")
+    return source, str(tmpdir.join("ds000_BIDS"))
+
+
+def _outputs(dest):
+    func_dir = os.path.join(dest, "sub-1", "functional")
+    return (os.path.join(func_dir, "sub-1_task-stopsignal_bold.nii.gz"),
+            os.path.join(func_dir, "sub-1_task-stopsignal_events.tsv"))
+
+
+def test_state_and_skip(dataset):
+    source, dest = dataset
+    converter.convert(source, dest, nii_handling="copy")
+    bold, events = _outputs(dest)
+    assert os.path.exists(bold)
+    with open(os.path.join(dest, converter.STATE_FILE)) as f:
+        assert list(json.load(f)) == ["sub-1"]
+
+    # Unchanged subjects are not converted again.
+    mtime = os.stat(events).st_mtime
+    os.remove(bold)
+    converter.convert(source, dest, nii_handling="copy")
+    assert not os.path.exists(bold)
+    assert os.stat(events).st_mtime == mtime
+
+    converter.convert(source, dest, nii_handling="copy", force=True)
+    assert os.path.exists(bold)
+
+
+def test_reconvert(dataset):
+    source, dest = dataset
+    converter.convert(source, dest, nii_handling="link")
+    bold, events = _outputs(dest)
+    stale = os.path.join(dest, "sub-1", "functional", "stale.txt")
+    _write(stale)
+
+    onsets = os.path.join(source, "sub001", "model", "model001", "onsets",
+                          "task001_run001", "cond001.txt")
+    with open(onsets, "a") as f:
+        f.write("20 1 1\n")
+    _touch_later(onsets)
+    converter.convert(source, dest, nii_handling="link")
+    assert not os.path.exists(stale)
+    assert os.path.islink(bold)
+    with open(events) as f:
+        assert len(f.read().splitlines()) == 4
+
+
+def test_move(dataset):
+    source, dest = dataset
+    src_bold = os.path.join(source, "sub001", "BOLD", "task001_run001",
+                            "bold.nii.gz")
+    converter.convert(source, dest, nii_handling="move")
+    bold, events = _outputs(dest)
+    assert not os.path.exists(src_bold)
+    assert os.path.exists(bold) and not os.path.islink(bold)
+
+    # The moved images are gone from the sources: the subject is up to date.
+    mtime = os.stat(events).st_mtime
+    converter.convert(source, dest, nii_handling="move")
+    assert os.stat(events).st_mtime == mtime
+
+    # Changed sources are not converted again: the outputs hold the only
+    # copy of the moved images.
+    _touch_later(os.path.join(source, "sub001", "model", "model001",
+                              "onsets", "task001_run001", "cond001.txt"))
+    warnings = []
+    for force in (False, True):
+        converter.convert(source, dest, nii_handling="move",
+                          warning=warnings.append, force=force)
+        with open(bold) as f:
+            assert f.read() == "bold"
+    assert len([w for w in warnings if "moved" in w]) == 2
+    with pytest.raises(IOError):
+        converter.convert_subject(source, dest, "sub001", "sub-1",
+                                  *converter._dataset_info(source)[1:],
+                                  nii_handling="copy")
+    assert os.path.exists(bold)
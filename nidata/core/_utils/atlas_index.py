@@ -0,0 +1,252 @@
+"""
+Precomputed voxel index of the regions of an atlas
+"""
+# License: simplified BSD
+
+import os
+
+import numpy as np
+
+from .compat import _basestring
+from .niimg import check_niimg
+
+INDEX_VERSION = 2
+
+
+class AtlasIndex(object):
+    """Voxels of every region of an atlas, in a compressed sparse row layout.
+
+    The flat (C order) indices of the voxels of region i are
+    indices[indptr[i]:indptr[i + 1]], sorted. For probabilistic atlases
+    (maps), the voxels are the non-zero voxels of each map, and weights
+    holds their values.
+
+    Attributes
+    ----------
+    labels: numpy.ndarray, shape (n_regions, )
+        Label of each region (index of the map, for maps).
+
+    indptr: numpy.ndarray, shape (n_regions + 1, )
+        Offsets of the regions in indices.
+
+    indices: numpy.ndarray
+        Flat voxel indices of all the regions.
+
+    weights: numpy.ndarray or None
+        Value of the maps at indices, None for label atlases.
+
+    maps: bool
+        Whether the index is that of a probabilistic atlas.
+
+    shape: tuple
+        Shape of the 3D atlas volume.
+
+    affine: numpy.ndarray, shape (4, 4)
+        Affine of the atlas.
+
+    bbox: numpy.ndarray, shape (n_regions, 3, 2)
+        Bounding box of each region, as start and stop voxel coordinates.
+
+    sizes: numpy.ndarray, shape (n_regions, )
+        Number of voxels of each region.
+
+    volumes: numpy.ndarray, shape (n_regions, )
+        Volume of each region in mm^3.
+
+    centroids: numpy.ndarray, shape (n_regions, 3)
+        Center of mass of each region in world coordinates (weighted by the
+        absolute value of the maps, for maps).
+    """
+    _arrays = ('labels', 'indptr', 'indices', 'weights', 'shape', 'affine',
+               'bbox', 'sizes', 'volumes', 'centroids')
+
+    def __init__(self, labels, indptr, indices, shape, affine, weights=None):
+        self.maps = weights is not None
+        self.labels = np.asarray(labels)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices)
+        self.weights = weights
+        self.shape = tuple(int(s) for s in shape)
+        self.affine = np.asarray(affine)
+
+        self.sizes = np.diff(self.indptr)
+        voxel_volume = abs(np.linalg.det(self.affine[:3, :3]))
+        self.volumes = self.sizes * voxel_volume
+
+        n_regions = len(self.labels)
+        self.bbox = np.zeros((n_regions, 3, 2), dtype=np.int64)
+        self.centroids = np.zeros((n_regions, 3))
+        nonempty = self.sizes > 0
+        if len(self.indices) == 0:
+            return
+        coords = np.array(np.unravel_index(self.indices, self.shape))
+        starts = self.indptr[:-1][nonempty]
+        self.bbox[nonempty, :, 0] = np.minimum.reduceat(coords, starts,
+                                                        axis=1).T
+        self.bbox[nonempty, :, 1] = np.maximum.reduceat(coords, starts,
+                                                        axis=1).T + 1
+        if self.weights is None:
+            weights = np.ones(len(self.indices))
+        else:
+            weights = np.abs(self.weights)
+        totals = np.add.reduceat(weights, starts)
+        totals[totals == 0] = 1
+        centers = np.add.reduceat(coords * weights, starts, axis=1) / totals
+        self.centroids[nonempty] = np.dot(self.affine[:3, :3],
+                                          centers).T + self.affine[:3, 3]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def region(self, i):
+        """Return the flat voxel indices of the i-th region."""
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    @classmethod
+    def from_img(cls, atlas_img, maps=False, volume=None):
+        """Build the index of an atlas.
+
+        Parameters
+        ----------
+        atlas_img: niimg
+            Label image (3D), or 4D image of maps if maps is True.
+
+        maps: bool, optional
+            If True, regions are the volumes of a 4D probabilistic atlas.
+
+        volume: int, optional
+            For 4D label images (e.g. parcellations at several scales), the
+            index of the volume to use.
+        """
+        atlas_img = check_niimg(atlas_img)
+        data = atlas_img.get_data()
+        if volume is not None:
+            data = data[..., volume]
+        while data.ndim > 3 and data.shape[-1] == 1 and not maps:
+            data = data[..., 0]
+        if data.ndim != (4 if maps else 3):
+            raise ValueError(
+                'A %dD image of %s is required, got shape %s%s.' % (
+                    4 if maps else 3, 'maps' if maps else 'labels',
+                    data.shape, '' if maps else
+                    ': select a volume of 4D label atlases with volume'))
+
+        if maps:
+            shape = data.shape[:3]
+            indices, weights, indptr = [], [], [0]
+            for i in range(data.shape[3]):
+                flat = np.asarray(data[..., i]).ravel()
+                nonzero = np.flatnonzero(flat)
+                indices.append(nonzero)
+                weights.append(flat[nonzero].astype(np.float32))
+                indptr.append(indptr[-1] + len(nonzero))
+            return cls(np.arange(data.shape[3]), indptr,
+                       np.concatenate(indices), shape,
+                       atlas_img.get_affine(),
+                       weights=np.concatenate(weights))
+
+        flat = np.asarray(data).ravel()
+        if flat.dtype.kind not in 'iu':
+            flat = np.round(flat).astype(np.int64)
+        # Assumes that the background label is zero. A stable sort keeps
+        # the voxel indices sorted within each region.
+        indices = np.flatnonzero(flat)
+        indices = indices[np.argsort(flat[indices], kind='mergesort')]
+        labels, starts = np.unique(flat[indices], return_index=True)
+        indptr = np.append(starts, len(indices))
+        if flat.size < 2 ** 31:
+            indices = indices.astype(np.int32)
+        return cls(labels, indptr, indices, data.shape,
+                   atlas_img.get_affine())
+
+    def save(self, filename, source=None):
+        """Store the index in a npz file.
+
+        If source is given, its size and modification time are stored, so
+        that load() can detect that the index is outdated.
+        """
+        arrays = dict((name, getattr(self, name)) for name in self._arrays
+                      if getattr(self, name) is not None)
+        arrays['version'] = INDEX_VERSION
+        arrays['maps'] = self.maps
+        if source is not None:
+            stat = os.stat(source)
+            arrays['source_stat'] = (stat.st_size, stat.st_mtime)
+        with open(filename, 'wb') as fp:
+            np.savez(fp, **arrays)
+
+    @classmethod
+    def load(cls, filename, source=None, maps=None):
+        """Load an index stored by save(), or None if it is outdated (or
+        not of the requested kind, if maps is given)."""
+        with np.load(filename) as npz:
+            if npz['version'] != INDEX_VERSION:
+                return None
+            if maps is not None and bool(npz['maps']) != maps:
+                return None
+            if source is not None:
+                stat = os.stat(source)
+                if ('source_stat' not in npz or tuple(npz['source_stat'])
+                        != (stat.st_size, stat.st_mtime)):
+                    return None
+            index = cls.__new__(cls)
+            for name in cls._arrays:
+                setattr(index, name, npz[name] if name in npz else None)
+            index.maps = bool(npz['maps'])
+        index.shape = tuple(int(s) for s in index.shape)
+        return index
+
+
+def index_filename(atlas_file, maps=False, volume=None):
+    """Return the path of the index stored alongside an atlas file."""
+    base = atlas_file
+    for ext in ('.gz', '.nii', '.img', '.hdr', '.mgz', '.mgh'):
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+    if maps:
+        base += '_maps'
+    if volume is not None:
+        base += '_%d' % volume
+    return base + '.index.npz'
+
+
+def get_atlas_index(atlas_file, maps=False, volume=None, force=False):
+    """Load the index of an atlas file, building it on first use.
+
+    The index is stored alongside the atlas file (see index_filename) and
+    rebuilt when the atlas file changes. If the atlas directory is not
+    writeable, the index is built but not stored.
+
+    Parameters
+    ----------
+    atlas_file: string
+        Path of the atlas image.
+
+    maps, volume:
+        See AtlasIndex.from_img.
+
+    force: bool, optional
+        If True, rebuild the index.
+
+    Returns
+    -------
+    index: AtlasIndex
+    """
+    if not isinstance(atlas_file, _basestring):
+        raise TypeError('An atlas file path is required, got %r'
+                        % (atlas_file, ))
+    filename = index_filename(atlas_file, maps=maps, volume=volume)
+    if not force and os.path.exists(filename):
+        try:
+            index = AtlasIndex.load(filename, source=atlas_file, maps=maps)
+        except (IOError, OSError, ValueError, KeyError):
+            index = None
+        if index is not None:
+            return index
+
+    index = AtlasIndex.from_img(atlas_file, maps=maps, volume=volume)
+    try:
+        index.save(filename, source=atlas_file)
+    except (IOError, OSError):
+        pass
+    return index
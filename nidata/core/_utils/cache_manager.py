@@ -0,0 +1,526 @@
+"""
+Bounded management of joblib cache directories, and in-memory cache tier
+"""
+# License: simplified BSD
+
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+from sklearn.externals.joblib import hash as joblib_hash
+
+from .compat import _basestring
+
+CONFIG_FILE = 'nidata_cache.json'
+ACCESS_FILE = 'nidata_access.json'
+POLICIES = ('lru', 'lfu')
+
+CacheEntry = namedtuple('CacheEntry',
+                        ['func_id', 'path', 'size', 'last_access', 'hits'])
+
+__managers = dict()
+
+
+def _func_dir(memorized_func):
+    """ Return the directory where joblib stores the outputs of a function.
+    """
+    if hasattr(memorized_func, 'store_backend'):  # joblib >= 0.12
+        return os.path.join(memorized_func.store_backend.location,
+                            memorized_func.func_id)
+    return memorized_func._get_func_dir(mkdir=False)
+
+
+def _result_dir(result):
+    """ Return the directory where joblib stores a MemorizedResult. """
+    if hasattr(result, 'store_backend'):  # joblib >= 0.12
+        return os.path.join(result.store_backend.location, result.func_id,
+                            result.args_id)
+    return result._output_dir
+
+
+def _is_entry(path):
+    return os.path.exists(os.path.join(path, 'output.pkl'))
+
+
+def _entry_size(path):
+    size = 0
+    for filename in os.listdir(path):
+        try:
+            size += os.path.getsize(os.path.join(path, filename))
+        except OSError:
+            pass
+    return size
+
+
+def _remove_dir(path):
+    # We use rename + unlink to be more robust to race conditions
+    tmp_dir = '%s.old_%i' % (path, os.getpid())
+    try:
+        os.rename(path, tmp_dir)
+        shutil.rmtree(tmp_dir)
+    except OSError:
+        # Another process could have removed this dir
+        pass
+
+
+def parse_size(size):
+    """ Convert a size such as 500M or 2G (powers of 1024) to bytes. """
+    if size is None or not isinstance(size, _basestring):
+        return size
+    units = dict(k=1, m=2, g=3, t=4)
+    size = size.strip().lower().rstrip('b')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * 1024 ** units[size[-1]])
+    return int(size)
+
+
+def parse_age(age):
+    """ Convert an age such as 90s, 30m, 12h or 7d to seconds. """
+    if age is None or not isinstance(age, _basestring):
+        return age
+    units = dict(s=1, m=60, h=3600, d=86400, w=604800)
+    age = age.strip().lower()
+    if age and age[-1] in units:
+        return float(age[:-1]) * units[age[-1]]
+    return float(age)
+
+
+class CacheManager(object):
+    """ Keep the size of a joblib cache directory bounded.
+
+    Cached results are evicted when they are older than max_age, when the
+    results of a function exceed its quota, and when the whole cache
+    exceeds max_bytes. Within these budgets, results are evicted least
+    recently used first ('lru' policy) or least frequently used first
+    ('lfu' policy, ties broken by recency).
+
+    Parameters
+    ----------
+    cachedir: string
+        Directory given to joblib.Memory (or its 'joblib' subdirectory).
+
+    max_bytes: int or string, optional
+        Byte budget of the whole cache, e.g. 10G.
+
+    max_age: float or string, optional
+        Results not accessed for this long (seconds, or e.g. 7d) are evicted.
+
+    policy: 'lru' or 'lfu', optional
+        Eviction order.
+
+    quotas: dict, optional
+        Byte budgets of single functions, keyed by function name or by
+        joblib function identifier (e.g. 'nidata/core/_utils/niimg/func').
+    """
+    def __init__(self, cachedir, max_bytes=None, max_age=None, policy='lru',
+                 quotas=None):
+        if policy not in POLICIES:
+            raise ValueError("policy must be one of %s, got %r"
+                             % (POLICIES, policy))
+        if os.path.basename(os.path.normpath(cachedir)) == 'joblib':
+            cachedir = os.path.dirname(os.path.normpath(cachedir))
+        self.cachedir = cachedir
+        self.max_bytes = parse_size(max_bytes)
+        self.max_age = parse_age(max_age)
+        self.policy = policy
+        self.quotas = dict((k, parse_size(v))
+                           for k, v in (quotas or {}).items())
+        # Estimated bytes per function, to prune only when needed
+        self._sizes = None
+        self._last_prune = 0
+
+    @property
+    def root(self):
+        """ Directory holding the function directories of joblib. """
+        return os.path.join(self.cachedir, 'joblib')
+
+    @classmethod
+    def from_config(cls, cachedir):
+        """ Load the manager configured in cachedir, or None. """
+        cachedir = cls(cachedir).cachedir
+        config_file = os.path.join(cachedir, CONFIG_FILE)
+        if not os.path.exists(config_file):
+            return None
+        with open(config_file, 'r') as fp:
+            config = json.load(fp)
+        return cls(cachedir, **config)
+
+    def save_config(self):
+        """ Store the budgets in cachedir, where from_config finds them. """
+        config = dict(max_bytes=self.max_bytes, max_age=self.max_age,
+                      policy=self.policy, quotas=self.quotas)
+        if not os.path.exists(self.cachedir):
+            os.makedirs(self.cachedir)
+        with open(os.path.join(self.cachedir, CONFIG_FILE), 'w') as fp:
+            json.dump(config, fp, indent=2)
+
+    @property
+    def bounded(self):
+        return bool(self.max_bytes is not None or self.max_age is not None
+                    or self.quotas)
+
+    def entries(self):
+        """ List the cached results, as CacheEntry tuples. """
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if 'output.pkl' not in filenames:
+                continue
+            del dirnames[:]  # joblib does not nest results
+            size = _entry_size(dirpath)
+            hits, last_access = self._read_access(dirpath)
+            entries.append(CacheEntry(
+                func_id=os.path.relpath(os.path.dirname(dirpath), self.root),
+                path=dirpath, size=size, last_access=last_access, hits=hits))
+        return entries
+
+    def stats(self):
+        """ Summarize the cache per function.
+
+        Returns
+        -------
+        stats: dict
+            Maps function identifiers to dicts with the number of entries,
+            bytes, hits and last access of their results. The key None holds
+            the totals.
+        """
+        stats = dict()
+        for entry in self.entries():
+            for key in (entry.func_id, None):
+                func_stats = stats.setdefault(
+                    key, dict(entries=0, bytes=0, hits=0, last_access=0))
+                func_stats['entries'] += 1
+                func_stats['bytes'] += entry.size
+                func_stats['hits'] += entry.hits
+                func_stats['last_access'] = max(func_stats['last_access'],
+                                                entry.last_access)
+        stats.setdefault(None, dict(entries=0, bytes=0, hits=0,
+                                    last_access=0))
+        return stats
+
+    def _quota(self, func_id):
+        quota = self.quotas.get(func_id)
+        if quota is None:
+            quota = self.quotas.get(os.path.basename(func_id))
+        return quota
+
+    def _eviction_key(self, entry):
+        if self.policy == 'lfu':
+            return (entry.hits, entry.last_access)
+        return entry.last_access
+
+    def prune(self, dry_run=False):
+        """ Evict results until the cache fits in its budgets.
+
+        Returns
+        -------
+        evicted: list of CacheEntry
+            The evicted results.
+        """
+        entries = sorted(self.entries(), key=self._eviction_key)
+        if self.max_age is not None:
+            oldest = time.time() - self.max_age
+            evicted = [e for e in entries if e.last_access < oldest]
+            entries = [e for e in entries if e.last_access >= oldest]
+        else:
+            evicted = []
+
+        kept = []
+        by_func = dict()
+        for entry in entries:
+            by_func.setdefault(entry.func_id, []).append(entry)
+        for func_id, func_entries in by_func.items():
+            quota = self._quota(func_id)
+            excess = 0
+            if quota is not None:
+                excess = sum(e.size for e in func_entries) - quota
+            for entry in func_entries:
+                if excess > 0:
+                    evicted.append(entry)
+                    excess -= entry.size
+                else:
+                    kept.append(entry)
+
+        kept.sort(key=self._eviction_key)
+        total = sum(e.size for e in kept)
+        if self.max_bytes is not None:
+            while kept and total > self.max_bytes:
+                entry = kept.pop(0)
+                evicted.append(entry)
+                total -= entry.size
+
+        if not dry_run:
+            for entry in evicted:
+                _remove_dir(entry.path)
+            self._sizes = dict()
+            for entry in kept:
+                self._sizes[entry.func_id] = (self._sizes.get(entry.func_id, 0)
+                                              + entry.size)
+            self._last_prune = time.time()
+        return evicted
+
+    def _read_access(self, path):
+        access_file = os.path.join(path, ACCESS_FILE)
+        try:
+            with open(access_file, 'r') as fp:
+                hits = json.load(fp)['hits']
+            return hits, os.path.getmtime(access_file)
+        except (IOError, OSError, ValueError, KeyError):
+            try:
+                return 0, os.path.getmtime(os.path.join(path, 'output.pkl'))
+            except OSError:
+                return 0, 0
+
+    def record_access(self, path, hit):
+        """ Count an access to the result stored in path, and prune the
+            cache if storing this result made it exceed a budget.
+        """
+        if not _is_entry(path):
+            return
+        hits = self._read_access(path)[0] + 1 if hit else 0
+        try:
+            with open(os.path.join(path, ACCESS_FILE), 'w') as fp:
+                json.dump(dict(hits=hits), fp)
+        except (IOError, OSError):
+            # Another process could have evicted this result
+            return
+        if hit or not self.bounded:
+            return
+
+        func_id = os.path.relpath(os.path.dirname(path), self.root)
+        if self._sizes is None:
+            self._sizes = dict()
+            for entry in self.entries():
+                self._sizes[entry.func_id] = (self._sizes.get(entry.func_id, 0)
+                                              + entry.size)
+        else:
+            self._sizes[func_id] = (self._sizes.get(func_id, 0)
+                                    + _entry_size(path))
+        quota = self._quota(func_id)
+        if ((self.max_bytes is not None
+                and sum(self._sizes.values()) > self.max_bytes)
+                or (quota is not None and self._sizes[func_id] > quota)
+                or (self.max_age is not None
+                    and time.time() - self._last_prune > self.max_age / 10.)):
+            self.prune()
+
+
+def get_cache_manager(cachedir):
+    """ Return the CacheManager configured in cachedir, or None.
+
+    Managers are shared within the process; the configuration is read again
+    when its file changes (e.g. after 'nidata cache prune --save').
+    """
+    if cachedir is None:
+        return None
+    config_file = os.path.join(CacheManager(cachedir).cachedir, CONFIG_FILE)
+    try:
+        mtime = os.path.getmtime(config_file)
+    except OSError:
+        mtime = None
+    if cachedir not in __managers or __managers[cachedir][0] != mtime:
+        __managers[cachedir] = (mtime, CacheManager.from_config(cachedir))
+    return __managers[cachedir][1]
+
+
+class ManagedFunc(object):
+    """ Callable wrapping a joblib.MemorizedFunc, that records the accesses
+        to cached results and prunes the cache after new results are
+        stored.
+
+    Other attributes are looked up on the wrapped MemorizedFunc.
+    """
+    def __init__(self, memorized_func, manager):
+        self.memorized_func = memorized_func
+        self.manager = manager
+
+    def __call__(self, *args, **kwargs):
+        return self.call_and_locate(*args, **kwargs)[0]
+
+    def call_and_locate(self, *args, **kwargs):
+        """ Return the output of a call and the directory of its result.
+
+        joblib hashes the arguments once, and tells where it stored the
+        result. Results get an access file when first stored through a
+        manager: results without one were computed by this call.
+        """
+        result = self.memorized_func.call_and_shelve(*args, **kwargs)
+        path = _result_dir(result)
+        hit = os.path.exists(os.path.join(path, ACCESS_FILE))
+        output = result.get()
+        self.manager.record_access(path, hit)
+        return output, path
+
+    def __getattr__(self, name):
+        memorized_func = self.__dict__.get('memorized_func')
+        if memorized_func is None:  # e.g. while unpickling
+            raise AttributeError(name)
+        return getattr(memorized_func, name)
+
+
+def _nbytes(obj):
+    """ Estimate the memory held by a cached result. """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(_nbytes(o) for o in obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(_nbytes(k) + _nbytes(v)
+                                        for k, v in obj.items())
+    dataobj = getattr(obj, 'dataobj', None)  # nibabel images
+    if isinstance(dataobj, np.ndarray):
+        return dataobj.nbytes + sys.getsizeof(obj)
+    return sys.getsizeof(obj)
+
+
+_PLAIN_TYPES = (type(None), bool, int, float, complex, _basestring, bytes)
+if sys.version_info[0] < 3:
+    _PLAIN_TYPES += (long, )  # noqa
+
+
+def _plain_key(obj):
+    """ Return obj as a hashable key if it is made of immutable values
+        (objects can provide theirs with a tier_key method), else None.
+    """
+    if isinstance(obj, _PLAIN_TYPES):
+        # 1, 1.0 and True are equal, but not the same argument
+        return (obj.__class__.__name__, obj)
+    if isinstance(obj, (list, tuple)):
+        key = tuple(_plain_key(o) for o in obj)
+        if None in key:
+            return None
+        return (obj.__class__.__name__, ) + key
+    tier_key = getattr(obj, 'tier_key', None)
+    if tier_key is not None:
+        return ('tier_key', tier_key())
+    return None
+
+
+def _call_key(args, kwargs):
+    """ Key of a call in a MemoryTier.
+
+    Calls with plain arguments (numbers, strings, fingerprints of niimgs,
+    and tuples of them) are keyed on the arguments themselves, which is
+    much cheaper than hashing them; other calls on the joblib hash of their
+    arguments.
+    """
+    call = (tuple(args), tuple(sorted(kwargs.items())))
+    key = _plain_key(call)
+    if key is None:
+        key = joblib_hash(call)
+    return key
+
+
+def _read_only(obj):
+    if isinstance(obj, np.ndarray):
+        obj.flags.writeable = False
+    elif isinstance(obj, (list, tuple)):
+        for o in obj:
+            _read_only(o)
+    return obj
+
+
+class MemoryTier(object):
+    """ In-process store of cached results, bounded in bytes and evicting
+        the least recently used results first.
+
+    A tier can be shared by several cached functions (see cache()), which
+    then share its budget. Results are shared by all the callers getting
+    them from the tier: numpy arrays are made read-only to protect them.
+
+    Parameters
+    ----------
+    max_bytes: int or string
+        Budget of the tier, e.g. 200M.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = parse_size(max_bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._store = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Worker processes start with an empty tier
+        return dict(max_bytes=self.max_bytes)
+
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'])
+
+    def __len__(self):
+        return len(self._store)
+
+    def get(self, key):
+        """ Return (True, result) if key is in the tier, else (False, None).
+        """
+        with self._lock:
+            if key not in self._store:
+                self.misses += 1
+                return False, None
+            value, size = self._store.pop(key)
+            self._store[key] = (value, size)
+            self.hits += 1
+            return True, value
+
+    def put(self, key, value):
+        """ Store a result, evicting the least recently used ones. """
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._store:
+                self.nbytes -= self._store.pop(key)[1]
+            self._store[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self._store.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._store.clear()
+            self.nbytes = 0
+
+
+class MemoryTierFunc(object):
+    """ Callable wrapping a joblib.MemorizedFunc, that returns results held
+        in a MemoryTier without reading the disk cache. Results computed or
+        read from disk are stored in the tier (write-through: the disk
+        cache is always written).
+
+    Hits are recorded by the CacheManager of a wrapped ManagedFunc, so that
+    results hot in the tier are not evicted from the disk.
+
+    Other attributes are looked up on the wrapped MemorizedFunc.
+    """
+    def __init__(self, memorized_func, tier):
+        self.memorized_func = memorized_func
+        self.tier = tier
+        self.func_dir = _func_dir(memorized_func)
+
+    def __call__(self, *args, **kwargs):
+        key = (self.func_dir, _call_key(args, kwargs))
+        found, stored = self.tier.get(key)
+        if found:
+            output, path = stored
+            if path is not None:
+                self.memorized_func.manager.record_access(path, True)
+            return output
+        if isinstance(self.memorized_func, ManagedFunc):
+            output, path = self.memorized_func.call_and_locate(
+                *args, **kwargs)
+        else:
+            output, path = self.memorized_func(*args, **kwargs), None
+        output = _read_only(output)
+        self.tier.put(key, (output, path))
+        return output
+
+    def __getattr__(self, name):
+        memorized_func = self.__dict__.get('memorized_func')
+        if memorized_func is None:  # e.g. while unpickling
+            raise AttributeError(name)
+        return getattr(memorized_func, name)
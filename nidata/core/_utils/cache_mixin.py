@@ -4,6 +4,9 @@ Mixin for cache with joblib
 # Author: Gael Varoquaux, Alexandre Abraham, Philippe Gervais
 # License: simplified BSD
 
+import functools
+import hashlib
+import inspect
 import json
 import warnings
 import os
@@ -21,10 +24,164 @@ try:
 except ImportError:
     pass
 
+from .cache_manager import ManagedFunc, MemoryTierFunc, get_cache_manager
 from .compat import _basestring
 
 __cache_checked = dict()
 
+NIIMG_EXTENSIONS = ('.nii', '.nii.gz', '.img', '.hdr', '.mgh', '.mgz')
+
+
+def niimg_fingerprint(niimg, checksums=None):
+    """ Return a cheap key identifying the content of a niimg file.
+
+    The key is made of the file path, size, modification time and a digest
+    of the image header, so that the voxel data is never read. If the file
+    has a known content checksum (e.g. from a download manifest read with
+    readmd5_sum_file), the key is the checksum and size instead, which
+    remains valid if the file is moved or touched.
+
+    Parameters
+    ----------
+    niimg: string or nibabel SpatialImage
+        Path to an image, or image loaded from a file.
+
+    checksums: dict, optional
+        Mapping from file paths (absolute, or as given) to content checksums.
+
+    Returns
+    -------
+    fingerprint: tuple or None
+        None if niimg is not backed by a file, or if its data may have been
+        modified in memory. Such images must be hashed on their content.
+    """
+    header = None
+    if isinstance(niimg, _basestring):
+        filename = niimg
+    elif isinstance(niimg, nibabel.spatialimages.SpatialImage):
+        if (getattr(niimg, '_data_cache', None) is not None
+                or getattr(niimg, '_fdata_cache', None) is not None):
+            # Data may have been modified since it was loaded.
+            return None
+        filename = niimg.get_filename()
+        header = niimg.get_header()
+    else:
+        return None
+    if filename is None or not os.path.isfile(filename):
+        return None
+
+    stat = os.stat(filename)
+    path = os.path.abspath(filename)
+    if checksums:
+        checksum = checksums.get(path, checksums.get(filename))
+        if checksum is not None:
+            return ('checksum', checksum, stat.st_size)
+
+    if header is None:
+        header = nibabel.load(filename).get_header()
+    return (path, stat.st_size, stat.st_mtime,
+            hashlib.md5(header.binaryblock).hexdigest())
+
+
+class _Fingerprinted(object):
+    """ Stand-in for a niimg argument of a cached function.
+
+    joblib hashes arguments by pickling them: this object pickles as its
+    fingerprint only, which makes hashing it O(1).
+    """
+    def __init__(self, niimg, fingerprint):
+        self.niimg = niimg
+        self.fingerprint = fingerprint
+
+    def __reduce__(self):
+        return (_Fingerprinted, (None, self.fingerprint))
+
+    def __repr__(self):
+        return 'Fingerprinted(%r)' % (self.fingerprint, )
+
+    def tier_key(self):
+        """ Key of this argument in a MemoryTier (see cache_manager). """
+        return self.fingerprint
+
+
+def _fingerprint_arg(arg, checksums):
+    if isinstance(arg, (list, tuple)):
+        return arg.__class__(_fingerprint_arg(a, checksums) for a in arg)
+    if (isinstance(arg, _basestring)
+            and not arg.lower().endswith(NIIMG_EXTENSIONS)):
+        return arg
+    fingerprint = niimg_fingerprint(arg, checksums=checksums)
+    if fingerprint is None:
+        return arg
+    return _Fingerprinted(arg, fingerprint)
+
+
+def _unfingerprint_arg(arg):
+    if isinstance(arg, _Fingerprinted):
+        return arg.niimg
+    if isinstance(arg, (list, tuple)):
+        return arg.__class__(_unfingerprint_arg(a) for a in arg)
+    return arg
+
+
+class _Unfingerprinting(object):
+    """ Wrapper of a cached function, passing it the niimgs behind
+        fingerprints.
+
+    The wrapper looks like func to joblib (same name, module and code) so
+    that the cache location and invalidation are those of func.
+    """
+    def __init__(self, func):
+        # Not named 'func': joblib copies our __dict__ on its MemorizedFunc
+        self.unfingerprinted_func = func
+        functools.update_wrapper(self, func)
+
+    @property
+    def __code__(self):
+        return self.unfingerprinted_func.__code__
+
+    def __call__(self, *args, **kwargs):
+        args = [_unfingerprint_arg(arg) for arg in args]
+        kwargs = dict((k, _unfingerprint_arg(v)) for k, v in kwargs.items())
+        return self.unfingerprinted_func(*args, **kwargs)
+
+    def __reduce__(self):
+        return (_Unfingerprinting, (self.unfingerprinted_func, ))
+
+
+class FingerprintedFunc(object):
+    """ Callable wrapping a joblib.MemorizedFunc, that replaces niimg
+        arguments (paths or images loaded from files, and lists of them)
+        by their fingerprint before the cache lookup.
+
+    joblib cannot inspect the signature of the wrapped function: arguments
+    are bound to their names here, and those in ignore are hashed as a
+    constant. Other attributes are looked up on the wrapped MemorizedFunc.
+    """
+    def __init__(self, memorized_func, func, checksums=None, ignore=None):
+        self.memorized_func = memorized_func
+        self.func = func
+        self.checksums = checksums
+        self.ignore = ignore or []
+
+    def __call__(self, *args, **kwargs):
+        code = getattr(self.func, '__code__', None)
+        if (code is not None and not code.co_flags
+                & (inspect.CO_VARARGS | inspect.CO_VARKEYWORDS)):
+            kwargs = inspect.getcallargs(self.func, *args, **kwargs)
+            args = ()
+        args = [_fingerprint_arg(arg, self.checksums) for arg in args]
+        kwargs = dict((k, _Fingerprinted(v, 'ignored') if k in self.ignore
+                       else _fingerprint_arg(v, self.checksums))
+                      for k, v in kwargs.items())
+        return self.memorized_func(*args, **kwargs)
+
+    def __getattr__(self, name):
+        memorized_func = self.__dict__.get('memorized_func')
+        if memorized_func is None:  # e.g. while unpickling
+            raise AttributeError(name)
+        return getattr(memorized_func, name)
+
 
 def _safe_cache(memory, func, **kwargs):
     """ A wrapper for mem.cache that flushes the cache if the version
@@ -85,7 +242,8 @@ def _safe_cache(memory, func, **kwargs):
 
 
 def cache(func, memory, func_memory_level=None, memory_level=None,
-          **kwargs):
+          fingerprint_niimgs=False, checksums=None, cache_manager=None,
+          memory_tier=None, **kwargs):
     """ Return a joblib.Memory object.
 
     The memory_level determines the level above which the wrapped
@@ -111,6 +269,23 @@ def cache(func, memory, func_memory_level=None, memory_level=None,
         be cached or not (if user_memory_level is equal of grater than
         func_memory_level the function is cached)
 
+    fingerprint_niimgs: boolean, optional
+        If True, niimg arguments backed by files are identified in the cache
+        by their fingerprint (see niimg_fingerprint) instead of their content,
+        which avoids hashing large images on every call.
+
+    checksums: dict, optional
+        Known content checksums of niimg files, see niimg_fingerprint.
+
+    cache_manager: CacheManager, optional
+        Keeps the cache within its budgets. Defaults to the manager
+        configured in the cache directory, if any (see
+        CacheManager.save_config).
+
+    memory_tier: MemoryTier, optional
+        In-process tier in front of the disk cache, returning hot results
+        without reading them from disk.
+
     kwargs: keyword arguments
         The keyword arguments passed to memory.cache
 
@@ -144,7 +319,24 @@ def cache(func, memory, func_memory_level=None, memory_level=None,
                           "function %s." %
                           (memory_level, func.__name__),
                           stacklevel=2)
-    return _safe_cache(memory, func, **kwargs)
+    if memory.cachedir is None:
+        return _safe_cache(memory, func, **kwargs)
+
+    if fingerprint_niimgs:
+        ignore = kwargs.pop('ignore', None)
+        mem = _safe_cache(memory, _Unfingerprinting(func), **kwargs)
+    else:
+        mem = _safe_cache(memory, func, **kwargs)
+    if cache_manager is None:
+        cache_manager = get_cache_manager(memory.cachedir)
+    if cache_manager is not None and cache_manager.bounded:
+        mem = ManagedFunc(mem, cache_manager)
+    if memory_tier is not None:
+        mem = MemoryTierFunc(mem, memory_tier)
+    if fingerprint_niimgs:
+        mem = FingerprintedFunc(mem, func, checksums=checksums,
+                                ignore=ignore)
+    return mem
 
 
 class CacheMixin(object):
@@ -157,6 +349,12 @@ class CacheMixin(object):
     defined by this class. Caching is performed only if the user-specified
     cache level (self._memory_level) is greater than the value given as a
     parameter to self._cache(). See _cache() documentation for details.
+
+    Setting self.fingerprint_niimgs to True identifies niimg arguments by
+    their file fingerprint rather than their content (see cache()), and
+    self.checksums can hold known content checksums of these files.
+    self.cache_manager can hold a CacheManager bounding the cache size, and
+    self.memory_tier a MemoryTier keeping hot results in memory.
     """
 
     def _cache(self, func, func_memory_level=1, **kwargs):
@@ -207,5 +405,11 @@ class CacheMixin(object):
                               "Setting memory_level to 1.")
                 self.memory_level = 1
 
+        kwargs.setdefault('fingerprint_niimgs',
+                          getattr(self, 'fingerprint_niimgs', False))
+        kwargs.setdefault('checksums', getattr(self, 'checksums', None))
+        kwargs.setdefault('cache_manager',
+                          getattr(self, 'cache_manager', None))
+        kwargs.setdefault('memory_tier', getattr(self, 'memory_tier', None))
         return cache(func, self.memory, func_memory_level=func_memory_level,
                      memory_level=self.memory_level, **kwargs)
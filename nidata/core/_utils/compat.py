@@ -4,6 +4,11 @@ Compatibility layer for Python 3/Python 2 single codebase
 import sys
 import hashlib
 
+import numpy as np
+
+# np.in1d was removed from numpy 2.4, in favor of np.isin (numpy >= 1.13).
+in1d = getattr(np, 'in1d', None) or np.isin
+
 
 if sys.version_info[0] == 3:
     import pickle
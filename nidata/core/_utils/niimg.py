@@ -12,7 +12,8 @@ from distutils.version import LooseVersion
 import numpy as np
 import itertools
 import nibabel
-from sklearn.externals.joblib import Memory
+from scipy import linalg, ndimage
+from sklearn.externals.joblib import Memory, Parallel, delayed, cpu_count
 
 from .cache_mixin import cache
 from .compat import _basestring
@@ -177,10 +178,79 @@ def _index_img(img, index):
         copy_header=True)
 
 
+def _resampling_transform(source_affine, target_affine):
+    """ Return the (matrix, offset) pair mapping target voxel coordinates to
+        source voxel coordinates, as expected by ndimage.affine_transform.
+    """
+    transform = np.dot(linalg.inv(source_affine), target_affine)
+    matrix, offset = transform[:3, :3], transform[:3, 3]
+    if np.all(matrix == np.diag(np.diag(matrix))):
+        # affine_transform is much faster with the diagonal only
+        matrix = np.diag(matrix)
+    return matrix, offset
+
+
+def _resample_niimg(niimg, target_affine, target_shape, transform,
+                    interpolation='continuous'):
+    """ Resample niimg to the target field of view using a precomputed
+        transform (see _resampling_transform).
+    """
+    if interpolation == 'continuous':
+        order = 3
+    elif interpolation == 'nearest':
+        order = 0
+    else:
+        raise ValueError("interpolation must be either 'continuous' "
+                         "or 'nearest'")
+    niimg = check_niimg(niimg)
+    data = _safe_get_data(niimg)
+    matrix, offset = transform
+
+    out_dtype = data.dtype
+    if order != 0 and data.dtype.kind != 'f':
+        out_dtype = np.float64
+    other_shape = data.shape[3:]
+    resampled = np.empty(tuple(target_shape) + other_shape,
+                         order='F', dtype=out_dtype)
+    data = data.reshape(data.shape[:3] + (-1, ), order='F')
+    resampled_view = resampled.reshape(tuple(target_shape) + (-1, ),
+                                       order='F')
+    for i in range(data.shape[3]):
+        ndimage.affine_transform(data[..., i], matrix, offset=offset,
+                                 output_shape=tuple(target_shape),
+                                 output=resampled_view[..., i], order=order)
+    return new_img_like(niimg, resampled, target_affine)
+
+
+def _resample_niimgs(niimgs, target_fov, transforms, interpolation='continuous',
+                     memory=Memory(cachedir=None), memory_level=0, n_jobs=1):
+    """ Resample a block of niimgs to target_fov, in parallel.
+
+    transforms is a dictionary used to share resampling transforms between
+    calls: the transform of a given (source affine, target fov) pair is only
+    computed once.
+    """
+    target_affine, target_shape = target_fov
+    resample = cache(_resample_niimg, memory, func_memory_level=2,
+                     memory_level=memory_level, fingerprint_niimgs=True)
+    jobs = []
+    for niimg in niimgs:
+        affine = np.asarray(niimg.get_affine())
+        key = affine.tobytes()
+        if key not in transforms:
+            transforms[key] = _resampling_transform(affine, target_affine)
+        jobs.append((niimg, target_affine, target_shape, transforms[key],
+                     interpolation))
+
+    if n_jobs == 1 or len(jobs) < 2:
+        return [resample(*job) for job in jobs]
+    return Parallel(n_jobs=n_jobs)(delayed(resample)(*job) for job in jobs)
+
+
 def _iter_check_niimg(niimgs, ensure_ndim=None, atleast_4d=False,
                       target_fov=None,
                       memory=Memory(cachedir=None),
-                      memory_level=0, verbose=0):
+                      memory_level=0, n_jobs=1, verbose=0):
     """Iterate over a list of niimgs and do sanity checks and resampling
 
     Parameters
@@ -198,12 +268,30 @@ def _iter_check_niimg(niimgs, ensure_ndim=None, atleast_4d=False,
 
     target_fov: tuple of affine and shape
        If specified, images are resampled to this field of view
+
+    n_jobs: integer, optional
+        Number of images resampled in parallel. Images are read ahead by
+        blocks of n_jobs images. -1 means all CPUs.
     """
     ref_fov = None
     resample_to_first_img = False
     ndim_minus_one = ensure_ndim - 1 if ensure_ndim is not None else None
     if target_fov is not None and target_fov != "first":
         ref_fov = target_fov
+    block_size = cpu_count() if n_jobs < 0 else max(n_jobs, 1)
+    transforms = dict()
+    block = []  # list of (niimg, needs resampling)
+
+    def flush(block):
+        to_resample = [niimg for niimg, resample in block if resample]
+        if not to_resample:
+            return [niimg for niimg, _ in block]
+        resampled = iter(_resample_niimgs(
+            to_resample, ref_fov, transforms, memory=memory,
+            memory_level=memory_level, n_jobs=n_jobs))
+        return [next(resampled) if resample else niimg
+                for niimg, resample in block]
+
     for i, niimg in enumerate(niimgs):
         try:
             niimg = check_niimg(
@@ -214,19 +302,9 @@ def _iter_check_niimg(niimgs, ensure_ndim=None, atleast_4d=False,
                     ref_fov = (niimg.get_affine(), niimg.shape[:3])
                     resample_to_first_img = True
 
-            if not _check_fov(niimg, ref_fov[0], ref_fov[1]):
-                if target_fov is not None:
-                    from nilearn import image  # we avoid a circular import
-                    if resample_to_first_img:
-                        warnings.warn('Affine is different across subjects.'
-                                      ' Realignement on first subject '
-                                      'affine forced')
-                    niimg = cache(
-                        image.resample_img, memory, func_memory_level=2,
-                        memory_level=memory_level)(
-                            niimg, target_affine=ref_fov[0],
-                            target_shape=ref_fov[1])
-                else:
+            needs_resampling = not _check_fov(niimg, ref_fov[0], ref_fov[1])
+            if needs_resampling:
+                if target_fov is None:
                     raise ValueError(
                         "Field of view of image #%d is different from "
                         "reference FOV.\n"
@@ -234,7 +312,10 @@ def _iter_check_niimg(niimgs, ensure_ndim=None, atleast_4d=False,
                         "Reference shape:\n%r\nImage shape:\n%r\n"
                         % (i, ref_fov[0], niimg.get_affine(), ref_fov[1],
                            niimg.shape))
-            yield niimg
+                if resample_to_first_img:
+                    warnings.warn('Affine is different across subjects.'
+                                  ' Realignement on first subject '
+                                  'affine forced')
         except TypeError as exc:
             img_name = ''
             if isinstance(niimg, _basestring):
@@ -244,6 +325,15 @@ def _iter_check_niimg(niimgs, ensure_ndim=None, atleast_4d=False,
                          % (i, img_name),) + exc.args)
             raise
 
+        block.append((niimg, needs_resampling))
+        if len(block) >= block_size:
+            for niimg in flush(block):
+                yield niimg
+            block = []
+
+    for niimg in flush(block):
+        yield niimg
+
 
 def check_niimg(niimg, ensure_ndim=None, atleast_4d=False,
                 return_iterator=False):
@@ -379,7 +469,7 @@ def check_niimg_4d(niimg, return_iterator=False):
 
 def concat_niimgs(niimgs, dtype=np.float32, ensure_ndim=None,
                   memory=Memory(cachedir=None), memory_level=0,
-                  auto_resample=False, verbose=0):
+                  auto_resample=False, n_jobs=1, verbose=0):
     """Concatenate a list of 3D/4D niimgs of varying lengths.
 
     The niimgs list can contain niftis/paths to images of varying dimensions
@@ -414,6 +504,10 @@ def concat_niimgs(niimgs, dtype=np.float32, ensure_ndim=None,
         Rough estimator of the amount of memory used by caching. Higher value
         means more memory for caching.
 
+    n_jobs: integer, optional
+        Number of images resampled in parallel when auto_resample is True.
+        -1 means all CPUs.
+
     Returns
     -------
     concatenated: nibabel.Nifti1Image
@@ -453,7 +547,7 @@ def concat_niimgs(niimgs, dtype=np.float32, ensure_ndim=None,
     cur_4d_index = 0
     for index, (size, niimg) in enumerate(zip(lengths, _iter_check_niimg(
             iterator, atleast_4d=True, target_fov=target_fov,
-            memory=memory, memory_level=memory_level))):
+            memory=memory, memory_level=memory_level, n_jobs=n_jobs))):
 
         if verbose > 0:
             if isinstance(niimg, _basestring):
@@ -27,11 +27,12 @@ def _asarray(arr, dtype=None, order=None):
     return ret
 
 
-def as_ndarray(arr, copy=False, dtype=None, order='K'):
+def as_ndarray(arr, copy=False, dtype=None, order='K', allow_memmap=False):
     """Starting with an arbitrary array, convert to numpy.ndarray.
 
     In the case of a memmap array, a copy is automatically made to break the
-    link with the underlying file (whatever the value of the "copy" keyword).
+    link with the underlying file (whatever the value of the "copy" keyword),
+    unless allow_memmap is True.
 
     The purpose of this function is mainly to get rid of memmap objects, but
     it can be used for other purposes. In particular, combining copying and
@@ -70,11 +71,18 @@ def as_ndarray(arr, copy=False, dtype=None, order='K'):
         Valid values are: "C", "F", "A", "K", None.
         default is "K". See ndarray.copy() for more information.
 
+    allow_memmap: bool
+        read-only mode, for callers which do not modify the returned array.
+        If True and arr is a memmap, a view on the mapped file is returned
+        when no conversion is needed (and copy is False), instead of reading
+        the whole file. This view is made read-only.
+
     Returns
     =======
     ret: numpy.ndarray
         Numpy array containing the same data as arr, always of class
-        numpy.ndarray, and with no link to any underlying file.
+        numpy.ndarray, and with no link to any underlying file (unless
+        allow_memmap is True).
     """
     # This function should work on numpy 1.3
     # in this version, astype() and copy() have no "order" keyword.
@@ -87,7 +95,12 @@ def as_ndarray(arr, copy=False, dtype=None, order='K'):
     if order not in ("C", "F", "A", "K", None):
         raise ValueError("Invalid value for 'order': %s" % str(order))
 
-    if isinstance(arr, np.memmap):
+    if isinstance(arr, np.memmap) and allow_memmap and not copy:
+        ret = _asarray(np.asarray(arr), dtype=dtype, order=order)
+        if np.may_share_memory(ret, arr):
+            ret.flags.writeable = False
+
+    elif isinstance(arr, np.memmap):
         if dtype is None:
             if order in ("K", "A", None):
                 ret = np.array(np.asarray(arr), copy=True)
@@ -101,8 +114,8 @@ def as_ndarray(arr, copy=False, dtype=None, order='K'):
                 # First load data from disk without changing order
                 # Changing order while reading through a memmap is incredibly
                 # inefficient.
-                ret = np.array(arr, copy=True)
-                ret = _asarray(arr, dtype=dtype, order=order)
+                ret = _asarray(np.array(arr, copy=True), dtype=dtype,
+                               order=order)
 
     elif isinstance(arr, np.ndarray):
         ret = _asarray(arr, dtype=dtype, order=order)
@@ -0,0 +1,193 @@
+"""
+Extraction of region time series from 4D images, using an atlas index
+"""
+# License: simplified BSD
+
+import os
+
+import nibabel
+import numpy as np
+from scipy import sparse
+from sklearn.externals.joblib import Parallel, delayed
+
+from .atlas_index import AtlasIndex, get_atlas_index
+from .compat import _basestring
+
+
+def region_matrix(index, order='C'):
+    """Return the sparse (n_regions, n_voxels) averaging matrix of an atlas.
+
+    Row i averages the voxels of region i (weighted by the map values, for
+    probabilistic atlases). Columns are flat voxel indices in the given
+    order.
+    """
+    indices = index.indices
+    if order == 'F':
+        indices = np.ravel_multi_index(
+            np.unravel_index(indices, index.shape), index.shape, order='F')
+    if index.weights is None:
+        weights = np.ones(len(indices), dtype=np.float32)
+    else:
+        weights = np.asarray(index.weights, dtype=np.float32)
+    sizes = np.diff(index.indptr)
+    rows = np.repeat(np.arange(len(index)), sizes)
+    totals = np.bincount(rows, weights=np.abs(weights),
+                         minlength=len(index))
+    totals[totals == 0] = 1
+    weights = weights / totals[rows]
+    n_voxels = int(np.prod(index.shape))
+    return sparse.csr_matrix((weights, indices, index.indptr),
+                             shape=(len(index), n_voxels))
+
+
+class _Extractor(object):
+    """Region averaging of voxel blocks, for both memory layouts."""
+    def __init__(self, index):
+        self.index = index
+        self.shape = index.shape
+        self._matrices = dict()
+
+    def _matrix(self, order):
+        # Only the voxels of the atlas are gathered from each block.
+        if order not in self._matrices:
+            matrix = region_matrix(self.index, order=order).tocsc()
+            voxels = np.flatnonzero(np.diff(matrix.indptr))
+            self._matrices[order] = (matrix[:, voxels].tocsr(), voxels)
+        return self._matrices[order]
+
+    def __call__(self, block):
+        """Region means of a (x, y, z, t) block, as a (t, n_regions) array.
+        """
+        order = 'F' if block.flags['F_CONTIGUOUS'] else 'C'
+        matrix, voxels = self._matrix(order)
+        block = block.reshape((-1, block.shape[-1]), order=order)
+        return np.asarray(matrix.dot(block[voxels])).T
+
+
+def _n_scans(img):
+    shape = img.shape
+    return shape[3] if len(shape) > 3 else 1
+
+
+def _check_img(img, index):
+    if isinstance(img, _basestring):
+        img = nibabel.load(img)
+    if tuple(img.shape[:3]) != index.shape:
+        raise ValueError('Image of shape %s does not match the atlas of '
+                         'shape %s; resample it first.'
+                         % (img.shape, index.shape))
+    if not np.allclose(img.get_affine(), index.affine):
+        raise ValueError('Image affine does not match the atlas affine; '
+                         'resample it first.')
+    return img
+
+
+def _img_signals(img, index, chunk_size=64, output_file=None, offset=0,
+                 extractor=None):
+    """Region signals of one image, streamed by chunks of scans."""
+    img = _check_img(img, index)
+    if extractor is None:
+        extractor = _Extractor(index)
+    n_scans = _n_scans(img)
+    if output_file is not None:
+        signals = np.load(output_file, mmap_mode='r+')
+        out = signals[offset:offset + n_scans]
+    else:
+        out = np.empty((n_scans, len(index)), dtype=np.float32)
+
+    dataobj = img.dataobj
+    if len(img.shape) == 3:
+        out[:] = extractor(np.asarray(dataobj)[..., np.newaxis])
+    else:
+        for start in range(0, n_scans, chunk_size):
+            stop = min(start + chunk_size, n_scans)
+            out[start:stop] = extractor(np.asarray(dataobj[..., start:stop]))
+    if output_file is not None:
+        out.flush()
+        return None
+    return out
+
+
+def extract_region_signals(atlas, imgs, output_file=None, chunk_size=64,
+                           n_jobs=1, verbose=0):
+    """Compute the mean time series of the regions of an atlas.
+
+    Each chunk of scans is read once, and averaged over all the regions at
+    once with a sparse matrix product. Images are processed in parallel,
+    one per worker.
+
+    Parameters
+    ----------
+    atlas: AtlasIndex or string
+        Index of the atlas (see AtlasDataset.label_index), or path of a
+        label atlas. Images must be sampled like the atlas.
+
+    imgs: list of niimgs
+        4D images (paths or nibabel images).
+
+    output_file: string, optional
+        Path of a .npy file where the signals of all the images are packed
+        along the first axis. The offset of each image is stored alongside
+        (see load_region_signals). If None, signals are kept in memory.
+
+    chunk_size: int, optional
+        Number of scans read at once.
+
+    n_jobs: int, optional
+        Number of worker processes (-1: as many as CPUs).
+
+    verbose: int, optional
+        Verbosity level.
+
+    Returns
+    -------
+    signals: list of numpy.ndarray
+        (n_scans, n_regions) array of each image; views on the memory-mapped
+        output_file if given.
+    """
+    if isinstance(atlas, AtlasIndex):
+        index = atlas
+    else:
+        index = get_atlas_index(atlas)
+
+    if output_file is None:
+        if n_jobs == 1:
+            extractor = _Extractor(index)
+            return [_img_signals(img, index, chunk_size=chunk_size,
+                                 extractor=extractor) for img in imgs]
+        return Parallel(n_jobs=n_jobs, verbose=verbose)(
+            delayed(_img_signals)(img, index, chunk_size=chunk_size)
+            for img in imgs)
+
+    # Headers are enough to lay out the packed array.
+    imgs = [_check_img(img, index) for img in imgs]
+    offsets = np.cumsum([0] + [_n_scans(img) for img in imgs])
+    signals = np.lib.format.open_memmap(
+        output_file, mode='w+', dtype=np.float32,
+        shape=(int(offsets[-1]), len(index)))
+    del signals
+    np.save(offsets_filename(output_file), offsets)
+    Parallel(n_jobs=n_jobs, verbose=verbose)(
+        delayed(_img_signals)(img, index, chunk_size=chunk_size,
+                              output_file=output_file, offset=offset)
+        for img, offset in zip(imgs, offsets))
+    return load_region_signals(output_file)
+
+
+def offsets_filename(output_file):
+    """Path of the offsets stored alongside packed region signals."""
+    return os.path.splitext(output_file)[0] + '_offsets.npy'
+
+
+def load_region_signals(output_file):
+    """Load the signals packed by extract_region_signals, memory-mapped.
+
+    Returns
+    -------
+    signals: list of numpy.ndarray
+        (n_scans, n_regions) array of each image.
+    """
+    signals = np.load(output_file, mmap_mode='r')
+    offsets = np.load(offsets_filename(output_file))
+    return [signals[start:stop]
+            for start, stop in zip(offsets[:-1], offsets[1:])]
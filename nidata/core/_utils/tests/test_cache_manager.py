@@ -0,0 +1,247 @@
+"""
+Test the bounded management of joblib caches
+"""
+# License: simplified BSD
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from nose import with_setup
+from nose.tools import assert_equal, assert_true, assert_false, assert_raises
+from sklearn.externals.joblib import Memory
+
+from nidata.__main__ import main
+from nidata.core._utils.cache_manager import (ACCESS_FILE, CacheManager,
+                                              ManagedFunc, MemoryTier,
+                                              get_cache_manager)
+from nidata.core._utils.cache_mixin import cache
+from nidata.core._utils.compat import StringIO
+
+tmpdir = None
+
+
+def setup_tmpdir():
+    global tmpdir
+    tmpdir = tempfile.mkdtemp()
+
+
+def teardown_tmpdir():
+    shutil.rmtree(tmpdir)
+
+
+def _zeros(n):
+    return np.zeros(n)
+
+
+def _ones(n):
+    return np.ones(n)
+
+
+def _cached(func, manager, memory_tier=None):
+    memory = Memory(cachedir=manager.cachedir, verbose=0)
+    return cache(func, memory, func_memory_level=1, memory_level=1,
+                 cache_manager=manager, memory_tier=memory_tier)
+
+
+def _counted(n):
+    _counted.calls += 1
+    return np.arange(n)
+
+
+def _set_access(path, hits, age):
+    """ Pretend the result in path was accessed hits times, age seconds
+        ago. """
+    access_file = os.path.join(path, ACCESS_FILE)
+    with open(access_file, 'w') as fp:
+        json.dump(dict(hits=hits), fp)
+    access = time.time() - age
+    os.utime(access_file, (access, access))
+
+
+@with_setup(setup_tmpdir, teardown_tmpdir)
+def test_managed_func():
+    manager = CacheManager(tmpdir, max_bytes='1G')
+    zeros = _cached(_zeros, manager)
+    assert_true(isinstance(zeros, ManagedFunc))
+    zeros(10)
+    zeros(10)
+    zeros(n=10)
+    entry, = manager.entries()
+    assert_equal(entry.hits, 2)
+    assert_equal(entry.func_id.split('/')[-1], '_zeros')
+    stats = manager.stats()
+    assert_equal(stats[None]['entries'], 1)
+    assert_equal(stats[entry.func_id]['hits'], 2)
+
+
+@with_setup(setup_tmpdir, teardown_tmpdir)
+def test_prune_policies():
+    manager = CacheManager(tmpdir)
+    zeros = _cached(_zeros, CacheManager(tmpdir, max_bytes='1G'))
+    often, recent, other = [zeros.call_and_locate(n)[1]
+                            for n in (1000, 2000, 3000)]
+    # Used often long ago, rarely but recently, and in between
+    _set_access(often, hits=10, age=300)
+    _set_access(recent, hits=1, age=10)
+    _set_access(other, hits=5, age=100)
+    total = sum(e.size for e in manager.entries())
+
+    budget = total - 1  # one result must go
+    lru = CacheManager(tmpdir, max_bytes=budget, policy='lru')
+    evicted, = lru.prune(dry_run=True)
+    assert_equal(evicted.path, often)
+    lfu = CacheManager(tmpdir, max_bytes=budget, policy='lfu')
+    evicted, = lfu.prune(dry_run=True)
+    assert_equal(evicted.path, recent)
+
+    # Nothing is removed by dry runs, max_age evicts idle results.
+    assert_equal(len(manager.entries()), 3)
+    evicted = CacheManager(tmpdir, max_age='1m').prune()
+    assert_equal(len(evicted), 2)
+    assert_equal([e.path for e in manager.entries()], [recent])
+    assert_false(os.path.exists(evicted[0].path))
+
+
+@with_setup(setup_tmpdir, teardown_tmpdir)
+def test_quota():
+    manager = CacheManager(tmpdir, quotas=dict(_zeros='30K'))
+    zeros = _cached(_zeros, manager)
+    ones = _cached(_ones, manager)
+    for n in (1000, 2000, 3000):  # 8, 16 and 24K
+        ones(n)
+        zeros(n)
+        time.sleep(.01)
+    # Storing results beyond the quota of _zeros evicts its oldest ones
+    stats = manager.stats()
+    assert_equal(len(stats), 3)
+    for func_id, func_stats in stats.items():
+        if func_id is None:
+            continue
+        if func_id.endswith('_zeros'):
+            assert_equal(func_stats['entries'], 1)
+            assert_true(func_stats['bytes'] <= 30 * 1024)
+        else:
+            assert_equal(func_stats['entries'], 3)
+
+    # The quota is applied to the function name or to its full identifier
+    func_id = [f for f in stats if f is not None and f.endswith('_ones')][0]
+    manager = CacheManager(tmpdir, quotas={func_id: 0})
+    assert_equal(len(manager.prune()), 3)
+
+
+@with_setup(setup_tmpdir, teardown_tmpdir)
+def test_get_cache_manager():
+    assert_true(get_cache_manager(tmpdir) is None)
+    CacheManager(tmpdir, max_bytes='1G').save_config()
+    manager = get_cache_manager(tmpdir)
+    assert_equal(manager.max_bytes, 1024 ** 3)
+    assert_true(get_cache_manager(tmpdir) is manager)
+    # A new configuration is read again
+    CacheManager(tmpdir, max_bytes='2G', policy='lfu').save_config()
+    config_file = os.path.join(tmpdir, 'nidata_cache.json')
+    stat = os.stat(config_file)
+    os.utime(config_file, (stat.st_atime, stat.st_mtime + 1))
+    manager = get_cache_manager(tmpdir)
+    assert_equal((manager.max_bytes, manager.policy), (2 * 1024 ** 3, 'lfu'))
+
+
+def _run(*argv):
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        assert_equal(main(list(argv)), 0)
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+
+@with_setup(setup_tmpdir, teardown_tmpdir)
+def test_cli():
+    zeros = _cached(_zeros, CacheManager(tmpdir, max_bytes='1G'))
+    zeros(1000)
+    zeros(1000)
+    _cached(_ones, CacheManager(tmpdir, max_bytes='1G'))(10)
+
+    lines = _run('cache', 'stats', tmpdir).splitlines()
+    assert_equal(len(lines), 4)
+    assert_true(lines[1].split()[0].endswith('_zeros'))
+    assert_equal(lines[1].split()[1:4:2], ['1', '1'])
+    assert_equal(lines[3].split()[:2], ['total', '2'])
+
+    output = _run('cache', 'prune', tmpdir, '--quota', '_zeros=0',
+                  '--dry-run')
+    assert_true(output.startswith('would evict'))
+    assert_equal(len(CacheManager(tmpdir).entries()), 2)
+
+    output = _run('cache', 'prune', tmpdir, '--max-bytes', '1', '--save')
+    assert_equal(output.splitlines()[-1].split()[0], '2')
+    assert_equal(CacheManager(tmpdir).entries(), [])
+    assert_equal(CacheManager.from_config(tmpdir).max_bytes, 1)
+
+    # Invalid budgets are usage errors.
+    stderr = sys.stderr
+    sys.stderr = StringIO()
+    try:
+        for argv in (['--quota', 'foo'], ['--quota', '_zeros=1X'],
+                     ['--max-bytes', '1X'], ['--max-age', 'soon']):
+            assert_raises(SystemExit, main, ['cache', 'prune', tmpdir] + argv)
+            assert_true('invalid' in sys.stderr.getvalue())
+    finally:
+        sys.stderr = stderr
+
+
+def test_memory_tier_budget():
+    tier = MemoryTier('2K')
+    for key in 'abc':
+        tier.put(key, np.zeros(100))  # 800 bytes
+    assert_equal(len(tier), 2)
+    assert_equal(tier.get('a'), (False, None))
+    tier.get('b')
+    tier.put('d', np.zeros(100))
+    assert_true(tier.get('b')[0])
+    assert_false(tier.get('c')[0])
+    tier.put('e', np.zeros(1000))  # beyond the budget, not kept
+    assert_false(tier.get('e')[0])
+    assert_true(tier.nbytes <= 2048)
+
+
+@with_setup(setup_tmpdir, teardown_tmpdir)
+def test_memory_tier():
+    manager = CacheManager(tmpdir, max_bytes='1G')
+    tier = MemoryTier('1M')
+    counted = _cached(_counted, manager, memory_tier=tier)
+    _counted.calls = 0
+    output = counted(10)
+    assert_false(output.flags.writeable)
+    assert_true(counted(10) is output)
+    assert_equal(tier.hits, 1)
+    # Arguments are not bound to their names: another disk cache hit
+    assert_false(counted(n=10) is output)
+    assert_equal(_counted.calls, 1)
+    # Equal but different arguments are not confused
+    assert_equal(counted(10.).dtype, np.float64)
+    assert_equal(_counted.calls, 2)
+
+    # Arrays are keyed on their content
+    n = np.array(3)
+    counted(n)
+    n[...] = 4
+    assert_equal(len(counted(n)), 4)
+    assert_equal(_counted.calls, 4)
+
+    # Tier hits are disk accesses for the cache manager: the results hot in
+    # the tier are evicted last.
+    hot, = [e.path for e in manager.entries() if e.hits == 2]
+    for entry in manager.entries():
+        _set_access(entry.path, hits=0, age=100)
+    counted(10)
+    entries = manager.entries()
+    assert_equal([e.hits for e in entries if e.path == hot], [1])
+    total = sum(e.size for e in entries)
+    evicted = CacheManager(tmpdir, max_bytes=total - 1).prune()
+    assert_true(hot not in [e.path for e in evicted])
@@ -0,0 +1,96 @@
+"""
+Test the caching of functions of niimgs
+"""
+# License: simplified BSD
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from nose.tools import assert_equal, assert_not_equal, assert_true
+import nibabel
+from sklearn.externals.joblib import Memory
+
+from nidata.core._utils.cache_mixin import cache, niimg_fingerprint
+from nidata.core._utils.niimg import check_niimg
+
+
+def _mean(img, scale=1, verbose=0):
+    _mean.calls += 1
+    return check_niimg(img).get_data().mean() * scale
+
+
+def _setup():
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'img.nii')
+    nibabel.save(nibabel.Nifti1Image(np.ones((3, 4, 5)), np.eye(4)), filename)
+    return tmpdir, filename
+
+
+def test_niimg_fingerprint():
+    tmpdir, filename = _setup()
+    try:
+        fingerprint = niimg_fingerprint(filename)
+        assert_true(fingerprint is not None)
+        # The same image, by path or loaded from its file
+        assert_equal(niimg_fingerprint(nibabel.load(filename)), fingerprint)
+
+        # Images whose data is loaded may have been modified in memory.
+        img = nibabel.load(filename)
+        img.get_data()[0, 0, 0] = 2
+        assert_true(niimg_fingerprint(img) is None)
+        if hasattr(img, 'get_fdata'):
+            img = nibabel.load(filename)
+            img.get_fdata()
+            assert_true(niimg_fingerprint(img) is None)
+        assert_true(niimg_fingerprint(nibabel.Nifti1Image(
+            np.ones((3, 4, 5)), np.eye(4))) is None)
+
+        # New data in the file
+        nibabel.save(nibabel.Nifti1Image(2 * np.ones((3, 4, 5)), np.eye(4)),
+                     filename)
+        stat = os.stat(filename)
+        # Don't depend on the resolution of file times
+        os.utime(filename, (stat.st_atime, stat.st_mtime + 1))
+        assert_not_equal(niimg_fingerprint(filename), fingerprint)
+
+        # Known checksums survive the file being touched.
+        checksums = {filename: 'abc'}
+        fingerprint = niimg_fingerprint(filename, checksums=checksums)
+        os.utime(filename, (stat.st_atime, stat.st_mtime + 2))
+        assert_equal(niimg_fingerprint(filename, checksums=checksums),
+                     fingerprint)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_cache_fingerprint_niimgs():
+    tmpdir, filename = _setup()
+    try:
+        memory = Memory(cachedir=os.path.join(tmpdir, 'cache'), verbose=0)
+        mean = cache(_mean, memory, func_memory_level=1, memory_level=1,
+                     fingerprint_niimgs=True, ignore=['verbose'])
+        _mean.calls = 0
+
+        # Path or image, positional or keyword arguments: one computation
+        assert_equal(mean(filename), 1)
+        assert_equal(mean(nibabel.load(filename)), 1)
+        assert_equal(mean(img=filename, scale=1), 1)
+        assert_equal(mean(filename, 1, verbose=1), 1)
+        assert_equal(_mean.calls, 1)
+        assert_equal(mean(filename, scale=2), 2)
+        assert_equal(_mean.calls, 2)
+
+        # Modified data is computed again.
+        img = nibabel.load(filename)
+        img.get_data()[...] = 3
+        assert_equal(mean(img), 3)
+        nibabel.save(nibabel.Nifti1Image(4 * np.ones((3, 4, 5)), np.eye(4)),
+                     filename)
+        stat = os.stat(filename)
+        os.utime(filename, (stat.st_atime, stat.st_mtime + 1))
+        assert_equal(mean(filename), 4)
+        assert_equal(_mean.calls, 4)
+    finally:
+        shutil.rmtree(tmpdir)
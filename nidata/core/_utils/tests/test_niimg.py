@@ -0,0 +1,90 @@
+"""
+Test the niimg utilities
+"""
+# License: simplified BSD
+
+import numpy as np
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+from nose.tools import assert_equal, assert_true
+import nibabel
+from scipy import linalg, ndimage
+
+from nidata.core._utils import cache_mixin, niimg
+
+
+def _reference_resampling(data, source_affine, target_affine, target_shape,
+                          order):
+    """ Resample 3D data by mapping every target voxel to the source grid,
+        as nilearn.image.resample_img does for arbitrary affines.
+    """
+    transform = np.dot(linalg.inv(source_affine), target_affine)
+    coords = np.indices(target_shape).reshape(3, -1)
+    coords = np.dot(transform[:3, :3], coords) + transform[:3, 3:]
+    return ndimage.map_coordinates(data, coords, order=order).reshape(
+        target_shape)
+
+
+def _random_img(shape, affine, seed=0):
+    data = np.random.RandomState(seed).uniform(size=shape)
+    return nibabel.Nifti1Image(data, affine)
+
+
+def test_resample_niimgs_equivalence():
+    # The shared-transform path gives the output of a resampling computed
+    # voxel by voxel from the full affines.
+    source_affine = np.diag([2., 2., 2., 1.])
+    source_affine[:3, 3] = [-3., 1., 2.]
+    angle = np.pi / 12
+    oblique = np.eye(4)
+    oblique[:2, :2] = [[np.cos(angle), -np.sin(angle)],
+                       [np.sin(angle), np.cos(angle)]]
+    oblique = np.dot(oblique, np.diag([1.5, 1.5, 1.5, 1.]))
+    target_shape = (9, 8, 7)
+    img_3d = _random_img((10, 11, 12), source_affine)
+    img_4d = _random_img((10, 11, 12, 3), source_affine, seed=1)
+
+    for target_affine in (np.diag([1.5, 3., 2.5, 1.]), oblique):
+        for interpolation, order in (('continuous', 3), ('nearest', 0)):
+            resampled_3d, resampled_4d = niimg._resample_niimgs(
+                [img_3d, img_4d], (target_affine, target_shape), dict(),
+                interpolation=interpolation)
+            assert_array_equal(resampled_3d.get_affine(), target_affine)
+            assert_equal(resampled_4d.shape, target_shape + (3, ))
+            assert_array_almost_equal(
+                resampled_3d.get_data(),
+                _reference_resampling(img_3d.get_data(), source_affine,
+                                      target_affine, target_shape, order))
+            for t in range(3):
+                assert_array_almost_equal(
+                    resampled_4d.get_data()[..., t],
+                    _reference_resampling(img_4d.get_data()[..., t],
+                                          source_affine, target_affine,
+                                          target_shape, order))
+
+    # Integer data is interpolated as floats, and kept as is by nearest
+    # interpolation.
+    labels = nibabel.Nifti1Image(
+        np.arange(2 * 3 * 4, dtype=np.int16).reshape((2, 3, 4)), np.eye(4))
+    upsampled, = niimg._resample_niimgs(
+        [labels], (np.diag([.5, .5, .5, 1.]), (4, 6, 8)), dict(),
+        interpolation='nearest')
+    assert_equal(upsampled.get_data().dtype, np.int16)
+    assert_array_equal(upsampled.get_data()[::2, ::2, ::2],
+                       labels.get_data())
+
+
+def test_resample_niimgs_no_fingerprint_without_cache():
+    # Images are only fingerprinted when the resampling is cached.
+    img = _random_img((4, 4, 4), np.eye(4))
+
+    def fail(*args, **kwargs):
+        raise AssertionError('niimg fingerprinted without a cache')
+
+    niimg_fingerprint = cache_mixin.niimg_fingerprint
+    cache_mixin.niimg_fingerprint = fail
+    try:
+        resampled, = niimg._resample_niimgs(
+            [img], (np.diag([2., 2., 2., 1.]), (2, 2, 2)), dict())
+    finally:
+        cache_mixin.niimg_fingerprint = niimg_fingerprint
+    assert_true(resampled.shape == (2, 2, 2))
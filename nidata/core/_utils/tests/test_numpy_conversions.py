@@ -0,0 +1,61 @@
+"""
+Test the numpy conversion utilities
+"""
+# License: simplified BSD
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.testing import assert_array_equal
+from nose.tools import assert_equal, assert_true, assert_false
+
+from nidata.core._utils.numpy_conversions import as_ndarray
+
+
+def _memmap(tmpdir, order='C'):
+    filename = os.path.join(tmpdir, 'arr.dat')
+    arr = np.memmap(filename, dtype=np.float32, mode='w+', shape=(4, 5),
+                    order=order)
+    arr[:] = np.arange(20).reshape((4, 5))
+    arr.flush()
+    return arr
+
+
+def test_as_ndarray_memmap():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        arr = _memmap(tmpdir)
+
+        # Read-only view on the mapped file
+        view = as_ndarray(arr, allow_memmap=True)
+        assert_equal(view.__class__, np.ndarray)
+        assert_true(np.may_share_memory(view, arr))
+        assert_false(view.flags.writeable)
+        assert_array_equal(view, arr)
+        view = as_ndarray(arr, dtype=np.float32, order='C',
+                          allow_memmap=True)
+        assert_true(np.may_share_memory(view, arr))
+
+        # Copies when converting, or when asked to
+        for kwargs in (dict(dtype=np.float64, allow_memmap=True),
+                       dict(order='F', allow_memmap=True),
+                       dict(copy=True, allow_memmap=True),
+                       dict(allow_memmap=False)):
+            ret = as_ndarray(arr, **kwargs)
+            assert_equal(ret.__class__, np.ndarray)
+            assert_false(np.may_share_memory(ret, arr))
+            assert_true(ret.flags.writeable)
+            assert_array_equal(ret, arr)
+        ret = as_ndarray(arr, dtype=np.float64, order='F', allow_memmap=True)
+        assert_false(np.may_share_memory(ret, arr))
+
+        # Cast and reordered copy without allow_memmap
+        ret = as_ndarray(arr, dtype=np.float64, order='F')
+        assert_equal(ret.dtype, np.float64)
+        assert_true(ret.flags['F_CONTIGUOUS'])
+        assert_array_equal(ret, arr)
+        del arr, view
+    finally:
+        shutil.rmtree(tmpdir)
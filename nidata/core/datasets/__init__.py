@@ -127,9 +127,302 @@ class Dataset(object):
 
 
 class HttpDataset(Dataset):
+    # Prefixes of the mirrors of the urls of the dataset, by url prefix
+    mirrors = dict()
+
     def __init__(self, data_dir=None):
         """
         """
         from ..fetchers import HttpFetcher  # avoid circular import
         super(HttpDataset, self).__init__(data_dir=data_dir)
-        self.fetcher = HttpFetcher(data_dir=self.data_dir)
+        self.fetcher = HttpFetcher(data_dir=self.data_dir,
+                                   mirrors=self.mirrors)
+
+
+class AtlasDataset(HttpDataset):
+    """ Dataset of atlas images, with a precomputed index of their regions.
+
+    Subclasses holding probabilistic atlases set maps to True.
+    """
+    maps = False
+
+    def label_index(self, atlas_file, maps=None, volume=None, force=False):
+        """ Return the AtlasIndex of a fetched atlas file.
+
+        The index (voxels, bounding box, volume and centroid of each region)
+        is built once and stored alongside the atlas file.
+
+        Parameters
+        ----------
+        atlas_file: string
+            Path of an atlas image returned by fetch().
+
+        maps: bool, optional
+            Whether atlas_file is a 4D probabilistic atlas. Defaults to the
+            maps attribute of the dataset.
+
+        volume: int, optional
+            For 4D label images, the volume to index.
+
+        force: bool, optional
+            If True, rebuild the index.
+        """
+        from .._utils.atlas_index import get_atlas_index
+        if maps is None:
+            maps = self.maps
+        return get_atlas_index(atlas_file, maps=maps, volume=volume,
+                               force=force)
+
+    def region_signals(self, atlas_file, imgs, volume=None, **kwargs):
+        """ Return the mean time series of the regions of a fetched atlas
+            in 4D images sampled like the atlas.
+
+        See nidata.core._utils.region_signals.extract_region_signals for
+        the keyword arguments (packed output file, chunk size, n_jobs).
+        """
+        from .._utils.region_signals import extract_region_signals
+        return extract_region_signals(
+            self.label_index(atlas_file, volume=volume), imgs, **kwargs)
+
+
+class DiffusionDataset(HttpDataset):
+    """ Dataset of diffusion images, with their gradient tables.
+
+    Subclasses list their files in `files`, as (key, file name, url, md5 sum)
+    tuples. The keys of the diffusion weighted image and of its b-values and
+    b-vectors are 'dwi', 'bvals' and 'bvecs'.
+    """
+    files = ()
+    normalize_bvecs = False
+
+    def fetch(self, keys=None, resume=True, force=False, check=True,
+              n_jobs=4, verbose=1):
+        """ Fetch the files of the dataset.
+
+        Files are downloaded concurrently. Existing files are verified
+        against their MD5 sum, which is only computed again for files whose
+        size or modification time changed.
+
+        Parameters
+        ----------
+        keys: list of strings, optional
+            Keys of the files to fetch. Default: all the files.
+
+        check: bool, optional
+            Whether to verify the MD5 sums of existing files.
+
+        n_jobs: int, optional
+            Number of files downloaded at once.
+
+        Returns
+        -------
+        data: sklearn.datasets.base.Bunch
+            Path of each file, by key.
+        """
+        from sklearn.datasets.base import Bunch
+        files = [f for f in self.files if keys is None or f[0] in keys]
+        paths = self.fetcher.fetch(
+            [(name, url, dict(md5sum=md5) if md5 else dict())
+             for _, name, url, md5 in files],
+            resume=resume, force=force, check=check, n_jobs=n_jobs,
+            verbose=verbose)
+        return Bunch(**dict((f[0], path) for f, path in zip(files, paths)))
+
+    def _dwi_files(self):
+        return dict((key, os.path.join(self.data_dir, name))
+                    for key, name, _, _ in self.files
+                    if key in ('dwi', 'bvals', 'bvecs'))
+
+    def gradients(self, b0_threshold=50, shell_tol=100, verbose=0):
+        """ Load the gradient table of the diffusion weighted image.
+
+        The parsed (and normalized) table is cached in gradients.npz, with
+        the size and modification time of the image and of the b-values and
+        b-vectors files. While they are unchanged, files are neither fetched
+        nor verified again.
+
+        Parameters
+        ----------
+        b0_threshold: float, optional
+            b-values up to this one are b=0 volumes.
+
+        shell_tol: float, optional
+            b-values closer than this one are in the same shell.
+
+        Returns
+        -------
+        data: sklearn.datasets.base.Bunch
+            dictionary-like object, contains:
+            - "bvals", "bvecs": b-values and b-vectors of the volumes
+            - "b0_mask": boolean mask of the b=0 volumes
+            - "shells": mean b-value of each shell, 0 first
+            - "shell_index": shell of each volume
+        """
+        import numpy as np
+        from sklearn.datasets.base import Bunch
+
+        paths = self._dwi_files()
+        cache_file = os.path.join(self.data_dir, 'gradients.npz')
+        params = [b0_threshold, shell_tol, int(self.normalize_bvecs)]
+
+        def source_stats():
+            return [[os.stat(paths[k]).st_size, os.stat(paths[k]).st_mtime]
+                    for k in ('dwi', 'bvals', 'bvecs')]
+
+        if os.path.exists(cache_file):
+            try:
+                with np.load(cache_file) as cached:
+                    if (cached['source_stats'].tolist() == source_stats()
+                            and cached['params'].tolist() == params):
+                        return Bunch(**dict(
+                            (k, cached[k]) for k in ('bvals', 'bvecs',
+                                                     'b0_mask', 'shells',
+                                                     'shell_index')))
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+
+        from dipy.io.gradients import read_bvals_bvecs
+        self.fetch(keys=['dwi', 'bvals', 'bvecs'], check=True,
+                   verbose=verbose)
+        bvals, bvecs = read_bvals_bvecs(paths['bvals'], paths['bvecs'])
+        b0_mask = bvals <= b0_threshold
+        if self.normalize_bvecs:
+            norms = np.sqrt(np.sum(bvecs * bvecs, axis=1))
+            bvecs[~b0_mask] /= norms[~b0_mask, np.newaxis]
+
+        # Shells: b-values sorted and split at gaps larger than shell_tol
+        shell_index = np.zeros(len(bvals), dtype=np.int16)
+        shells = [0.]
+        order = np.argsort(bvals)
+        order = order[~b0_mask[order]]
+        if len(order):
+            splits = np.flatnonzero(np.diff(bvals[order]) > shell_tol) + 1
+            for i, shell in enumerate(np.split(order, splits)):
+                shell_index[shell] = i + 1
+                shells.append(bvals[shell].mean())
+        gradients = Bunch(bvals=bvals, bvecs=bvecs, b0_mask=b0_mask,
+                          shells=np.array(shells), shell_index=shell_index)
+        try:
+            with open(cache_file, 'wb') as fp:
+                np.savez(fp, source_stats=source_stats(), params=params,
+                         **gradients)
+        except (IOError, OSError):
+            pass
+        return gradients
+
+    def _shell_volumes(self, gradients, bvals, b0_threshold=50,
+                       shell_tol=100):
+        import numpy as np
+        from .._utils.compat import in1d
+        if not hasattr(bvals, '__iter__'):
+            bvals = [bvals]
+        shell_ids = []
+        for bval in bvals:
+            if bval <= b0_threshold:
+                if not gradients.b0_mask.any():
+                    raise ValueError('No b=0 volumes below b=%s; the shells '
+                                     'of the dataset are at b=%s'
+                                     % (b0_threshold, gradients.shells))
+                shell_ids.append(0)
+                continue
+            dists = np.abs(gradients.shells[1:] - bval)
+            if not len(dists) or dists.min() > shell_tol:
+                raise ValueError('No shell at b=%s; the shells of the dataset '
+                                 'are at b=%s' % (bval, gradients.shells))
+            shell_ids.append(np.argmin(dists) + 1)
+        volumes = np.flatnonzero(in1d(gradients.shell_index, shell_ids))
+        return shell_ids, volumes
+
+    def shell_img(self, bvals, cache=False, b0_threshold=50, verbose=0):
+        """ Load the volumes of some shells of the diffusion weighted image.
+
+        Only the volumes of the shells are read from the image.
+
+        Parameters
+        ----------
+        bvals: float or list of floats
+            b-values of the shells (0 for the b=0 volumes).
+
+        cache: bool, optional
+            If True, the volumes are stored uncompressed in the shells
+            directory of the dataset, and memory-mapped from there by later
+            calls.
+
+        Returns
+        -------
+        img: nibabel.Nifti1Image
+            The volumes of the shells, in the order of the image.
+        """
+        import nibabel
+        import numpy as np
+
+        gradients = self.gradients(b0_threshold=b0_threshold,
+                                   verbose=verbose)
+        shell_ids, volumes = self._shell_volumes(gradients, bvals,
+                                                 b0_threshold=b0_threshold)
+        dwi_file = self._dwi_files()['dwi']
+        shells = '_'.join('b%d' % round(gradients.shells[i])
+                          for i in sorted(set(shell_ids)))
+        cache_file = os.path.join(self.data_dir, 'shells', 'dwi_%s_thr%g.nii'
+                                  % (shells, b0_threshold))
+        if (cache and os.path.exists(cache_file) and
+                os.stat(cache_file).st_mtime >= os.stat(dwi_file).st_mtime):
+            return nibabel.load(cache_file, mmap=True)
+
+        # Contiguous volumes are read at once, through the image proxy.
+        img = nibabel.load(dwi_file)
+        runs = np.split(volumes, np.flatnonzero(np.diff(volumes) != 1) + 1)
+        data = np.concatenate([np.asarray(img.dataobj[..., run[0]:run[-1] + 1])
+                               for run in runs], axis=-1)
+        shell_img = nibabel.Nifti1Image(data, img.get_affine(),
+                                        header=img.get_header())
+        if cache:
+            if not os.path.exists(os.path.dirname(cache_file)):
+                os.makedirs(os.path.dirname(cache_file))
+            temp_file = cache_file[:-len('.nii')] + '.part.nii'
+            nibabel.save(shell_img, temp_file)
+            os.rename(temp_file, cache_file)
+            return nibabel.load(cache_file, mmap=True)
+        return shell_img
+
+    def read_shell(self, bvals, cache=False, b0_threshold=50, verbose=0):
+        """ Load the volumes of some shells and their gradient table.
+
+        See shell_img for the parameters.
+
+        Returns
+        -------
+        img: nibabel.Nifti1Image
+        gtab: dipy.core.gradients.GradientTable
+        """
+        from dipy.core.gradients import gradient_table
+
+        gradients = self.gradients(b0_threshold=b0_threshold,
+                                   verbose=verbose)
+        _, volumes = self._shell_volumes(gradients, bvals,
+                                         b0_threshold=b0_threshold)
+        img = self.shell_img(bvals, cache=cache, b0_threshold=b0_threshold,
+                             verbose=verbose)
+        return img, gradient_table(gradients.bvals[volumes],
+                                   gradients.bvecs[volumes],
+                                   b0_threshold=b0_threshold)
+
+    def read(self, b0_threshold=50, verbose=0):
+        """ Load the diffusion weighted image and its gradient table.
+
+        The image data is not read: it is loaded lazily, through its proxy
+        (img.dataobj), when accessed.
+
+        Returns
+        -------
+        img: nibabel.Nifti1Image
+        gtab: dipy.core.gradients.GradientTable
+        """
+        import nibabel
+        from dipy.core.gradients import gradient_table
+
+        gradients = self.gradients(b0_threshold=b0_threshold,
+                                   verbose=verbose)
+        img = nibabel.load(self._dwi_files()['dwi'])
+        return img, gradient_table(gradients.bvals, gradients.bvecs,
+                                   b0_threshold=b0_threshold)
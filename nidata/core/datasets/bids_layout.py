@@ -0,0 +1,205 @@
+"""
+Index of the files of a BIDS-like dataset directory
+"""
+import json
+import os
+import re
+
+from .._utils.compat import _basestring
+
+ENTITIES = ('sub', 'ses', 'task', 'run', 'modality', 'suffix', 'extension')
+
+_ENTITY_RES = dict(
+    sub=re.compile(r'(?:^|_)sub-([a-zA-Z0-9]+)'),
+    ses=re.compile(r'(?:^|_)ses-([a-zA-Z0-9]+)'),
+    task=re.compile(r'(?:^|_)task-([a-zA-Z0-9]+)'),
+    run=re.compile(r'(?:^|_)run-?([0-9]+)'))
+# Parts of a file name that are entities, not its suffix
+_ENTITY_PART_RE = re.compile(r'^((sub|ses|task|acq|rec|echo)-.*|run-?[0-9]+)$')
+_DIR_RES = dict(
+    sub=re.compile(r'^sub-?([a-zA-Z0-9]+)$'),
+    ses=re.compile(r'^ses-?([a-zA-Z0-9]+)$'))
+
+
+def _split_ext(filename):
+    for ext in ('.nii.gz', '.tar.gz'):
+        if filename.endswith(ext):
+            return filename[:-len(ext)], ext
+    return os.path.splitext(filename)
+
+
+def parse_entities(path):
+    """Return the BIDS entities of a file path.
+
+    sub, ses, task and run are read from the file name, or else from the
+    sub*/ses* directories of the path. modality is the name of the parent
+    directory (e.g. functional, anat), suffix the last '_' separated part
+    of the file name that is not an entity (e.g. bold, T1w, events).
+    """
+    dirs = os.path.normpath(os.path.dirname(path)).split(os.sep)
+    stem, ext = _split_ext(os.path.basename(path))
+    entities = dict(modality=dirs[-1] if dirs and dirs[-1] != '.' else None,
+                    suffix=None, extension=ext)
+    parts = [p for p in stem.split('_') if not _ENTITY_PART_RE.match(p)]
+    if parts:
+        entities['suffix'] = parts[-1]
+    for name, regex in _ENTITY_RES.items():
+        match = regex.search(stem)
+        entities[name] = match.groups()[0] if match else None
+    for name, regex in _DIR_RES.items():
+        if entities[name] is not None:
+            continue
+        for dirname in dirs:
+            match = regex.match(dirname)
+            if match:
+                entities[name] = match.groups()[0]
+    return entities
+
+
+def _key(value):
+    """Normalized entity value: labels made of digits compare as ints."""
+    if hasattr(value, 'isdigit') and value.isdigit():
+        return int(value)
+    return value
+
+
+def _scandir(path):
+    """Yield (name, is_dir) for the entries of a directory."""
+    try:
+        scandir = os.scandir
+    except AttributeError:  # Python < 3.5
+        for name in os.listdir(path):
+            yield name, os.path.isdir(os.path.join(path, name))
+        return
+    for entry in scandir(path):
+        yield entry.name, entry.is_dir()
+
+
+class BidsLayout(object):
+    """Index of the files of a dataset directory, by BIDS entities.
+
+    The directory is walked once and the index is stored next to it
+    (.<dirname>_layout.json in its parent directory). The stored index is
+    reused as long as no directory of the tree has been modified, which is
+    checked with one stat() per directory.
+
+    Parameters
+    ----------
+    root: string
+        Path of the dataset directory.
+
+    Examples
+    --------
+    >>> layout = BidsLayout(os.path.join(data_dir, 'ds052_BIDS'))
+    >>> layout.get(task='stopsignal', suffix='bold', run=[1, 2, 3])
+    """
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        parent, name = os.path.split(self.root)
+        self.index_file = os.path.join(parent, '.%s_layout.json' % name)
+        self.files = []
+        self.dir_mtimes = dict()
+        self._index = dict()
+        if not self._load():
+            self.rebuild()
+
+    def _load(self):
+        if not os.path.exists(self.index_file):
+            return False
+        try:
+            with open(self.index_file, 'r') as fp:
+                stored = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return False
+        for dirname, mtime in stored['dir_mtimes'].items():
+            try:
+                if os.stat(os.path.join(self.root, dirname)).st_mtime != mtime:
+                    return False
+            except OSError:
+                return False
+        self.files = stored['files']
+        self.dir_mtimes = stored['dir_mtimes']
+        self._build_index()
+        return True
+
+    def rebuild(self):
+        """Walk the dataset directory and store the index."""
+        self.files = []
+        self.dir_mtimes = dict()
+        todo = ['']
+        while todo:
+            dirname = todo.pop()
+            path = os.path.join(self.root, dirname)
+            if not os.path.isdir(path):
+                continue
+            self.dir_mtimes[dirname] = os.stat(path).st_mtime
+            for name, is_dir in _scandir(path):
+                if name.startswith('.'):
+                    continue
+                relpath = os.path.join(dirname, name)
+                if is_dir:
+                    todo.append(relpath)
+                else:
+                    entities = parse_entities(relpath)
+                    entities['path'] = relpath
+                    self.files.append(entities)
+        self.files.sort(key=lambda f: f['path'])
+        self._build_index()
+        try:
+            with open(self.index_file, 'w') as fp:
+                json.dump(dict(files=self.files, dir_mtimes=self.dir_mtimes),
+                          fp)
+        except (IOError, OSError):
+            # e.g. read-only shared data
+            pass
+
+    def _build_index(self):
+        self._index = dict((name, dict()) for name in ENTITIES)
+        for i, entities in enumerate(self.files):
+            for name in ENTITIES:
+                self._index[name].setdefault(_key(entities[name]),
+                                             set()).add(i)
+
+    def _lookup(self, name, wanted):
+        index = self._index[name]
+        if callable(wanted):
+            return set().union(*[ids for value, ids in index.items()
+                                 if wanted(value)])
+        if (hasattr(wanted, '__iter__')
+                and not isinstance(wanted, _basestring)):
+            return set().union(*[index.get(_key(w), set()) for w in wanted])
+        return index.get(_key(wanted), set())
+
+    def get(self, **entities):
+        """Return the paths of the files matching the given entities.
+
+        Values can be a label, a list/set/range of labels (any of them), or
+        a predicate; labels made of digits match ints (run=1 matches run01).
+        The special value True matches files having the entity.
+
+        Returns
+        -------
+        paths: list of strings
+            Sorted absolute paths.
+        """
+        ids = None
+        for name, wanted in entities.items():
+            if name not in ENTITIES:
+                raise ValueError('Unknown entity %r; valid entities are %s'
+                                 % (name, ENTITIES))
+            if wanted is True:
+                wanted = lambda value: value is not None
+            matches = self._lookup(name, wanted)
+            ids = matches if ids is None else ids & matches
+        if ids is None:
+            ids = range(len(self.files))
+        return [os.path.join(self.root, self.files[i]['path'])
+                for i in sorted(ids)]
+
+    def entities(self, name, **filters):
+        """Return the sorted values of an entity among matching files."""
+        paths = set(self.get(**filters))
+        values = set(f[name] for f in self.files
+                     if os.path.join(self.root, f['path']) in paths)
+        return sorted(values - set([None]), key=lambda v: (
+            not isinstance(_key(v), int), _key(v)))
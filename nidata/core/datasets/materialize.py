@@ -0,0 +1,205 @@
+"""
+Storage of the images of a dataset as raw, memory-mappable arrays
+"""
+# License: simplified BSD
+
+import base64
+import json
+import os
+
+import nibabel
+import numpy as np
+from sklearn.externals.joblib import Parallel, delayed
+
+from .._utils.compat import _basestring
+
+_IMG_EXTENSIONS = ('.nii', '.nii.gz', '.img', '.hdr', '.mgz')
+
+
+def _is_img_list(value):
+    if isinstance(value, _basestring):
+        value = [value]
+    if not isinstance(value, (list, tuple)) or not value:
+        return False
+    return all(isinstance(v, _basestring) and v.endswith(_IMG_EXTENSIONS)
+               for v in value)
+
+
+def _source_stat(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def _materialize_img(img_file, array_file, chunk_size=64):
+    """Write an image as a (scans, x, y, z) .npy file, by chunks of scans.
+
+    Returns the entry of the image in the store index.
+    """
+    img = nibabel.load(img_file)
+    shape = img.shape[:3]
+    n_scans = img.shape[3] if len(img.shape) > 3 else 1
+    temp_file = array_file + '.part.npy'
+    dataobj = img.dataobj
+    # The arrays hold the scaled data: its dtype is not the on-disk one
+    # when the header has a slope or an intercept.
+    dtype = np.asarray(dataobj[..., :1]).dtype
+    out = np.lib.format.open_memmap(temp_file, mode='w+', dtype=dtype,
+                                    shape=(n_scans,) + tuple(shape))
+    if len(img.shape) == 3:
+        out[0] = np.asarray(dataobj)
+    else:
+        for start in range(0, n_scans, chunk_size):
+            stop = min(start + chunk_size, n_scans)
+            out[start:stop] = np.rollaxis(
+                np.asarray(dataobj[..., start:stop]), 3)
+    out.flush()
+    del out
+    os.rename(temp_file, array_file)
+    header = img.get_header().copy()
+    header.set_data_dtype(dtype)
+    header.set_slope_inter(None, None)
+    header = header.binaryblock
+    return dict(source=os.path.abspath(img_file),
+                source_stat=_source_stat(img_file),
+                array=os.path.basename(array_file),
+                n_scans=n_scans,
+                affine=np.asarray(img.get_affine()).tolist(),
+                header=base64.b64encode(header).decode('ascii'))
+
+
+class ArrayStore(object):
+    """Images of a dataset stored as raw arrays, one .npy file per image.
+
+    Each image is a (scans, x, y, z) array (3D images have one scan); the
+    scans of the images of a key are numbered consecutively, from the
+    offsets of the images.
+
+    Parameters
+    ----------
+    store_dir: string
+        Directory of the store.
+
+    Examples
+    --------
+    >>> store = materialize(haxby_data, store_dir, keys=['func'])
+    >>> store.scans('func', 100, 164)  # scans 100 to 163 of all the runs
+    """
+    index_name = 'index.json'
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index = dict()
+        index_file = os.path.join(store_dir, self.index_name)
+        if os.path.exists(index_file):
+            with open(index_file, 'r') as fp:
+                self.index = json.load(fp)
+
+    def keys(self):
+        return sorted(self.index.keys())
+
+    def offsets(self, key):
+        """Index of the first scan of each image, and the number of scans.
+        """
+        return np.cumsum([0] + [entry['n_scans']
+                                for entry in self.index[key]])
+
+    def __getitem__(self, key):
+        """Memory-mapped arrays of the images of a key."""
+        return [self.array(key, i) for i in range(len(self.index[key]))]
+
+    def array(self, key, i):
+        entry = self.index[key][i]
+        return np.load(os.path.join(self.store_dir, key, entry['array']),
+                       mmap_mode='r')
+
+    def img(self, key, i):
+        """Nifti image of an array, with the affine and header of its source.
+        """
+        entry = self.index[key][i]
+        header = nibabel.Nifti1Header(
+            base64.b64decode(entry['header'].encode('ascii')))
+        data = np.rollaxis(self.array(key, i), 0, 4)
+        if entry['n_scans'] == 1 and len(header.get_data_shape()) == 3:
+            data = data[..., 0]
+        return nibabel.Nifti1Image(data, np.array(entry['affine']),
+                                   header=header)
+
+    def scans(self, key, start, stop):
+        """Scans start to stop - 1 of the images of a key, as one array."""
+        offsets = self.offsets(key)
+        first = max(np.searchsorted(offsets, start, side='right') - 1, 0)
+        last = np.searchsorted(offsets, stop, side='left')
+        return np.concatenate([
+            self.array(key, i)[max(start - offsets[i], 0):
+                               stop - offsets[i]]
+            for i in range(first, min(last, len(offsets) - 1))])
+
+    def save(self):
+        with open(os.path.join(self.store_dir, self.index_name), 'w') as fp:
+            json.dump(self.index, fp)
+
+
+def materialize(data, store_dir, keys=None, chunk_size=64, n_jobs=1,
+                verbose=0):
+    """Store the images of a dataset as raw, memory-mappable arrays.
+
+    Images are decoded once, in parallel worker processes; images already
+    stored, and unchanged since (size and modification time), are skipped.
+
+    Parameters
+    ----------
+    data: Bunch or dict
+        Result of the fetch() of a dataset.
+
+    store_dir: string
+        Directory of the store.
+
+    keys: list of strings, optional
+        Keys of the images to store. Default: all the keys whose value is a
+        path or a list of paths of images.
+
+    chunk_size: int, optional
+        Number of scans of 4D images read at once.
+
+    n_jobs: int, optional
+        Number of worker processes (-1: as many as CPUs).
+
+    Returns
+    -------
+    store: ArrayStore
+    """
+    if keys is None:
+        keys = sorted(k for k, v in data.items() if _is_img_list(v))
+    store = ArrayStore(store_dir)
+    todo = []
+    for key in keys:
+        img_files = data[key]
+        if isinstance(img_files, _basestring):
+            img_files = [img_files]
+        key_dir = os.path.join(store_dir, key)
+        if not os.path.exists(key_dir):
+            os.makedirs(key_dir)
+        stored = dict((entry['source'], entry)
+                      for entry in store.index.get(key, []))
+        entries = []
+        for i, img_file in enumerate(img_files):
+            entry = stored.get(os.path.abspath(img_file))
+            array_file = os.path.join(key_dir, '%05d.npy' % i)
+            if (entry is None or entry['array'] != os.path.basename(array_file)
+                    or entry['source_stat'] != _source_stat(img_file)
+                    or not os.path.exists(array_file)):
+                todo.append((key, i, img_file, array_file))
+                entry = None
+            entries.append(entry)
+        store.index[key] = entries
+
+    if verbose > 0:
+        print('Materializing %d images in %s' % (len(todo), store_dir))
+    results = Parallel(n_jobs=n_jobs, verbose=verbose)(
+        delayed(_materialize_img)(img_file, array_file,
+                                  chunk_size=chunk_size)
+        for _, _, img_file, array_file in todo)
+    for (key, i, _, _), entry in zip(todo, results):
+        store.index[key][i] = entry
+    store.save()
+    return store
@@ -1,3 +1,5 @@
 from .aws_fetcher import AmazonS3Fetcher
 from .http_fetcher import HttpFetcher
 from .base import *
+from . import instrumentation
+from . import admission
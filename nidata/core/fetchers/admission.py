@@ -0,0 +1,102 @@
+"""
+Admission control of downloads: disk budget and bandwidth cap
+"""
+# License: simplified BSD
+
+import os
+import shutil
+import threading
+import time
+
+from . import instrumentation
+
+
+def disk_free(path):
+    """Free space (bytes) of the file system of path, for the user."""
+    while not os.path.exists(path):
+        path = os.path.dirname(os.path.abspath(path))
+    try:
+        return shutil.disk_usage(path).free
+    except AttributeError:  # Python < 3.3
+        stat = os.statvfs(path)
+        return stat.f_bavail * stat.f_frsize
+
+
+def format_size(n_bytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n_bytes) < 1024.:
+            return '%.1f%s' % (n_bytes, unit)
+        n_bytes /= 1024.
+    return '%.1fTB' % n_bytes
+
+
+class DiskAdmission(object):
+    """Admit downloads while their projected disk usage fits a budget.
+
+    Each download declares its peak footprint (e.g. archive and extracted
+    files) and its final footprint (what is left once it is done). A
+    download waits until its peak fits in the budget, next to the final
+    footprints of the finished downloads and the peaks of the running ones.
+
+    Parameters
+    ----------
+    budget: int
+        Bytes that downloads can add to the disk.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.committed = 0  # final footprints of finished downloads
+        self.in_flight = 0  # peak footprints of running downloads
+        self.n_running = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, peak, name=None):
+        """Wait until a download of the given peak footprint fits.
+
+        Raises IOError if it cannot fit, even once the running downloads
+        are done.
+        """
+        t0 = time.time()
+        with self._condition:
+            while self.committed + self.in_flight + peak > self.budget:
+                if self.n_running == 0 or self.committed + peak > self.budget:
+                    raise IOError(
+                        'Not enough disk space to fetch %s: %s needed, %s '
+                        'left in the budget of %s.' % (
+                            name, format_size(peak),
+                            format_size(self.budget - self.committed),
+                            format_size(self.budget)))
+                self._condition.wait()
+            self.in_flight += peak
+            self.n_running += 1
+        instrumentation.emit('admit', name=name, peak=peak, time=t0,
+                             duration=time.time() - t0)
+
+    def release(self, peak, final):
+        """Declare a download done, with its final footprint."""
+        with self._condition:
+            self.in_flight -= peak
+            self.committed += final
+            self.n_running -= 1
+            self._condition.notify_all()
+
+
+class RateLimiter(object):
+    """Cap of the aggregate throughput of threads, in bytes per second.
+
+    Threads call throttle() with the size of each chunk they read; it
+    sleeps as long as needed to keep the total rate under the cap.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def throttle(self, n_bytes):
+        with self._lock:
+            now = time.time()
+            # Unused bandwidth is not saved for later bursts.
+            self._next = max(self._next, now) + n_bytes / self.rate
+            delay = self._next - now
+        if delay > 0:
+            time.sleep(delay)
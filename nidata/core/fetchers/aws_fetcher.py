@@ -9,6 +9,7 @@ from functools import partial
 import nibabel as nib
 import numpy as np
 
+from . import instrumentation
 from .base import chunk_report, Fetcher
 
 
@@ -19,31 +20,68 @@ def test_cb(cur_bytes, total_bytes, t0=None, **kwargs):
 class AmazonS3Fetcher(Fetcher):
     dependencies = ['boto']
 
-    def __init__(self, data_dir=None, access_key=None, secret_access_key=None, profile_name=None):
+    def __init__(self, data_dir=None, access_key=None, secret_access_key=None, profile_name=None,
+                 host=None, port=None, is_secure=True):
+        """host, port and is_secure select another S3 endpoint than
+        Amazon's (e.g. a mirror, or a local stand-in for benchmarks)."""
         if not (profile_name or (access_key and secret_access_key)):
             raise ValueError('profile_name or access_key / secret_access_key must be provided.')
         super(AmazonS3Fetcher, self).__init__(data_dir=data_dir)
         self.access_key = access_key
         self.secret_access_key = secret_access_key
         self.profile_name = profile_name
+        self.host = host
+        self.port = port
+        self.is_secure = is_secure
 
-    def fetch(self, files, force=False, check=False, verbose=1):
+    def _connect(self):
         assert self.profile_name or (self.access_key and self.secret_access_key)
 
-        files = Fetcher.reformat_files(files)  # allows flexibility
         import boto
+        kwargs = dict()
+        if self.host is not None:
+            from boto.s3.connection import OrdinaryCallingFormat
+            # Bucket names in the path: the endpoint has no bucket subdomains
+            kwargs = dict(host=self.host, port=self.port,
+                          is_secure=self.is_secure,
+                          calling_format=OrdinaryCallingFormat())
         if self.profile_name is not None:
-            s3 = boto.connect_s3(profile_name=self.profile_name)
-        elif self.access_key is not None and self.secret_access_key is not None:
-            s3 = boto.connect_s3(self.access_key, self.secret_access_key)
+            return boto.connect_s3(profile_name=self.profile_name, **kwargs)
+        return boto.connect_s3(self.access_key, self.secret_access_key,
+                               **kwargs)
+
+    def _get_bucket(self, s3, bucket_name=None):
+        if bucket_name:  # bucket requested
+            return s3.get_bucket(bucket_name)
+        return s3.get_all_buckets()[0]  # default to first bucket
+
+    def list_prefixes(self, prefix, delimiter='/', bucket=None):
+        """Return the names of the 'directories' just below prefix,
+        e.g. list_prefixes('HCP/') -> ['HCP/100307/', ...].
+
+        boto pages through the listing; callers can split a large listing
+        into several prefixes and list them concurrently.
+        """
+        buck = self._get_bucket(self._connect(), bucket)
+        return [key.name for key in buck.list(prefix=prefix,
+                                              delimiter=delimiter)
+                if key.name.endswith(delimiter)]
+
+    def fetch(self, files, force=False, check=False, verbose=1):
+        files = Fetcher.reformat_files(files)  # allows flexibility
+        with instrumentation.timed('fetch', data_dir=self.data_dir,
+                                   n_files=len(files)):
+            return self._fetch(files, force=force, check=check,
+                               verbose=verbose)
+
+    def _fetch(self, files, force=False, check=False, verbose=1):
+        with instrumentation.timed('connect', url='s3://'):
+            s3 = self._connect()
 
         bucket_names = np.unique([opts.get('bucket') for f, rk, opts in files])
         files_ = []
         for bucket_name in bucket_names:  # loop over bucket names: efficient
-            if bucket_name:  # bucket requested
-                buck = s3.get_bucket(bucket_name)
-            else:  # default to first bucket
-                buck = s3.get_all_buckets()[0]
+            buck = self._get_bucket(s3, bucket_name)
 
             for file_, remote_key, opts in files:
                 if opts.get('bucket') != bucket_name:
@@ -75,8 +113,16 @@ class AmazonS3Fetcher(Fetcher):
                                 bucket_name or 'default bucket',
                                 remote_key,
                                 target_file))
-                        with open(target_file, 'wb') as fp:
-                            key.get_contents_to_file(fp, cb=partial(test_cb, t0=time.time()), num_cb=None)
+                        url = 's3://%s/%s' % (buck.name, remote_key)
+                        with instrumentation.timed('transfer', url=url,
+                                                   file=target_file,
+                                                   offset=0) as event:
+                            t_transfer = time.time()
+                            with open(target_file, 'wb') as fp:
+                                key.get_contents_to_file(fp, cb=partial(test_cb, t0=time.time()), num_cb=None)
+                            event['bytes'] = os.path.getsize(target_file)
+                            event['throughput'] = event['bytes'] / max(
+                                time.time() - t_transfer, 1e-6)
 
                     files_.append(target_file)
         return files_
@@ -18,6 +18,8 @@ import fnmatch
 import warnings
 import re
 import base64
+import json
+import threading
 
 import numpy as np
 from scipy import ndimage
@@ -62,6 +64,63 @@ def readmd5_sum_file(path):
     return hashes
 
 
+class DigestStore(object):
+    """ MD5 sums of the files of a data directory.
+
+    Sums are stored (in .nidata_digests.json) with the size and modification
+    time of the files: a file is hashed again only if it changed.
+    """
+    filename = '.nidata_digests.json'
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.path = os.path.join(data_dir, self.filename)
+        self.digests = dict()
+        self._dirty = False
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as fp:
+                    self.digests = json.load(fp)
+            except (IOError, OSError, ValueError):
+                pass
+
+    def _key(self, path):
+        return os.path.relpath(path, self.data_dir)
+
+    @staticmethod
+    def _stat(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime]
+
+    def record(self, path, md5sum):
+        """ Store the MD5 sum of a file, e.g. a verified download. """
+        with self._lock:
+            self.digests[self._key(path)] = self._stat(path) + [md5sum]
+            self._dirty = True
+
+    def md5_sum_file(self, path):
+        """ MD5 sum of a file, hashed only if unknown or changed. """
+        with self._lock:
+            digest = self.digests.get(self._key(path))
+        if digest is not None and digest[:2] == self._stat(path):
+            return digest[2]
+        md5sum = md5_sum_file(path)
+        self.record(path, md5sum)
+        return md5sum
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                with open(self.path, 'w') as fp:
+                    json.dump(self.digests, fp)
+                self._dirty = False
+            except (IOError, OSError):
+                pass
+
+
 def readlinkabs(link):
     """
     Return an absolute path for the destination
@@ -4,6 +4,7 @@
 import contextlib
 import collections
 import os
+import random
 import tarfile
 import zipfile
 import sys
@@ -11,10 +12,13 @@ import shutil
 import time
 import hashlib
 import fnmatch
+import json
 import warnings
 import re
 import base64
 from functools import partial
+from multiprocessing.pool import ThreadPool
+import threading
 
 import nibabel as nib
 import numpy as np
@@ -22,7 +26,15 @@ from scipy import ndimage
 from sklearn.datasets.base import Bunch
 
 from .._utils.compat import _basestring, BytesIO, cPickle, _urllib, md5_hash
-from .base import chunk_report, Fetcher
+from .._utils.cache_manager import parse_size
+from . import instrumentation
+from .admission import DiskAdmission, RateLimiter, disk_free, format_size
+from .base import chunk_report, md5_sum_file, DigestStore, Fetcher
+
+
+# Moves of fetched files into a data directory shared by threads are
+# serialized: movetree checks then creates destination directories.
+_movetree_lock = threading.Lock()
 
 
 def movetree(src, dst):
@@ -91,7 +103,7 @@ def _tree(path, pattern=None, dictionary=False):
 
 
 def _chunk_read_(response, local_file, chunk_size=8192, report_hook=None,
-                 initial_size=0, total_size=None, verbose=1):
+                 initial_size=0, total_size=None, verbose=1, throttle=None):
     """Download a file chunk by chunk and show advancement
 
     Parameters
@@ -117,10 +129,13 @@ def _chunk_read_(response, local_file, chunk_size=8192, report_hook=None,
     verbose: int, optional
         verbosity level (0 means no message).
 
+    throttle: callable, optional
+        Called with the size of each chunk read, e.g. to cap the bandwidth.
+
     Returns
     -------
-    data: string
-        The downloaded file.
+    n_bytes: int
+        Number of bytes downloaded.
 
     """
     if total_size is None:
@@ -146,13 +161,84 @@ def _chunk_read_(response, local_file, chunk_size=8192, report_hook=None,
             break
 
         local_file.write(chunk)
+        if throttle is not None:
+            throttle(len(chunk))
         if report_hook:
             chunk_report(bytes_so_far, total_size, initial_size, t0)
 
-    return
+    return bytes_so_far - initial_size
+
+
+def _members_index_file(file_):
+    """Path of the member index stored alongside an archive."""
+    return file_ + '.members.json'
+
+
+def _load_members_index(file_):
+    """Return the [name, offset, size] list of the members of a tar archive,
+    as stored by _extract_tar_members, or None if missing or outdated."""
+    index_file = _members_index_file(file_)
+    if not os.path.exists(index_file):
+        return None
+    try:
+        with open(index_file, 'r') as fp:
+            index = json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
+    stat = os.stat(file_)
+    if index.get('archive_stat') != [stat.st_size, stat.st_mtime]:
+        return None
+    return index['members']
+
+
+def _is_selected(name, members):
+    return not members.isdisjoint(name.split('/'))
+
+
+def _extract_tar_members(file_, data_dir, members, verbose=1):
+    """Extract the members of a tar archive having one of the given names
+    as a path component (e.g. session directories).
+
+    The archive is streamed without being uncompressed to disk. The first
+    pass stores the offset of every member alongside the archive, so that
+    later calls seek straight to the selected members instead of scanning
+    the whole archive.
+    """
+    members = set(members)
+    index = _load_members_index(file_)
+    n_extracted = 0
+    with contextlib.closing(tarfile.open(file_, 'r')) as tar:
+        if index is not None:
+            for entry in index:
+                name, offset = entry[:2]
+                if not _is_selected(name, members):
+                    continue
+                # Offsets are increasing: uncompressed-stream seeks only go
+                # forward.
+                tar.fileobj.seek(offset)
+                tar.extract(tarfile.TarInfo.fromtarfile(tar), path=data_dir)
+                n_extracted += 1
+        else:
+            index = []
+            tarinfo = tar.next()
+            while tarinfo is not None:
+                index.append([tarinfo.name, tarinfo.offset, tarinfo.size])
+                if _is_selected(tarinfo.name, members):
+                    tar.extract(tarinfo, path=data_dir)
+                    n_extracted += 1
+                tarinfo = tar.next()
+            stat = os.stat(file_)
+            try:
+                with open(_members_index_file(file_), 'w') as fp:
+                    json.dump(dict(archive_stat=[stat.st_size, stat.st_mtime],
+                                   members=index), fp)
+            except (IOError, OSError):
+                pass
+    if verbose > 0:
+        print('   %d of %d members extracted.' % (n_extracted, len(index)))
 
 
-def _uncompress_file(file_, delete_archive=True, verbose=1):
+def _uncompress_file(file_, delete_archive=True, members=None, verbose=1):
     """Uncompress files contained in a data_set.
 
     Parameters
@@ -164,6 +250,10 @@ def _uncompress_file(file_, delete_archive=True, verbose=1):
         Whether or not to delete archive once it is uncompressed.
         Default: True
 
+    members: collection of strings, optional
+        For tar archives, extract only the members having one of these
+        names as a path component (see _extract_tar_members).
+
     verbose: int, optional
         verbosity level (0 means no message).
 
@@ -171,9 +261,22 @@ def _uncompress_file(file_, delete_archive=True, verbose=1):
     -----
     This handles zip, tar, gzip and bzip files only.
     """
+    with instrumentation.timed('extract', file=file_):
+        _uncompress(file_, delete_archive=delete_archive, members=members,
+                    verbose=verbose)
+
+
+def _uncompress(file_, delete_archive=True, members=None, verbose=1):
     if verbose > 0:
         print('Extracting data from %s...' % file_)
     data_dir = os.path.dirname(file_)
+    if members is not None and tarfile.is_tarfile(file_):
+        _extract_tar_members(file_, data_dir, members, verbose=verbose)
+        if delete_archive:
+            os.remove(file_)
+            if os.path.exists(_members_index_file(file_)):
+                os.remove(_members_index_file(file_))
+        return
     # We first try to see if it is a zip file
     try:
         filename, ext = os.path.splitext(file_)
@@ -219,9 +322,139 @@ def _uncompress_file(file_, delete_archive=True, verbose=1):
         raise
 
 
+class MirrorRanking(object):
+    """Throughput of the hosts serving files, to rank mirrors.
+
+    Throughputs are moving averages of the measured download speeds; a
+    failure halves the throughput of a host. Hosts never measured are tried
+    as if they were as fast as the fastest one.
+    """
+    def __init__(self):
+        self.throughputs = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _host(url):
+        return _urllib.parse.urlparse(url).netloc
+
+    def record(self, url, throughput):
+        host = self._host(url)
+        with self._lock:
+            previous = self.throughputs.get(host)
+            self.throughputs[host] = (throughput if previous is None
+                                      else 0.7 * previous + 0.3 * throughput)
+
+    def failed(self, url):
+        host = self._host(url)
+        with self._lock:
+            self.throughputs[host] = self.throughputs.get(host, 0.) / 2.
+
+    def rank(self, urls):
+        """Sort urls by decreasing throughput of their host (stable)."""
+        with self._lock:
+            best = max(list(self.throughputs.values()) + [0.])
+            speeds = [self.throughputs.get(self._host(url), best)
+                      for url in urls]
+        order = sorted(range(len(urls)), key=lambda i: -speeds[i])
+        return [urls[i] for i in order]
+
+
+# Shared by the fetchers of the process: mirrors measured by one fetch are
+# ranked for the next ones.
+_mirror_ranking = MirrorRanking()
+
+
+def _mirror_urls(url, mirrors=None):
+    """The url and its mirrors.
+
+    mirrors maps url prefixes to the prefixes of their mirrors, e.g.
+    {'https://s3.amazonaws.com/fcp-indi/': ['https://fcp-indi.s3.amazonaws.com/']}
+    """
+    urls = [url]
+    for prefix, mirror_prefixes in (mirrors or dict()).items():
+        if url.startswith(prefix):
+            urls += [mirror + url[len(prefix):] for mirror in mirror_prefixes
+                     if mirror + url[len(prefix):] not in urls]
+    return urls
+
+
+def _is_transient(error):
+    """Whether a failed download is worth retrying."""
+    if isinstance(error, _urllib.error.HTTPError):
+        return error.code in (408, 429) or error.code >= 500
+    return isinstance(error, (_urllib.error.URLError, IOError, OSError,
+                              EOFError))
+
+
+def _download(url, temp_full_name, resume=True, handlers=(), headers=None,
+              verbose=1, throttle=None):
+    """Download url into temp_full_name, appending to the partial download
+    found there if resume is True.
+
+    Raises IOError if the connection is closed before the end of the file.
+    """
+    def open_(offset):
+        request = _urllib.request.Request(url)
+        request.add_header('Connection', 'Keep-Alive')
+        for header_name, header_val in headers.items():
+            request.add_header(header_name, header_val)
+        if offset:
+            # Only download the remainder
+            request.add_header("Range", "bytes=%s-" % offset)
+        with instrumentation.timed('connect', url=url):
+            return url_opener.open(request)
+    url_opener = _urllib.request.build_opener(*handlers)
+
+    initial_size = 0
+    if resume and os.path.exists(temp_full_name):
+        initial_size = os.path.getsize(temp_full_name)
+    if initial_size:
+        instrumentation.emit('resume', url=url, offset=initial_size)
+    try:
+        data = open_(initial_size)
+    except _urllib.error.HTTPError as e:
+        # The partial download cannot be resumed (e.g. 416 for a .part
+        # that is complete or longer than the file): start it again.
+        if not initial_size or _is_transient(e):
+            raise
+        if verbose > 0:
+            print('Resuming failed, downloading the whole file.')
+        initial_size = 0
+        data = open_(initial_size)
+    try:
+        if initial_size:
+            content_range = data.info().get('Content-Range')
+            if (content_range is None or not content_range.startswith(
+                    'bytes %s-' % initial_size)):
+                # The server sends the whole file
+                if verbose > 0:
+                    print('Resuming failed, downloading the whole file.')
+                initial_size = 0
+        expected_size = data.info().get('Content-Length')
+        with open(temp_full_name, 'ab' if initial_size else 'wb') as local_file:
+            with instrumentation.timed('transfer', url=url,
+                                       file=temp_full_name,
+                                       offset=initial_size) as event:
+                t_transfer = time.time()
+                event['bytes'] = _chunk_read_(data, local_file,
+                                              report_hook=(verbose > 0),
+                                              initial_size=initial_size,
+                                              verbose=verbose,
+                                              throttle=throttle)
+                event['throughput'] = event['bytes'] / max(
+                    time.time() - t_transfer, 1e-6)
+                _mirror_ranking.record(url, event['throughput'])
+    finally:
+        data.close()
+    if expected_size is not None and event['bytes'] < int(expected_size):
+        raise IOError('Connection closed after %d of %s bytes of %s'
+                      % (event['bytes'], expected_size, url))
+
+
 def _fetch_file(url, data_dir, resume=True, overwrite=False,
                 md5sum=None, username=None, passwd=None,
-                handlers=None, headers=None, cookies=None, verbose=1):
+                handlers=None, headers=None, cookies=None, mirrors=None,
+                retries=3, backoff=1., throttle=None, verbose=1):
     """Load requested file, downloading it if needed or requested.
 
     Parameters
@@ -256,6 +489,22 @@ def _fetch_file(url, data_dir, resume=True, overwrite=False,
 
     cookies: dictionary, specifying cookies
 
+    mirrors: dictionary, optional
+        Prefixes of mirrors of urls, by url prefix (see _mirror_urls). The
+        url and its mirrors are tried by decreasing measured throughput.
+
+    retries: int, optional
+        Number of times transient failures (connection errors, server
+        errors, downloads cut short) are retried, with exponential backoff.
+        Retries resume the partial download, from any mirror.
+
+    backoff: float, optional
+        Delay before the first retry, in seconds; doubled at each retry,
+        with a random jitter.
+
+    throttle: callable, optional
+        Called with the size of each downloaded chunk (see RateLimiter).
+
     verbose: int, optional
         verbosity level (0 means no message).
 
@@ -263,16 +512,13 @@ def _fetch_file(url, data_dir, resume=True, overwrite=False,
     -------
     files: string
         Absolute path of downloaded file.
-
-    Notes
-    -----
-    If, for any reason, the download procedure fails, all downloaded files are
-    removed.
     """
     if handlers is None:
         handlers = []
     if headers is None:
-        headers = dict(),
+        headers = dict()
+    else:
+        headers = dict(headers)
     if cookies is None:
         cookies = dict()
 
@@ -280,7 +526,7 @@ def _fetch_file(url, data_dir, resume=True, overwrite=False,
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
 
-    # Determine filename using URL
+    # Determine filename using URL; mirrors share the partial download.
     parse = _urllib.parse.urlparse(url)
     file_name = os.path.basename(parse.path)
     if file_name == '':
@@ -298,102 +544,207 @@ def _fetch_file(url, data_dir, resume=True, overwrite=False,
         if overwrite:
             os.remove(temp_full_name)
     t0 = time.time()
-    local_file = None
-    initial_size = 0
 
-    try:
-        # Download data
-        if username:
+    urls = _mirror_urls(url, mirrors)
+    if username:
+        for url_ in urls:
             # Make sure we're secure, basic auth is unencrypted
-            if parse.scheme and parse.scheme != 'https':
-                raise ValueError('Specifying username currently requires using a secure (https) URL (%s).' % url)
-            password_mgr = _urllib.request.HTTPPasswordMgrWithDefaultRealm()
-            password_mgr.add_password(None, url, username, passwd)
-            # Don't append, don't want to update caller's list with this!
-            handlers = [_urllib.request.HTTPBasicAuthHandler(password_mgr)] + handlers
-        url_opener = _urllib.request.build_opener(*handlers)
-
-        # Prep the request (add headers, cookies)
-        request = _urllib.request.Request(url)
-        request.add_header('Connection', 'Keep-Alive')
-        if cookies:
-            if 'Cookie' in headers:
-                headers['Cookie'] += ';'
-            else:
-                headers['Cookie'] = ''
-            headers['Cookie'] += ';'.join(['%s=%s' % (k, v) for k, v in cookies.items()])
-        for header_name, header_val in headers.items():
-            request.add_header(header_name, header_val)
-
-        if verbose > 0:
-            displayed_url = url.split('?')[0] if verbose == 1 else url
-            print('Downloading data from %s ...' % displayed_url)
-        if not resume or not os.path.exists(temp_full_name):
-            # Simple case: no resume
-            data = url_opener.open(request)
-            local_file = open(temp_full_name, "wb")
+            scheme = _urllib.parse.urlparse(url_).scheme
+            if scheme and scheme != 'https':
+                raise ValueError('Specifying username currently requires using a secure (https) URL (%s).' % url_)
+        password_mgr = _urllib.request.HTTPPasswordMgrWithDefaultRealm()
+        for url_ in urls:
+            password_mgr.add_password(None, url_, username, passwd)
+        # Don't append, don't want to update caller's list with this!
+        handlers = [_urllib.request.HTTPBasicAuthHandler(password_mgr)] + handlers
+    if cookies:
+        if 'Cookie' in headers:
+            headers['Cookie'] += ';'
         else:
-            # Complex case: download has been interrupted, we try to resume it.
-            local_file_size = os.path.getsize(temp_full_name)
-            # If the file exists, then only download the remainder
-            request.add_header("Range", "bytes=%s-" % (local_file_size))
+            headers['Cookie'] = ''
+        headers['Cookie'] += ';'.join(['%s=%s' % (k, v) for k, v in cookies.items()])
+
+    error = None
+    for attempt in range(retries + 1):
+        if attempt:
+            delay = backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            if verbose > 0:
+                print('Retrying in %.1fs (%s)' % (delay, error))
+            instrumentation.emit('retry', url=url, reason=repr(error),
+                                 attempt=attempt)
+            time.sleep(delay)
+        for url_ in _mirror_ranking.rank(urls):
+            if verbose > 0:
+                displayed_url = url_.split('?')[0] if verbose == 1 else url_
+                print('Downloading data from %s ...' % displayed_url)
             try:
-                data = url_opener.open(request)
-                content_range = data.info().get('Content-Range')
-                if (content_range is None or not content_range.startswith(
-                        'bytes %s-' % local_file_size)):
-                    raise IOError('Server does not support resuming')
-            except Exception as ex:
-                # A wide number of errors can be raised here. HTTPError,
-                # URLError... I prefer to catch them all and rerun without
-                # resuming.
-                if verbose > 0:
-                    print('Resuming failed, try to download the whole file.')
-                return _fetch_file(
-                    url, data_dir, resume=False, overwrite=overwrite,
-                    md5sum=md5sum, username=username, passwd=passwd,
-                    handlers=handlers, headers=headers, cookies=cookies,
-                    verbose=verbose)
-            else:
-                local_file = open(temp_full_name, "ab")
-                initial_size = local_file_size
-
-        # Download the file.
-        _chunk_read_(data, local_file, report_hook=(verbose > 0),
-                     initial_size=initial_size, verbose=verbose)
-
-        # temp file must be closed prior to the move
-        if not local_file.closed:
-            local_file.close()
-        shutil.move(temp_full_name, full_name)
-        dt = time.time() - t0
-        if verbose > 0:
-            print('...done. (%i seconds, %i min)' % (dt, dt // 60))
-    except _urllib.error.HTTPError as e:
-        if verbose > 0:
-            print('Error while fetching file %s. Dataset fetching aborted.' %
-                   (file_name))
-        if verbose > 1:
-            print("HTTP Error: %s, %s" % (e, url))
-        raise
-    except _urllib.error.URLError as e:
+                _download(url_, temp_full_name, resume=resume or attempt > 0,
+                          handlers=handlers, headers=headers,
+                          verbose=verbose, throttle=throttle)
+            except Exception as e:
+                if url_.startswith('file:'):  # local files: nothing to retry
+                    raise
+                if not _is_transient(e) and len(urls) == 1:
+                    if verbose > 0:
+                        print('Error while fetching file %s. Dataset '
+                              'fetching aborted.' % file_name)
+                    if verbose > 1:
+                        print("Error: %s, %s" % (e, url_))
+                    raise
+                error = e
+                _mirror_ranking.failed(url_)
+                continue
+            error = None
+            break
+        if error is None or not _is_transient(error):
+            break
+    if error is not None:
         if verbose > 0:
             print('Error while fetching file %s. Dataset fetching aborted.' %
-                   (file_name))
-        if verbose > 1:
-            print("URL Error: %s, %s" % (e, url))
-        raise
-    finally:
-        if local_file is not None and not local_file.closed:
-            local_file.close()
+                  (file_name))
+        raise error
+
+    shutil.move(temp_full_name, full_name)
+    dt = time.time() - t0
+    if verbose > 0:
+        print('...done. (%i seconds, %i min)' % (dt, dt // 60))
     if md5sum is not None:
-        if (md5_sum_file(full_name) != md5sum):
+        with instrumentation.timed('verify', file=full_name) as event:
+            event['ok'] = md5_sum_file(full_name) == md5sum
+        if not event['ok']:
             raise ValueError("File %s checksum verification has failed."
-                             " Dataset fetching aborted." % local_file)
+                             " Dataset fetching aborted." % full_name)
     return full_name
 
 
-def fetch_files(data_dir, files, resume=True, force=False, verbose=1, delete_archive=True):
+def _fetch_target(data_dir, file_, url, opts, resume=True, force=False,
+                  verbose=1, delete_archive=True, check=False, digests=None,
+                  mirrors=None, retries=3, throttle=None):
+    """Fetch one target file of fetch_files, return its path."""
+    # There are two working directories here:
+    # - data_dir is the destination directory of the dataset
+    # - temp_dir is a temporary directory dedicated to this fetching call. All
+    #   files that must be downloaded will be in this directory. If a corrupted
+    #   file is found, or a file is missing, this working directory will be
+    #   deleted.
+    files_pickle = cPickle.dumps(url)
+    files_md5 = hashlib.md5(files_pickle).hexdigest()
+    temp_dir = os.path.join(data_dir, files_md5)
+
+    # 3 possibilities:
+    # - the file exists in data_dir, nothing to do.
+    # - the file does not exists: we download it in temp_dir
+    # - the file exists in temp_dir: this can happen if an archive has been
+    #   downloaded. There is nothing to do
+
+    # Target file in the data_dir
+    target_file = os.path.join(data_dir, file_)
+    md5sum = opts.get('md5sum')
+
+    if (check and not force and md5sum is not None and digests is not None
+            and not opts.get('uncompress') and os.path.exists(target_file)):
+        with instrumentation.timed('verify', file=target_file) as event:
+            event['ok'] = digests.md5_sum_file(target_file) == md5sum
+        if not event['ok']:
+            if verbose > 0:
+                print('File %s is corrupted, fetching it again.'
+                      % target_file)
+            os.remove(target_file)
+
+    if force or not os.path.exists(target_file):
+        # if not os.path.exists(temp_target_dir):
+        #     os.makedirs(temp_target_dir)
+        # Reuse an archive kept by a previous call (delete_archive=False),
+        # along with its member index.
+        kept_archive = os.path.join(
+            data_dir, os.path.basename(_urllib.parse.urlparse(url).path))
+        if (not force and opts.get('uncompress')
+                and os.path.isfile(kept_archive)):
+            if not os.path.exists(temp_dir):
+                os.makedirs(temp_dir)
+            for kept_file in (kept_archive,
+                              _members_index_file(kept_archive)):
+                if os.path.exists(kept_file):
+                    shutil.move(kept_file, temp_dir)
+        # Fetch the file, if it doesn't already exist.
+        fetched_file = _fetch_file(url, temp_dir,
+                                   resume=resume,
+                                   overwrite=force,
+                                   verbose=verbose,
+                                   md5sum=opts.get('md5sum'),
+                                   username=opts.get('username'),
+                                   passwd=opts.get('passwd'),
+                                   handlers=opts.get('handlers', []),
+                                   headers=opts.get('headers', dict()),
+                                   cookies=opts.get('cookies', dict()),
+                                   mirrors=mirrors, retries=retries,
+                                   throttle=throttle)
+
+        # First, uncompress.
+        if opts.get('uncompress'):
+            target_files = _uncompress_file(fetched_file, verbose=verbose,
+                                            delete_archive=False,
+                                            members=opts.get('members'))
+        else:
+            target_files = [fetched_file]
+
+        if opts.get('move'):
+            raise NotImplementedError('Move options has been removed. Sorry!')
+
+            # XXX: here, move is supposed to be a dir, it can be a name
+            move = os.path.join(temp_dir, opts['move'])
+
+            if len(target_files) > 1:
+                target_files = [os.path.join(os.path.dirname(move),
+                                     os.path.basename(f))
+                                for f in target_files]
+                # Do the move
+            else:
+                if not os.path.exists(move_dir):
+                    os.makedirs(move_dir)
+                shutil.move(fetched_file, move)
+                target_files = [move]
+            temp_target_file = move
+
+        # Let's examine our work: archives are uncompressed into
+        # temp_dir, other files are moved to their target.
+        if (not opts.get('uncompress') and not os.path.exists(target_file)
+                and os.path.exists(fetched_file)):
+            target_dir = os.path.dirname(target_file)
+            with _movetree_lock:
+                if not os.path.exists(target_dir):
+                    os.makedirs(target_dir)
+            shutil.move(fetched_file, target_file)
+
+        if opts.get('uncompress') and delete_archive:
+            os.remove(fetched_file)
+            if os.path.exists(_members_index_file(fetched_file)):
+                os.remove(_members_index_file(fetched_file))
+
+        # If needed, move files from temps directory to final directory.
+        if os.path.exists(temp_dir):
+            #XXX We could only moved the files requested
+            #XXX Movetree can go wrong
+            with _movetree_lock:
+                movetree(temp_dir, data_dir)
+            shutil.rmtree(temp_dir)
+
+        if not os.path.exists(target_file):
+            raise Exception("An error occurred while fetching %s; the expected target file cannot be found. (%s)\nDebug info: %s" % (
+                file_, target_file,
+                {'fetched_file': fetched_file, 'target_files': target_files}))
+
+        if (md5sum is not None and digests is not None
+                and not opts.get('uncompress')):
+            # The download was verified against md5sum.
+            digests.record(target_file, md5sum)
+
+    return target_file
+
+
+def fetch_files(data_dir, files, resume=True, force=False, verbose=1, delete_archive=True,
+                n_jobs=1, check=False, mirrors=None, retries=3,
+                disk_budget=None, max_bandwidth=None, uncompress_ratio=2.):
     """Load requested dataset, downloading it if needed or requested.
 
     This function retrieves files from the hard drive or download them from
@@ -429,6 +780,38 @@ def fetch_files(data_dir, files, resume=True, force=False, verbose=1, delete_arc
     verbose: int, optional
         verbosity level (0 means no message).
 
+    n_jobs: int, optional
+        Number of urls fetched at once, by threads.
+
+    check: bool, optional
+        If true, verify the MD5 sum of existing files ('md5sum' option), and
+        fetch them again if they do not match. Sums are stored in the data
+        directory: unchanged files are not hashed again.
+
+    mirrors: dict, optional
+        Prefixes of mirrors of urls, by url prefix. Files are downloaded
+        from the url or mirror with the best measured throughput, and from
+        the others if it fails.
+
+    retries: int, optional
+        Number of times the download of a file is retried after transient
+        failures, resuming the partial download.
+
+    disk_budget: int or string, optional
+        Disk space that the fetch can use, e.g. '50G', or 'free' for the
+        free space of the data directory (which also caps any budget). The
+        sizes of the files are requested first (HEAD); the fetch fails
+        before downloading anything if they do not fit, and downloads only
+        start when their peak footprint (archive and extracted files) fits
+        next to the others. Default: no check.
+
+    max_bandwidth: int or string, optional
+        Cap of the aggregate download rate, in bytes per second, e.g. '10M'.
+
+    uncompress_ratio: float, optional
+        Estimated size of extracted files relative to the size of their
+        archive, for archives whose members are not known yet.
+
     Returns
     -------
     files: list of string
@@ -445,90 +828,193 @@ def fetch_files(data_dir, files, resume=True, force=False, verbose=1, delete_arc
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
 
-    files_ = []
-    for file_, url, opts in files:
-        # There are two working directories here:
-        # - data_dir is the destination directory of the dataset
-        # - temp_dir is a temporary directory dedicated to this fetching call. All
-        #   files that must be downloaded will be in this directory. If a corrupted
-        #   file is found, or a file is missing, this working directory will be
-        #   deleted.
-        files_pickle = cPickle.dumps(url)
-        files_md5 = hashlib.md5(files_pickle).hexdigest()
-        temp_dir = os.path.join(data_dir, files_md5)
-
-        # 3 possibilities:
-        # - the file exists in data_dir, nothing to do.
-        # - the file does not exists: we download it in temp_dir
-        # - the file exists in temp_dir: this can happen if an archive has been
-        #   downloaded. There is nothing to do
-
-        # Target file in the data_dir
-        target_file = os.path.join(data_dir, file_)
-
-        if force or not os.path.exists(target_file):
-            # if not os.path.exists(temp_target_dir):
-            #     os.makedirs(temp_target_dir)
-            # Fetch the file, if it doesn't already exist.
-            fetched_file = _fetch_file(url, temp_dir,
-                                       resume=resume,
-                                       overwrite=force,
-                                       verbose=verbose,
-                                       md5sum=opts.get('md5sum'),
-                                       username=opts.get('username'),
-                                       passwd=opts.get('passwd'),
-                                       handlers=opts.get('handlers', []),
-                                       headers=opts.get('headers', dict()),
-                                       cookies=opts.get('cookies', dict()))
-
-            # First, uncompress.
-            if opts.get('uncompress'):
-                target_files = _uncompress_file(fetched_file, verbose=verbose, delete_archive=False)
-            else:
-                target_files = [fetched_file]
-
-            if opts.get('move'):
-                raise NotImplementedError('Move options has been removed. Sorry!')
-
-                # XXX: here, move is supposed to be a dir, it can be a name
-                move = os.path.join(temp_dir, opts['move'])
-
-                if len(target_files) > 1:
-                    target_files = [os.path.join(os.path.dirname(move),
-                                         os.path.basename(f))
-                                    for f in target_files]
-                    # Do the move
-                else:
-                    if not os.path.exists(move_dir):
-                        os.makedirs(move_dir)
-                    shutil.move(fetched_file, move)
-                    target_files = [move]
-                temp_target_file = move
-
-            # Let's examine our work
-            if not os.path.exists(target_file):
-                if os.path.exists(fetched_file):
-                    target_dir = os.path.dirname(target_file)
-                    if not os.path.exists(target_dir):
-                        os.makedirs(target_dir)
-                    shutil.move(fetched_file, target_file)
-                else:
-                    raise Exception("An error occurred while fetching %s; the expected target file cannot be found. (%s)\nDebug info: %s" % (
-                        file_, target_file,
-                        {'fetched_file': fetched_file, 'target_files': target_files}))
-
-            if opts.get('uncompress') and delete_archive:
-                os.remove(fetched_file)
-
-            # If needed, move files from temps directory to final directory.
-            if os.path.exists(temp_dir):
-                #XXX We could only moved the files requested
-                #XXX Movetree can go wrong
-                movetree(temp_dir, data_dir)
-                shutil.rmtree(temp_dir)
-
-        files_.append(target_file)
-
+    digests = DigestStore(data_dir)
+    with instrumentation.timed('fetch', data_dir=data_dir,
+                               n_files=len(files)):
+        return _fetch_files(data_dir, files, digests, resume=resume,
+                            force=force, verbose=verbose,
+                            delete_archive=delete_archive, n_jobs=n_jobs,
+                            check=check, mirrors=mirrors, retries=retries,
+                            disk_budget=disk_budget,
+                            max_bandwidth=max_bandwidth,
+                            uncompress_ratio=uncompress_ratio)
+
+
+def _remote_size(url, opts):
+    """Size of the file at url, from the headers of its response (HEAD
+    request for HTTP), or None if unknown."""
+    request = _urllib.request.Request(url)
+    if _urllib.parse.urlparse(url).scheme in ('http', 'https'):
+        request.get_method = lambda: 'HEAD'
+    headers = dict(opts.get('headers', dict()))
+    if opts.get('cookies'):
+        headers['Cookie'] = ';'.join(['%s=%s' % (k, v) for k, v
+                                      in opts['cookies'].items()])
+    for header_name, header_val in headers.items():
+        request.add_header(header_name, header_val)
+    try:
+        response = _urllib.request.build_opener(
+            *opts.get('handlers', [])).open(request)
+    except Exception:
+        return None
+    try:
+        size = response.info().get('Content-Length')
+    finally:
+        response.close()
+    return None if size is None else int(size)
+
+
+def _members_size(archive, members=None):
+    """Total size of (the selected) members of an archive, or None if it
+    cannot be known without reading the archive."""
+    if zipfile.is_zipfile(archive):
+        with contextlib.closing(zipfile.ZipFile(archive)) as z:
+            return sum(info.file_size for info in z.infolist()
+                       if members is None
+                       or _is_selected(info.filename, set(members)))
+    index = _load_members_index(archive)
+    if index is None or any(len(entry) < 3 for entry in index):
+        return None
+    return sum(entry[2] for entry in index
+               if members is None or _is_selected(entry[0], set(members)))
+
+
+def _plan_footprints(data_dir, files, groups, force=False,
+                     delete_archive=True, uncompress_ratio=2., n_jobs=1,
+                     verbose=1):
+    """Return the (peak, final) disk footprints of the url groups to fetch.
+
+    Archives kept in data_dir are measured from their members; the size of
+    other files is requested to their server.
+    """
+    todo = collections.OrderedDict()
+    for url, indices in groups.items():
+        opts = files[indices[0]][2]
+        if force or not all(os.path.exists(os.path.join(data_dir,
+                                                         files[i][0]))
+                            for i in indices):
+            todo[url] = opts
+    kept_archives = dict(
+        (url, os.path.join(data_dir, os.path.basename(
+            _urllib.parse.urlparse(url).path)))
+        for url, opts in todo.items() if opts.get('uncompress'))
+    kept_archives = dict((url, archive) for url, archive
+                         in kept_archives.items()
+                         if not force and os.path.isfile(archive))
+    remote = [url for url in todo if url not in kept_archives]
+    pool = ThreadPool(max(1, min(n_jobs, len(remote), 8)))
+    try:
+        sizes = dict(zip(remote, pool.map(
+            lambda url: _remote_size(url, todo[url]), remote)))
+    finally:
+        pool.close()
+    unknown = [url for url in remote if sizes[url] is None]
+    if unknown:
+        warnings.warn('The size of %d of the %d files to fetch is unknown; '
+                      'they are not accounted for in the disk budget.'
+                      % (len(unknown), len(todo)))
+
+    footprints = dict()
+    for url, opts in todo.items():
+        if url in kept_archives:
+            download = 0
+            archive = os.path.getsize(kept_archives[url])
+            extracted = _members_size(kept_archives[url],
+                                      opts.get('members'))
+        else:
+            archive = sizes[url] or 0
+            # A partial download only needs its remainder
+            parse = _urllib.parse.urlparse(url)
+            part = os.path.join(
+                data_dir, hashlib.md5(cPickle.dumps(url)).hexdigest(),
+                (os.path.basename(parse.path) or md5_hash(parse.path))
+                + '.part')
+            download = archive
+            if not force and os.path.exists(part):
+                download = max(archive - os.path.getsize(part), 0)
+            extracted = None
+        if not opts.get('uncompress'):
+            footprints[url] = (download, download)
+            continue
+        if extracted is None:
+            extracted = int(archive * uncompress_ratio)
+        footprints[url] = (download + extracted,
+                           extracted + (0 if delete_archive else download))
+    return footprints
+
+
+def _fetch_files(data_dir, files, digests, resume=True, force=False,
+                 verbose=1, delete_archive=True, n_jobs=1, check=False,
+                 mirrors=None, retries=3, disk_budget=None,
+                 max_bandwidth=None, uncompress_ratio=2.):
+    throttle = None
+    if max_bandwidth is not None:
+        throttle = RateLimiter(parse_size(max_bandwidth)).throttle
+    try:
+        if n_jobs == 1 and disk_budget is None:
+            return [_fetch_target(data_dir, file_, url, opts, resume=resume,
+                                  force=force, verbose=verbose,
+                                  delete_archive=delete_archive,
+                                  check=check, digests=digests,
+                                  mirrors=mirrors, retries=retries,
+                                  throttle=throttle)
+                    for file_, url, opts in files]
+
+        # Files sharing an url (e.g. the files of an archive) are fetched in
+        # turn by the same thread; distinct urls are fetched concurrently.
+        groups = collections.OrderedDict()
+        for i, (file_, url, opts) in enumerate(files):
+            groups.setdefault(url, []).append(i)
+
+        admission, footprints = None, dict()
+        if disk_budget is not None:
+            budget = disk_free(data_dir)
+            if disk_budget != 'free':
+                budget = min(parse_size(disk_budget), budget)
+            footprints = _plan_footprints(
+                data_dir, files, groups, force=force,
+                delete_archive=delete_archive,
+                uncompress_ratio=uncompress_ratio, n_jobs=n_jobs,
+                verbose=verbose)
+            total = sum(final for _, final in footprints.values())
+            if verbose > 0 and footprints:
+                print('Fetching %d urls: about %s on disk (budget: %s)' % (
+                    len(footprints), format_size(total),
+                    format_size(budget)))
+            if total > budget:
+                raise IOError('Not enough disk space in %s: the files to '
+                              'fetch need about %s, the budget is %s.' % (
+                                  data_dir, format_size(total),
+                                  format_size(budget)))
+            admission = DiskAdmission(budget)
+
+        def fetch_group(url):
+            footprint = footprints.get(url)
+            if footprint is not None:
+                admission.acquire(footprint[0], name=url)
+            try:
+                return [_fetch_target(data_dir, *files[i], resume=resume,
+                                      force=force, verbose=verbose,
+                                      delete_archive=delete_archive,
+                                      check=check, digests=digests,
+                                      mirrors=mirrors, retries=retries,
+                                      throttle=throttle)
+                        for i in groups[url]]
+            finally:
+                if footprint is not None:
+                    admission.release(*footprint)
+
+        pool = ThreadPool(min(n_jobs, len(groups)))
+        try:
+            fetched = pool.map(fetch_group, list(groups))
+        finally:
+            pool.close()
+    finally:
+        digests.save()
+    files_ = [None] * len(files)
+    for indices, targets in zip(groups.values(), fetched):
+        for i, target_file in zip(indices, targets):
+            files_[i] = target_file
     return files_
 
 
@@ -564,17 +1050,44 @@ def copytree(src, dst, symlinks=False, ignore=None):
 
 
 class HttpFetcher(Fetcher):
+    """Fetcher of files over HTTP(S).
+
+    Parameters
+    ----------
+    mirrors: dict, optional
+        Prefixes of mirrors of urls, by url prefix (see fetch_files).
+
+    retries: int, optional
+        Number of times a download is retried after transient failures.
+
+    disk_budget: int or string, optional
+        Disk space that a fetch can use (see fetch_files).
+
+    max_bandwidth: int or string, optional
+        Cap of the download rate of a fetch, in bytes per second.
+    """
 
-    def __init__(self, data_dir=None, username=None, passwd=None):
+    def __init__(self, data_dir=None, username=None, passwd=None,
+                 mirrors=None, retries=3, disk_budget=None,
+                 max_bandwidth=None):
         super(HttpFetcher, self).__init__(data_dir=data_dir)
         self.username = username
         self.passwd = passwd
+        self.mirrors = dict(mirrors or dict())
+        self.retries = retries
+        self.disk_budget = disk_budget
+        self.max_bandwidth = max_bandwidth
 
-    def fetch(self, files, force=False, resume=True, check=False, verbose=1, delete_archive=True):
+    def fetch(self, files, force=False, resume=True, check=False, verbose=1, delete_archive=True,
+              n_jobs=1):
         files = self.reformat_files(files)  # allows flexibility
         if self.username is not None:
             for tgt, src, opts in files:
                 opts['username'] = opts.get('username', self.username)
                 opts['passwd'] = opts.get('passwd', self.username)
 
-        return fetch_files(self.data_dir, files, resume=resume, force=force, verbose=verbose, delete_archive=delete_archive)
+        return fetch_files(self.data_dir, files, resume=resume, force=force, verbose=verbose,
+                           delete_archive=delete_archive, n_jobs=n_jobs, check=check,
+                           mirrors=self.mirrors, retries=self.retries,
+                           disk_budget=self.disk_budget,
+                           max_bandwidth=self.max_bandwidth)
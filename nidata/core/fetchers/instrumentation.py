@@ -0,0 +1,148 @@
+"""
+Structured events of the fetchers, for monitoring bulk downloads
+
+Fetchers emit an event (a dict) for each step of the fetching of a file:
+
+- 'connect': request sent until the response headers are received (name
+  resolution, connection and server latency), with 'url'
+- 'transfer': download of a file, with 'url', 'file', 'bytes' (bytes moved),
+  'offset' (resume offset) and 'throughput' (bytes per second)
+- 'resume': resuming of a partial download, with 'url' and 'offset'
+- 'retry': download started again, with 'url' and 'reason'
+- 'verify': MD5 sum check, with 'file' and 'ok'
+- 'extract': uncompression of an archive, with 'file'
+- 'fetch': a whole fetch() call, with 'n_files'
+- 'admit': wait for disk space (see admission), with 'name' and 'peak'
+
+Timed events carry their 'duration' in seconds, and 'error' if the step
+failed. Events are passed to listeners registered with add_listener; when
+there is none, emitting an event costs a test.
+
+Examples
+--------
+>>> from nidata.core.fetchers import instrumentation
+>>> sink = instrumentation.JsonLinesSink('fetch_events.jsonl')
+>>> instrumentation.add_listener(sink)
+>>> dataset.fetch()
+>>> instrumentation.remove_listener(sink)
+"""
+# License: simplified BSD
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+_listeners = []
+_lock = threading.Lock()
+
+
+def add_listener(callback):
+    """Register a callable receiving every event (a dict)."""
+    with _lock:
+        _listeners.append(callback)
+
+
+def remove_listener(callback):
+    with _lock:
+        _listeners.remove(callback)
+
+
+def enabled():
+    """Whether events are listened to."""
+    return bool(_listeners)
+
+
+def emit(event, **fields):
+    """Pass an event to the listeners."""
+    if not _listeners:
+        return
+    fields['event'] = event
+    fields.setdefault('time', time.time())
+    fields.setdefault('thread', threading.current_thread().name)
+    for callback in list(_listeners):
+        callback(fields)
+
+
+@contextlib.contextmanager
+def timed(event, **fields):
+    """Emit an event with the duration of the block.
+
+    The block can add fields to the event through the yielded dict.
+    """
+    t0 = time.time()
+    try:
+        yield fields
+    except BaseException as e:
+        fields['error'] = repr(e)
+        raise
+    finally:
+        emit(event, time=t0, duration=time.time() - t0, **fields)
+
+
+class JsonLinesSink(object):
+    """Listener appending events to a file, one JSON object per line."""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as fp:
+                fp.write(line)
+
+
+class PrometheusTextfileSink(object):
+    """Listener aggregating events into Prometheus metrics, written to a
+    file in the text format (e.g. for the node exporter textfile collector).
+
+    Metrics are nidata_fetch_events_total, nidata_fetch_seconds_total and
+    nidata_fetch_errors_total, by event, and nidata_fetch_bytes_total. The
+    file is replaced atomically after each event.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.events = dict()
+        self.seconds = dict()
+        self.errors = dict()
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        name = event['event']
+        with self._lock:
+            self.events[name] = self.events.get(name, 0) + 1
+            if 'duration' in event:
+                self.seconds[name] = (self.seconds.get(name, 0.)
+                                      + event['duration'])
+            if 'error' in event:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            if name == 'transfer':
+                self.bytes += event.get('bytes', 0)
+            self.write()
+
+    def _lines(self):
+        lines = []
+        for metric, values, help_ in (
+                ('nidata_fetch_events_total', self.events,
+                 'Number of fetch events.'),
+                ('nidata_fetch_seconds_total', self.seconds,
+                 'Time spent in fetch events.'),
+                ('nidata_fetch_errors_total', self.errors,
+                 'Number of failed fetch events.')):
+            lines += ['# HELP %s %s' % (metric, help_),
+                      '# TYPE %s counter' % metric]
+            lines += ['%s{event="%s"} %s' % (metric, name, values[name])
+                      for name in sorted(values)]
+        lines += ['# HELP nidata_fetch_bytes_total Bytes downloaded.',
+                  '# TYPE nidata_fetch_bytes_total counter',
+                  'nidata_fetch_bytes_total %d' % self.bytes]
+        return lines
+
+    def write(self):
+        temp_path = self.path + '.part'
+        with open(temp_path, 'w') as fp:
+            fp.write('\n'.join(self._lines()) + '\n')
+        os.rename(temp_path, self.path)
@@ -56,19 +56,20 @@ class mock_request(object):
 
 def wrap_chunk_read_(_chunk_read_):
     def mock_chunk_read_(response, local_file, initial_size=0, chunk_size=8192,
-                         report_hook=None, verbose=0):
+                         report_hook=None, verbose=0, **kwargs):
         if not isinstance(response, _basestring):
             return _chunk_read_(response, local_file,
                                 initial_size=initial_size,
                                 chunk_size=chunk_size,
-                                report_hook=report_hook, verbose=verbose)
+                                report_hook=report_hook, verbose=verbose,
+                                **kwargs)
         return response
     return mock_chunk_read_
 
 
 def mock_chunk_read_raise_error_(response, local_file, initial_size=0,
                                  chunk_size=8192, report_hook=None,
-                                 verbose=0):
+                                 verbose=0, **kwargs):
     raise _urllib.errors.HTTPError("url", 418, "I'm a teapot", None, None)
 
 
@@ -11,6 +11,7 @@ import numpy as np
 import zipfile
 import tarfile
 import gzip
+import threading
 from tempfile import mkdtemp, mkstemp
 
 import nibabel
@@ -281,3 +282,283 @@ def test_uncompress():
     shutil.rmtree(dtemp)
 
     os.remove(temp)
+
+
+def test_uncompress_members():
+    from nidata.core.fetchers.http_fetcher import (_uncompress_file,
+                                                   _members_index_file)
+    dtemp = mkdtemp()
+    ztemp = os.path.join(dtemp, 'test.tgz')
+    with contextlib.closing(tarfile.open(ztemp, 'w:gz')) as tar:
+        for session in ('ses001', 'ses002', 'ses003'):
+            fd, temp = mkstemp()
+            os.close(fd)
+            tar.add(temp, arcname='ds/%s/bold.nii.gz' % session)
+            os.remove(temp)
+    _uncompress_file(ztemp, members=['ses002'], delete_archive=False,
+                     verbose=0)
+    assert_equal(os.listdir(os.path.join(dtemp, 'ds')), ['ses002'])
+    assert_true(os.path.exists(_members_index_file(ztemp)))
+
+    # The member index is used to extract other sessions later on.
+    _uncompress_file(ztemp, members=['ses001', 'ses003'], verbose=0)
+    assert_equal(sorted(os.listdir(os.path.join(dtemp, 'ds'))),
+                 ['ses001', 'ses002', 'ses003'])
+    assert_true(os.path.exists(os.path.join(dtemp, 'ds', 'ses003',
+                                            'bold.nii.gz')))
+    assert_false(os.path.exists(ztemp))
+    assert_false(os.path.exists(_members_index_file(ztemp)))
+    shutil.rmtree(dtemp)
+
+
+@with_setup(setup_tmpdata, teardown_tmpdata)
+def test_fetch_files_n_jobs():
+    # Archives are fetched concurrently, files keep their order.
+    src_dir = os.path.join(get_tmpdir(), 'src')
+    data_dir = os.path.join(get_tmpdir(), 'data')
+    os.makedirs(src_dir)
+    os.makedirs(data_dir)
+    files = []
+    for contrast in range(3):
+        archive = os.path.join(src_dir, 'contrast%d.zip' % contrast)
+        with contextlib.closing(zipfile.ZipFile(archive, 'w')) as testzip:
+            for subject in range(4):
+                testzip.writestr('data/S%02d/c%d.nii.gz'
+                                 % (subject, contrast), 'x')
+        files += [('data/S%02d/c%d.nii.gz' % (subject, contrast),
+                   'file://' + archive, {'uncompress': True})
+                  for subject in range(4)]
+    fetched = fetchers.http_fetcher.fetch_files(data_dir, files, verbose=0,
+                                                n_jobs=3)
+    assert_equal(fetched, [os.path.join(data_dir, f[0]) for f in files])
+    assert_true(all(os.path.exists(f) for f in fetched))
+
+
+@with_setup(setup_tmpdata, teardown_tmpdata)
+def test_fetch_files_check():
+    src_file = os.path.join(get_tmpdir(), 'src.txt')
+    data_dir = os.path.join(get_tmpdir(), 'data')
+    os.makedirs(data_dir)
+    with open(src_file, 'w') as fp:
+        fp.write('abcd')
+    md5sum = fetchers.md5_sum_file(src_file)
+    files = [('dst.txt', 'file://' + src_file, {'md5sum': md5sum})]
+    fetched, = fetchers.http_fetcher.fetch_files(data_dir, files, verbose=0,
+                                                 check=True)
+    digests = fetchers.DigestStore(data_dir)
+    assert_equal(digests.digests['dst.txt'][2], md5sum)
+
+    # A corrupted file is fetched again.
+    with open(fetched, 'w') as fp:
+        fp.write('abc')
+    fetchers.http_fetcher.fetch_files(data_dir, files, verbose=0, check=True)
+    with open(fetched) as fp:
+        assert_equal(fp.read(), 'abcd')
+
+
+@with_setup(setup_tmpdata, teardown_tmpdata)
+def test_instrumentation():
+    from nidata.core.fetchers import instrumentation
+    src_dir = os.path.join(get_tmpdir(), 'src')
+    data_dir = os.path.join(get_tmpdir(), 'data')
+    os.makedirs(src_dir)
+    os.makedirs(data_dir)
+    src_file = os.path.join(src_dir, 'src.txt')
+    with open(src_file, 'w') as fp:
+        fp.write('abcd')
+    archive = os.path.join(src_dir, 'archive.zip')
+    with contextlib.closing(zipfile.ZipFile(archive, 'w')) as testzip:
+        testzip.writestr('data/a.txt', 'x')
+    files = [('dst.txt', 'file://' + src_file,
+              {'md5sum': fetchers.md5_sum_file(src_file)}),
+             ('data/a.txt', 'file://' + archive, {'uncompress': True})]
+
+    events = []
+    prom_file = os.path.join(get_tmpdir(), 'nidata.prom')
+    jsonl_file = os.path.join(get_tmpdir(), 'events.jsonl')
+    listeners = [events.append,
+                 instrumentation.PrometheusTextfileSink(prom_file),
+                 instrumentation.JsonLinesSink(jsonl_file)]
+    for listener in listeners:
+        instrumentation.add_listener(listener)
+    try:
+        fetchers.http_fetcher.fetch_files(data_dir, files, verbose=0)
+    finally:
+        for listener in listeners:
+            instrumentation.remove_listener(listener)
+    assert_false(instrumentation.enabled())
+
+    assert_equal([e['event'] for e in events],
+                 ['connect', 'transfer', 'verify',
+                  'connect', 'transfer', 'extract', 'fetch'])
+    transfer = events[1]
+    assert_equal(transfer['bytes'], 4)
+    assert_equal(transfer['offset'], 0)
+    assert_true(transfer['duration'] >= 0)
+    assert_true(events[2]['ok'])
+    with open(jsonl_file) as fp:
+        assert_equal(len(fp.readlines()), len(events))
+    with open(prom_file) as fp:
+        metrics = fp.read()
+    assert_true('nidata_fetch_events_total{event="transfer"} 2' in metrics)
+    assert_true('nidata_fetch_bytes_total %d'
+                % (4 + os.path.getsize(archive)) in metrics)
+
+
+class _FlakyServer(object):
+    """Local HTTP server of one file, failing the first requests.
+
+    failures lists the failure of each request until it succeeds: 'cut'
+    sends half of the file, an int is returned as HTTP error code.
+    """
+    def __init__(self, body, failures=()):
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+        except ImportError:  # Python 2
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        self.failures = list(failures)
+        self.ranges = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                failure = server.failures.pop(0) if server.failures else None
+                range_ = self.headers.get('Range')
+                server.ranges.append(range_)
+                if failure not in (None, 'cut'):
+                    self.send_response(failure)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                start = int(range_[6:-1]) if range_ else 0
+                self.send_response(206 if range_ else 200)
+                if range_:
+                    self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                        start, len(body) - 1, len(body)))
+                self.send_header('Content-Length', str(len(body) - start))
+                self.end_headers()
+                if failure == 'cut':
+                    self.wfile.write(body[start:len(body) // 2])
+                else:
+                    self.wfile.write(body[start:])
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@with_setup(setup_tmpdata, teardown_tmpdata)
+def test_fetch_file_retry():
+    from nidata.core.fetchers import http_fetcher
+    body = np.random.RandomState(0).bytes(100000)
+    # A cut download is resumed from where it stopped.
+    server = _FlakyServer(body, failures=['cut', 503])
+    try:
+        fetched = http_fetcher._fetch_file(server.url + 'data.bin',
+                                           get_tmpdir(), backoff=0.01,
+                                           verbose=0)
+    finally:
+        server.close()
+    with open(fetched, 'rb') as fp:
+        assert_equal(fp.read(), body)
+    assert_equal(server.ranges, [None, 'bytes=50000-', 'bytes=50000-'])
+
+    # Partial downloads that cannot be resumed are downloaded again.
+    with open(os.path.join(get_tmpdir(), 'data3.bin.part'), 'wb') as fp:
+        fp.write(body)
+    server = _FlakyServer(body, failures=[416])
+    try:
+        fetched = http_fetcher._fetch_file(server.url + 'data3.bin',
+                                           get_tmpdir(), verbose=0)
+    finally:
+        server.close()
+    with open(fetched, 'rb') as fp:
+        assert_equal(fp.read(), body)
+    assert_equal(server.ranges, ['bytes=100000-', None])
+
+    # Without retries, failures are raised
+    server = _FlakyServer(body, failures=[503])
+    try:
+        assert_raises(Exception, http_fetcher._fetch_file,
+                      server.url + 'data2.bin', get_tmpdir(), retries=0,
+                      verbose=0)
+    finally:
+        server.close()
+
+
+@with_setup(setup_tmpdata, teardown_tmpdata)
+def test_fetch_file_mirrors():
+    from nidata.core.fetchers import http_fetcher
+    body = b'mirrored'
+    primary = _FlakyServer(body, failures=[503] * 10)
+    mirror = _FlakyServer(body)
+    try:
+        mirrors = {primary.url: [mirror.url]}
+        fetched = http_fetcher._fetch_file(primary.url + 'data.bin',
+                                           get_tmpdir(), mirrors=mirrors,
+                                           retries=0, verbose=0)
+        with open(fetched, 'rb') as fp:
+            assert_equal(fp.read(), body)
+        assert_equal(len(primary.ranges), 1)
+
+        # The mirror is now ranked first.
+        http_fetcher._fetch_file(primary.url + 'data2.bin', get_tmpdir(),
+                                 mirrors=mirrors, retries=0, verbose=0)
+        assert_equal(len(primary.ranges), 1)
+        assert_equal(len(mirror.ranges), 2)
+    finally:
+        primary.close()
+        mirror.close()
+
+
+@with_setup(setup_tmpdata, teardown_tmpdata)
+def test_fetch_files_disk_budget():
+    from nidata.core.fetchers import admission
+    src_dir = os.path.join(get_tmpdir(), 'src')
+    data_dir = os.path.join(get_tmpdir(), 'data')
+    os.makedirs(src_dir)
+    os.makedirs(data_dir)
+    archive = os.path.join(src_dir, 'data.zip')
+    with contextlib.closing(zipfile.ZipFile(archive, 'w')) as testzip:
+        testzip.writestr('data/a.txt', 'x' * 1000)
+    files = [('data/a.txt', 'file://' + archive, {'uncompress': True})]
+
+    # Too small a budget fails before downloading anything.
+    assert_raises(IOError, fetchers.http_fetcher.fetch_files, data_dir,
+                  files, verbose=0, disk_budget=100)
+    assert_equal(os.listdir(data_dir), [])
+    fetched, = fetchers.http_fetcher.fetch_files(data_dir, files, verbose=0,
+                                                 disk_budget='1M')
+    assert_true(os.path.exists(fetched))
+
+    # Downloads wait for the space released by the others.
+    budget = admission.DiskAdmission(100)
+    budget.acquire(80)
+    assert_raises(IOError, budget.acquire, 200)
+    thread = threading.Thread(target=budget.acquire, args=(50,))
+    thread.start()
+    thread.join(0.2)
+    assert_true(thread.is_alive())
+    budget.release(80, 40)
+    thread.join(5)
+    assert_false(thread.is_alive())
+    assert_equal(budget.committed + budget.in_flight, 90)
+
+
+def test_rate_limiter():
+    import time
+    from nidata.core.fetchers import admission
+    limiter = admission.RateLimiter(10000)
+    t0 = time.time()
+    for _ in range(5):
+        limiter.throttle(1000)
+    assert_true(time.time() - t0 >= 0.4)
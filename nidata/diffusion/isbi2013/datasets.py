@@ -0,0 +1,48 @@
+# *- encoding: utf-8 -*-
+"""
+Utilities to download the ISBI 2013 2-shell phantom dataset
+"""
+# License: simplified BSD
+
+from ...core.datasets import DiffusionDataset
+
+
+class Isbi2013Dataset(DiffusionDataset):
+    """Download and load a 2-shell software phantom dataset (20MB).
+
+    Returns
+    -------
+    data: sklearn.datasets.base.Bunch
+        dictionary-like object, contains:
+        - "dwi": path of the diffusion weighted image
+        - "bvals", "bvecs": paths of the b-values and b-vectors
+    """
+    dependencies = ['dipy']
+    url = 'https://dl.dropboxusercontent.com/u/2481924/isbi2013_merlet/'
+    files = (
+        ('dwi', 'phantom64.nii.gz', url + '2shells-1500-2500-N64-SNR-30.nii.gz',
+         '42911a70f232321cf246315192d69c42'),
+        ('bvals', 'phantom64.bval', url + '2shells-1500-2500-N64.bval',
+         '90e8cf66e0f4d9737a3b3c0da24df5ea'),
+        ('bvecs', 'phantom64.bvec', url + '2shells-1500-2500-N64.bvec',
+         '4b7aa2757a1ccab140667b76e8075cb1'))
+
+
+def fetch_isbi2013_2shell(data_dir=None, resume=True, verbose=1):
+    """ Download a 2-shell software phantom dataset
+    """
+    return Isbi2013Dataset(data_dir=data_dir).fetch(resume=resume,
+                                                    verbose=verbose)
+
+
+def read_isbi2013_2shell(data_dir=None):
+    """ Load ISBI 2013 2-shell synthetic dataset
+
+    Returns
+    -------
+    img : obj,
+        Nifti1Image
+    gtab : obj,
+        GradientTable
+    """
+    return Isbi2013Dataset(data_dir=data_dir).read()
@@ -0,0 +1,77 @@
+# *- encoding: utf-8 -*-
+"""
+Utilities to download the SCIL b=0 multi-site dataset
+"""
+# License: simplified BSD
+
+import os
+
+import nibabel as nib
+from sklearn.datasets.base import Bunch
+
+from ...core.datasets import DiffusionDataset
+
+
+class ScilB0Dataset(DiffusionDataset):
+    """Download and load b=0 datasets from multiple MR systems (GE, Philips,
+    Siemens) and different magnetic fields (1.5T and 3T) (9.2MB).
+
+    Returns
+    -------
+    data: sklearn.datasets.base.Bunch
+        dictionary-like object, contains:
+        - "b0": dictionary of the paths of the b0 images, by
+          (field, company), e.g. ('3T', 'GE')
+    """
+    url = ('http://scil.dinf.usherbrooke.ca/wp-content/data/'
+           'datasets_multi-site_all_companies.zip')
+    folder = 'datasets_multi-site_all_companies'
+
+    def fetch(self, keys=None, resume=True, force=False, check=True,
+              n_jobs=4, verbose=1):
+        # A single archive, of b0 images only: there is no file to select
+        # or verify.
+        folder, = self.fetcher.fetch(
+            [(self.folder, self.url, {'uncompress': True})],
+            resume=resume, force=force, verbose=verbose)
+        b0 = dict()
+        for field in sorted(os.listdir(folder)):
+            if not os.path.isdir(os.path.join(folder, field)):
+                continue
+            for company in sorted(os.listdir(os.path.join(folder, field))):
+                b0_file = os.path.join(folder, field, company, 'b0.nii.gz')
+                if os.path.exists(b0_file):
+                    b0[(field, company)] = b0_file
+        return Bunch(b0=b0)
+
+
+def fetch_scil_b0(data_dir=None, resume=True, verbose=1):
+    """ Download b=0 datasets from multiple MR systems (GE, Philips, Siemens) and
+        different magnetic fields (1.5T and 3T)
+    """
+    return ScilB0Dataset(data_dir=data_dir).fetch(resume=resume,
+                                                  verbose=verbose)
+
+
+def read_scil_b0(data_dir=None):
+    """ Load GE 3T b0 image form the scil b0 dataset.
+
+    Returns
+    -------
+    img : obj,
+        Nifti1Image
+    """
+    data = fetch_scil_b0(data_dir=data_dir, verbose=0)
+    return nib.load(data.b0[('3T', 'GE')])
+
+
+def read_siemens_scil_b0(data_dir=None):
+    """ Load Siemens 1.5T b0 image form the scil b0 dataset.
+
+    Returns
+    -------
+    img : obj,
+        Nifti1Image
+    """
+    data = fetch_scil_b0(data_dir=data_dir, verbose=0)
+    return nib.load(data.b0[('1.5T', 'Siemens')])
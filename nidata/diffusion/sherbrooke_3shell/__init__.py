@@ -0,0 +1 @@
+from .datasets import *
\ No newline at end of file
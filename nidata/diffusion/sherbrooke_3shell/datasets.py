@@ -0,0 +1,49 @@
+# *- encoding: utf-8 -*-
+"""
+Utilities to download the Sherbrooke 3-shell HARDI dataset
+"""
+# License: simplified BSD
+
+from ...core.datasets import DiffusionDataset
+
+
+class Sherbrooke3shellDataset(DiffusionDataset):
+    """Download and load a 3-shell HARDI dataset with 192 gradient
+    directions (184MB).
+
+    Returns
+    -------
+    data: sklearn.datasets.base.Bunch
+        dictionary-like object, contains:
+        - "dwi": path of the diffusion weighted image
+        - "bvals", "bvecs": paths of the b-values and b-vectors
+    """
+    dependencies = ['dipy']
+    url = 'https://dl.dropboxusercontent.com/u/2481924/sherbrooke_data/'
+    files = (
+        ('dwi', 'HARDI193.nii.gz', url + '3shells-1000-2000-3500-N193.nii.gz',
+         '0b735e8f16695a37bfbd66aab136eb66'),
+        ('bvals', 'HARDI193.bval', url + '3shells-1000-2000-3500-N193.bval',
+         'e9b9bb56252503ea49d31fb30a0ac637'),
+        ('bvecs', 'HARDI193.bvec', url + '3shells-1000-2000-3500-N193.bvec',
+         '0c83f7e8b917cd677ad58a078658ebb7'))
+
+
+def fetch_sherbrooke_3shell(data_dir=None, resume=True, verbose=1):
+    """ Download a 3shell HARDI dataset with 192 gradient directions
+    """
+    return Sherbrooke3shellDataset(data_dir=data_dir).fetch(resume=resume,
+                                                            verbose=verbose)
+
+
+def read_sherbrooke_3shell(data_dir=None):
+    """ Load Sherbrooke 3-shell HARDI dataset
+
+    Returns
+    -------
+    img : obj,
+        Nifti1Image
+    gtab : obj,
+        GradientTable
+    """
+    return Sherbrooke3shellDataset(data_dir=data_dir).read()
@@ -0,0 +1,117 @@
+# *- encoding: utf-8 -*-
+"""
+Utilities to download the Stanford HARDI dataset
+"""
+# License: simplified BSD
+
+import nibabel as nib
+
+from ...core.datasets import DiffusionDataset
+
+
+class StanfordHardiDataset(DiffusionDataset):
+    """Download and load a HARDI dataset with 160 gradient directions
+    (87MB), with a T1 image, its tissue maps, and a reduced freesurfer
+    aparc image.
+
+    Returns
+    -------
+    data: sklearn.datasets.base.Bunch
+        dictionary-like object, contains:
+        - "dwi": path of the diffusion weighted image
+        - "bvals", "bvecs": paths of the b-values and b-vectors
+        - "labels", "label_info": paths of the aparc image and of its labels
+        - "t1": path of the T1 image
+        - "pve_csf", "pve_gm", "pve_wm": paths of the tissue maps
+    """
+    dependencies = ['dipy']
+    url = 'https://stacks.stanford.edu/file/druid:yx282xq2090/'
+    files = (
+        ('dwi', 'HARDI150.nii.gz', url + 'dwi.nii.gz',
+         '0b18513b46132b4d1051ed3364f2acbc'),
+        ('bvals', 'HARDI150.bval', url + 'dwi.bvals',
+         '4e08ee9e2b1d2ec3fddb68c70ae23c36'),
+        ('bvecs', 'HARDI150.bvec', url + 'dwi.bvecs',
+         '4c63a586f29afc6a48a5809524a76cb4'),
+        ('labels', 'aparc-reduced.nii.gz', url + 'aparc-reduced.nii.gz',
+         '742de90090d06e687ce486f680f6d71a'),
+        ('label_info', 'label-info.txt', url + 'label_info.txt',
+         '39db9f0f5e173d7a2c2e51b07d5d711b'),
+        ('t1', 't1.nii.gz', url + 't1.nii.gz',
+         'a6a140da6a947d4131b2368752951b0a'),
+        ('pve_csf', 'pve_csf.nii.gz', url + 'pve_csf.nii.gz',
+         '2c498e4fed32bca7f726e28aa86e9c18'),
+        ('pve_gm', 'pve_gm.nii.gz', url + 'pve_gm.nii.gz',
+         '1654b20aeb35fc2734a0d7928b713874'),
+        ('pve_wm', 'pve_wm.nii.gz', url + 'pve_wm.nii.gz',
+         '2e244983cf92aaf9f9d37bc7716b37d5'))
+
+
+def fetch_stanford_hardi(data_dir=None, resume=True, verbose=1):
+    """ Download a HARDI dataset with 160 gradient directions
+    """
+    return StanfordHardiDataset(data_dir=data_dir).fetch(
+        keys=['dwi', 'bvals', 'bvecs'], resume=resume, verbose=verbose)
+
+
+def read_stanford_hardi(data_dir=None):
+    """ Load Stanford HARDI dataset
+
+    Returns
+    -------
+    img : obj,
+        Nifti1Image
+    gtab : obj,
+        GradientTable
+    """
+    return StanfordHardiDataset(data_dir=data_dir).read()
+
+
+def _fetch_files(keys, data_dir=None, resume=True, verbose=1):
+    """Fetch some files of the dataset.
+
+    Returns them as (files, folder), with the (url, md5) of the files by
+    file name, as the functions that fetched them returned.
+    """
+    dataset = StanfordHardiDataset(data_dir=data_dir)
+    dataset.fetch(keys=keys, resume=resume, verbose=verbose)
+    files = dict((name, (url, md5)) for key, name, url, md5 in dataset.files
+                 if key in keys)
+    return files, dataset.data_dir
+
+
+def fetch_stanford_labels(data_dir=None, resume=True, verbose=1):
+    """Download reduced freesurfer aparc image from stanford web site."""
+    return _fetch_files(['labels', 'label_info'], data_dir=data_dir,
+                        resume=resume, verbose=verbose)
+
+
+def read_stanford_labels(data_dir=None):
+    """Read stanford hardi data and label map"""
+    dataset = StanfordHardiDataset(data_dir=data_dir)
+    hard_img, gtab = dataset.read()
+    labels_img = nib.load(dataset.fetch(keys=['labels', 'label_info'],
+                                        verbose=0).labels)
+    return hard_img, gtab, labels_img
+
+
+def fetch_stanford_t1(data_dir=None, resume=True, verbose=1):
+    return _fetch_files(['t1'], data_dir=data_dir, resume=resume,
+                        verbose=verbose)
+
+
+def read_stanford_t1(data_dir=None):
+    dataset = StanfordHardiDataset(data_dir=data_dir)
+    return nib.load(dataset.fetch(keys=['t1'], verbose=0).t1)
+
+
+def fetch_stanford_pve_maps(data_dir=None, resume=True, verbose=1):
+    return _fetch_files(['pve_csf', 'pve_gm', 'pve_wm'], data_dir=data_dir,
+                        resume=resume, verbose=verbose)
+
+
+def read_stanford_pve_maps(data_dir=None):
+    dataset = StanfordHardiDataset(data_dir=data_dir)
+    data = dataset.fetch(keys=['pve_csf', 'pve_gm', 'pve_wm'], verbose=0)
+    return (nib.load(data.pve_csf), nib.load(data.pve_gm),
+            nib.load(data.pve_wm))
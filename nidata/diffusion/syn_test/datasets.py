@@ -0,0 +1,48 @@
+# *- encoding: utf-8 -*-
+"""
+Utilities to download t1 and b0 volumes from the same session
+"""
+# License: simplified BSD
+
+import nibabel as nib
+
+from ...core.datasets import DiffusionDataset
+
+
+class SynTestDataset(DiffusionDataset):
+    """Download and load t1 and b0 volumes from the same session (12MB).
+
+    Returns
+    -------
+    data: sklearn.datasets.base.Bunch
+        dictionary-like object, contains:
+        - "t1": path of the T1 image
+        - "b0": path of the b0 image
+    """
+    url = 'https://dl.dropboxusercontent.com/u/5918983/'
+    files = (
+        ('t1', 't1.nii.gz', url + 't1.nii.gz',
+         '701bda02bb769655c7d4a9b1df2b73a6'),
+        ('b0', 'b0.nii.gz', url + 'b0.nii.gz',
+         'e4b741f0c77b6039e67abb2885c97a78'))
+
+
+def fetch_syn_data(data_dir=None, resume=True, verbose=1):
+    """ Download t1 and b0 volumes from the same session
+    """
+    return SynTestDataset(data_dir=data_dir).fetch(resume=resume,
+                                                   verbose=verbose)
+
+
+def read_syn_data(data_dir=None):
+    """ Load t1 and b0 volumes from the same session
+
+    Returns
+    -------
+    t1 : obj,
+        Nifti1Image
+    b0 : obj,
+        Nifti1Image
+    """
+    data = fetch_syn_data(data_dir=data_dir, verbose=0)
+    return nib.load(data.t1), nib.load(data.b0)
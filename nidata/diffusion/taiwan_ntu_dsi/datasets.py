@@ -0,0 +1,67 @@
+# *- encoding: utf-8 -*-
+"""
+Utilities to download the Taiwan NTU DSI dataset
+"""
+# License: simplified BSD
+
+from ...core.datasets import DiffusionDataset
+
+
+class TaiwanNtuDsiDataset(DiffusionDataset):
+    """Download and load a DSI dataset with 203 gradient directions (91MB).
+
+    See DSI203_license.txt for the license. For the complete datasets,
+    please visit http://dsi-studio.labsolver.org
+
+    Returns
+    -------
+    data: sklearn.datasets.base.Bunch
+        dictionary-like object, contains:
+        - "dwi": path of the diffusion weighted image
+        - "bvals", "bvecs": paths of the b-values and b-vectors
+        - "license": path of the license of the dataset
+    """
+    dependencies = ['dipy']
+    url = 'http://dl.dropbox.com/u/2481924/'
+    files = (
+        ('dwi', 'DSI203.nii.gz', url + 'taiwan_ntu_dsi.nii.gz',
+         '950408c0980a7154cb188666a885a91f'),
+        ('bvals', 'DSI203.bval', url + 'tawian_ntu_dsi.bval',
+         '602e5cb5fad2e7163e8025011d8a6755'),
+        ('bvecs', 'DSI203.bvec', url + 'taiwan_ntu_dsi.bvec',
+         'a95eb1be44748c20214dc7aa654f9e6b'),
+        ('license', 'DSI203_license.txt', url + 'license_taiwan_ntu_dsi.txt',
+         '7fa1d5e272533e832cc7453eeba23f44'))
+    # The b-vectors of the dataset are not unit vectors.
+    normalize_bvecs = True
+
+    def fetch(self, keys=None, resume=True, force=False, check=True,
+              n_jobs=4, verbose=1):
+        data = super(TaiwanNtuDsiDataset, self).fetch(
+            keys=keys, resume=resume, force=force, check=check,
+            n_jobs=n_jobs, verbose=verbose)
+        if verbose > 0:
+            print('See DSI203_license.txt for LICENSE.')
+            print('For the complete datasets please visit :')
+            print('http://dsi-studio.labsolver.org')
+        return data
+
+
+def fetch_taiwan_ntu_dsi(data_dir=None, resume=True, verbose=1):
+    """ Download a DSI dataset with 203 gradient directions
+    """
+    return TaiwanNtuDsiDataset(data_dir=data_dir).fetch(resume=resume,
+                                                        verbose=verbose)
+
+
+def read_taiwan_ntu_dsi(data_dir=None):
+    """ Load Taiwan NTU dataset
+
+    Returns
+    -------
+    img : obj,
+        Nifti1Image
+    gtab : obj,
+        GradientTable
+    """
+    return TaiwanNtuDsiDataset(data_dir=data_dir).read()
@@ -0,0 +1,105 @@
+"""
+Test the diffusion datasets
+"""
+# License: simplified BSD
+
+import os
+
+import nibabel
+import numpy as np
+from nose import with_setup
+from nose.tools import assert_equal, assert_true, assert_raises
+
+from nidata.core.datasets import DiffusionDataset
+from nidata.core.fetchers import md5_sum_file
+from nidata.core.fetchers.tests.test_fetchers import (setup_tmpdata,
+                                                      teardown_tmpdata,
+                                                      get_tmpdir)
+
+
+def _local_dataset(src_dir, data_dir, bvals, bvecs, dwi=None):
+    """A DiffusionDataset of local files."""
+    os.makedirs(src_dir)
+    sources = dict(dwi='dwi.nii.gz', bvals='dwi.bval', bvecs='dwi.bvec')
+    if dwi is None:
+        dwi = np.zeros((2, 2, 2, len(bvals)), dtype=np.float32)
+    nibabel.save(nibabel.Nifti1Image(dwi, np.eye(4)),
+                 os.path.join(src_dir, sources['dwi']))
+    np.savetxt(os.path.join(src_dir, sources['bvals']), bvals[np.newaxis])
+    np.savetxt(os.path.join(src_dir, sources['bvecs']), bvecs.T)
+
+    class LocalDiffusionDataset(DiffusionDataset):
+        normalize_bvecs = True
+        files = [(key, 'local' + name[len('dwi'):],
+                  'file://' + os.path.join(src_dir, name),
+                  md5_sum_file(os.path.join(src_dir, name)))
+                 for key, name in sources.items()]
+    return LocalDiffusionDataset(data_dir=data_dir)
+
+
+BVALS = np.array([0, 1000, 5, 2010, 990, 1990, 1005])
+BVECS = np.array([[0, 0, 0], [2, 0, 0], [0, 0, 0], [0, 3, 0],
+                  [0, 0, 1], [1, 1, 0], [0, 0, 4]], dtype=float)
+
+
+@with_setup(setup_tmpdata, teardown_tmpdata)
+def test_gradients():
+    bvals = BVALS
+    data_dir = os.path.join(get_tmpdir(), 'data')
+    os.makedirs(data_dir)
+    dataset = _local_dataset(os.path.join(get_tmpdir(), 'src'), data_dir,
+                             bvals, BVECS)
+    gradients = dataset.gradients()
+    np.testing.assert_array_equal(gradients.b0_mask, bvals <= 50)
+    np.testing.assert_array_equal(gradients.shell_index,
+                                  [0, 1, 0, 2, 1, 2, 1])
+    np.testing.assert_array_almost_equal(gradients.shells, [0, 998.3333, 2000],
+                                         decimal=3)
+    norms = np.sqrt(np.sum(gradients.bvecs ** 2, axis=1))
+    np.testing.assert_array_almost_equal(norms, [0, 1, 0, 1, 1, 1, 1])
+    cache_file = os.path.join(dataset.data_dir, 'gradients.npz')
+    assert_true(os.path.exists(cache_file))
+
+    # The cached table is used while the files are unchanged...
+    mtime = os.stat(cache_file).st_mtime
+    dataset.fetch = None  # files are neither fetched nor verified
+    np.testing.assert_array_equal(dataset.gradients().bvals, bvals)
+    assert_equal(os.stat(cache_file).st_mtime, mtime)
+
+    # ... and computed again otherwise.
+    del dataset.fetch
+    os.remove(os.path.join(dataset.data_dir, 'local.bval'))
+    np.testing.assert_array_equal(dataset.gradients().shell_index,
+                                  gradients.shell_index)
+
+
+@with_setup(setup_tmpdata, teardown_tmpdata)
+def test_shell_img():
+    dwi = np.arange(2 * 2 * 2 * len(BVALS), dtype=np.float32).reshape(
+        (2, 2, 2, len(BVALS)))
+    data_dir = os.path.join(get_tmpdir(), 'data')
+    os.makedirs(data_dir)
+    dataset = _local_dataset(os.path.join(get_tmpdir(), 'src'), data_dir,
+                             BVALS, BVECS, dwi=dwi)
+    img = dataset.shell_img(1000)
+    np.testing.assert_array_equal(img.get_data(), dwi[..., [1, 4, 6]])
+    img = dataset.shell_img([0, 2000], cache=True)
+    np.testing.assert_array_equal(img.get_data(), dwi[..., [0, 2, 3, 5]])
+    cache_file = os.path.join(dataset.data_dir, 'shells',
+                              'dwi_b0_b2000_thr50.nii')
+    assert_true(os.path.exists(cache_file))
+    assert_equal(img.get_filename(), cache_file)
+    assert_raises(ValueError, dataset.shell_img, 3000)
+
+    # The b=0 volumes depend on the threshold.
+    img = dataset.shell_img([0, 2000], cache=True, b0_threshold=1)
+    np.testing.assert_array_equal(img.get_data(), dwi[..., [0, 3, 5]])
+    assert_equal(img.get_filename(), os.path.join(
+        dataset.data_dir, 'shells', 'dwi_b0_b2000_thr1.nii'))
+
+    # No b=0 volumes
+    data_dir = os.path.join(get_tmpdir(), 'data_no_b0')
+    os.makedirs(data_dir)
+    dataset = _local_dataset(os.path.join(get_tmpdir(), 'src_no_b0'),
+                             data_dir, BVALS[[1, 3]], BVECS[[1, 3]])
+    assert_raises(ValueError, dataset.shell_img, 0)
@@ -5,9 +5,8 @@ Utilities to download functional MRI datasets
 # Author: Ofer Groweiss
 # License: simplified BSD
 
-import glob
+import json
 import os
-import re
 
 import pandas as pd
 import numpy as np
@@ -16,131 +15,230 @@ from sklearn.datasets.base import Bunch
 
 import nibabel
 import nipy.modalities.fmri.design_matrix as dm
-from nilearn.image import index_img
 from nilearn.masking import compute_epi_mask
 from nipy.modalities.fmri.glm import FMRILinearModel
 from nipy.modalities.fmri.experimental_paradigm import EventRelatedParadigm
 
 from ...core.datasets import HttpDataset
+from ...core.datasets.bids_layout import BidsLayout, parse_entities
+from ...core._utils.cache_mixin import CacheMixin, cache, niimg_fingerprint
+from ...core._utils.cache_manager import parse_size
 from openfmri2bids.converter import convert
+from sklearn.externals.joblib import Parallel, delayed, cpu_count
+
+
+def _get_beta_filepath(func_file, cond):
+    return func_file.replace('_bold.nii.gz', '_beta-%s.nii.gz' % cond)
+
+
+def _make_design_matrix(n_scans, tr, conditions, onsets):
+    frametimes = np.linspace(0, (n_scans - 1) * tr, n_scans)
+    paradigm = EventRelatedParadigm(conditions, onsets)
+    design_mat = dm.make_dmtx(frametimes, paradigm, drift_model='cosine',
+                              hfcut=n_scans, hrf_model='canonical')
+    return design_mat.matrix
+
+
+def _fit_run(func_file, design_matrix, conditions, memory):
+    """Fit the GLM of one run and save its betas; run in worker processes.
+    """
+    # The mask only depends on the run: it is cached on its fingerprint.
+    mask_img = cache(compute_epi_mask, memory, func_memory_level=1,
+                     memory_level=1, fingerprint_niimgs=True)(func_file)
+    img = nibabel.load(func_file)
+    fmri_glm = FMRILinearModel(img, design_matrix, mask=mask_img)
+    fmri_glm.fit(do_scaling=True, model='ar1')
+
+    # Pull out the betas
+    beta_hat = fmri_glm.glms[0].get_beta()  # Least-squares estimates of the beta
+    mask = fmri_glm.mask.get_data() > 0
+
+    # Save beta images, one volume at a time.
+    beta_files = []
+    beta_map = np.zeros(mask.shape, dtype=np.float32)
+    for ci, cond in enumerate(np.unique(conditions)):
+        beta_map[mask] = beta_hat[ci]
+        beta_cond_img = nibabel.Nifti1Image(beta_map, fmri_glm.affine)
+        beta_cond_img.get_header()['descrip'] = (
+            'Parameter estimates of the localizer dataset')
+        beta_filepath = _get_beta_filepath(func_file, cond)
+        nibabel.save(beta_cond_img, beta_filepath)
+        beta_files.append(beta_filepath)
+    return beta_files
+
+
+def _call_catching(func, *args):
+    """Return (func(*args), None), or (None, error) if it fails: the other
+    runs fitted at once are kept."""
+    try:
+        return func(*args), None
+    except Exception as e:
+        return None, e
+
+
+def _save_manifest(manifest, manifest_file):
+    temp_file = manifest_file + '.part'
+    with open(temp_file, 'w') as fp:
+        json.dump(manifest, fp, indent=1)
+    os.rename(temp_file, manifest_file)
+
+
+def _available_memory():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class OpenFMriDataset(HttpDataset, CacheMixin):
+    def __init__(self, data_dir=None):
+        super(OpenFMriDataset, self).__init__(data_dir=data_dir)
+        # Design matrices and masks are cached with the dataset.
+        self.memory = os.path.join(self.data_dir, 'cache')
+        self.memory_level = 1
+        self.fingerprint_niimgs = True
 
-
-class OpenFMriDataset(HttpDataset):
     @staticmethod
     def get_subj_from_path(pth):
-        match = re.match('.*(sub-[0-9]+).*', pth)
-        if not match:
-            return None
-        else:
-            return match.groups()[0]
+        sub = parse_entities(pth)['sub']
+        return None if sub is None else 'sub-%s' % sub
 
     @staticmethod
     def get_task_from_path(pth):
-        match = re.match('.*sub-[0-9]+_task-([^_]+)_', pth)
-        if not match:
-            return None
-        else:
-            return match.groups()[0]
+        return parse_entities(pth)['task']
 
     @staticmethod
     def get_run_from_path(pth):
-        match = re.match('.*_(run[0-9]+)', pth)
-        if not match:
-            return None
-        else:
-            return match.groups()[0]
-
-    def preprocess_files(self, func_files, anat_files=None, verbose=1):
-        def get_beta_filepath(func_file, cond):
-            return func_file.replace('_bold.nii.gz', '_beta-%s.nii.gz' % cond)
-
-        beta_files = []
+        run = parse_entities(pth)['run']
+        return None if run is None else 'run%s' % run
+
+    def preprocess_files(self, func_files, anat_files=None, n_jobs=1,
+                         max_memory=None, verbose=1):
+        """Estimate the beta maps of each condition of each run.
+
+        Runs are fitted in parallel. A manifest in the data directory
+        records the input fingerprints of the fitted runs: runs whose bold
+        and events files did not change, and whose betas are still there,
+        are not fitted again. The manifest is saved as runs are fitted, so
+        that a failing run does not discard the others.
+
+        Parameters
+        ----------
+        n_jobs: int, optional
+            Number of worker processes (-1: as many as CPUs).
+
+        max_memory: int or string, optional
+            Memory budget of the workers (e.g. 8G); n_jobs is reduced so
+            that the runs fitted at once fit in it. Defaults to the
+            available memory, when it can be known.
+        """
+        manifest_file = os.path.join(self.data_dir, 'preprocess_manifest.json')
+        manifest = dict()
+        if os.path.exists(manifest_file):
+            with open(manifest_file, 'r') as fp:
+                manifest = json.load(fp)
+
+        beta_files = dict()
+        todo = []
         for fi, func_file in enumerate(func_files):
+            cond_file = func_file.replace('_bold.nii.gz', '_events.tsv')
+            key = os.path.relpath(func_file, self.data_dir)
+            cond_stat = os.stat(cond_file)
+            # lstat: a re-converted run gets a new link to the same data.
+            fingerprint = [list(niimg_fingerprint(func_file)),
+                           os.lstat(func_file).st_mtime,
+                           [cond_stat.st_size, cond_stat.st_mtime]]
+
             # Don't re-do preprocessing.
-            beta_mask = func_file.replace('_bold.nii.gz', '_beta*.nii.gz')
+            entry = manifest.get(key)
+            if entry is not None and entry['fingerprint'] == fingerprint:
+                run_betas = [os.path.join(self.data_dir, f)
+                             for f in entry['betas']]
+                if all(os.path.exists(f) for f in run_betas):
+                    beta_files[func_file] = run_betas
+                    continue
 
-            cond_file = func_file.replace('_bold.nii.gz', '_events.tsv')
             cond_data = pd.read_csv(cond_file, sep='\t')
-
-            # Get condition info, to search if betas have been done.
             conditions = cond_data['trial_type'].tolist()
-            all_conds = np.unique(conditions)
-            all_beta_files = [get_beta_filepath(func_file, cond)
-                              for cond in all_conds]
-            # All betas are done.
-            if np.all([os.path.exists(f) for f in all_beta_files]):
-                beta_files += all_beta_files
-                continue
-
-            if verbose >= 0:
-                print('Preprocessing file %d of %d' % (fi + 1, len(func_files)))
-
-            # Need to do regression.
             tr = cond_data['duration'].as_matrix().mean()
             onsets = cond_data['onset'].tolist()
-
-            img = nibabel.load(func_file)
-            n_scans = img.shape[3]
-            frametimes = np.linspace(0, (n_scans - 1) * tr, n_scans)
-
-            # Create the design matrix
-            paradigm = EventRelatedParadigm(conditions, onsets)
-            design_mat = dm.make_dmtx(frametimes, paradigm, drift_model='cosine',
-                                      hfcut=n_scans, hrf_model='canonical')
-
-            # Do the GLM
-            mask_img = compute_epi_mask(img)
-            fmri_glm = FMRILinearModel(img, design_mat.matrix, mask=mask_img)
-            fmri_glm.fit(do_scaling=True, model='ar1')
-
-            # Pull out the betas
-            beta_hat = fmri_glm.glms[0].get_beta()  # Least-squares estimates of the beta
-            mask = fmri_glm.mask.get_data() > 0
-
-            # output beta images
-            dim = design_mat.matrix.shape[1]
-            beta_map = np.tile(mask.astype(np.float)[..., np.newaxis], dim)
-            beta_map[mask] = beta_hat.T
-            beta_image = nibabel.Nifti1Image(beta_map, fmri_glm.affine)
-            beta_image.get_header()['descrip'] = ('Parameter estimates of the localizer dataset')
-
-            # Save beta images
-            for ci, cond in enumerate(np.unique(conditions)):
-                beta_cond_img = index_img(beta_image, ci)
-                beta_filepath = get_beta_filepath(func_file, cond)
-                nibabel.save(beta_cond_img, beta_filepath)
-                beta_files.append(beta_filepath)
-
-        return beta_files
+            shape = nibabel.load(func_file).shape
+            design_matrix = self._cache(_make_design_matrix)(
+                shape[3], tr, conditions, onsets)
+            todo.append((func_file, key, fingerprint, shape, design_matrix,
+                         conditions))
+
+        if todo:
+            if n_jobs < 0:
+                n_jobs = max(cpu_count() + 1 + n_jobs, 1)
+            # Data, residuals and the model of a run are held at once.
+            run_memory = max(3 * 8 * np.prod(shape) for _, _, _, shape, _, _
+                             in todo)
+            max_memory = parse_size(max_memory) or _available_memory()
+            if max_memory:
+                n_jobs = int(max(1, min(n_jobs, max_memory // run_memory)))
+            if verbose >= 0:
+                print('Preprocessing %d of %d files (%d jobs)' % (
+                    len(todo), len(func_files), n_jobs))
+
+            # Blocks of n_jobs runs: the manifest is saved after each.
+            errors = []
+            for start in range(0, len(todo), n_jobs):
+                block = todo[start:start + n_jobs]
+                results = Parallel(n_jobs=n_jobs, verbose=verbose)(
+                    delayed(_call_catching)(_fit_run, func_file,
+                                            design_matrix, conditions,
+                                            self.memory)
+                    for func_file, _, _, _, design_matrix, conditions
+                    in block)
+
+                for (func_file, key, fingerprint, _, _, _), (run_betas,
+                        error) in zip(block, results):
+                    if error is not None:
+                        errors.append((func_file, error))
+                        continue
+                    beta_files[func_file] = run_betas
+                    manifest[key] = dict(
+                        fingerprint=fingerprint,
+                        betas=[os.path.relpath(f, self.data_dir)
+                               for f in run_betas])
+                _save_manifest(manifest, manifest_file)
+
+            if errors:
+                func_file, error = errors[0]
+                if verbose >= 0:
+                    print('Fitting %d runs failed, first: %s'
+                          % (len(errors), func_file))
+                raise error
+
+        return [f for func_file in func_files for f in beta_files[func_file]]
 
 class PoldrackEtal2001Dataset(OpenFMriDataset):
     def fetch(self, n_subjects=1, preprocess_data=True,
-              url=None, resume=True, force=False, verbose=1):
+              url=None, resume=True, force=False, n_jobs=1, verbose=1):
 
         # Prep the URLs
-        if not os.path.exists(os.path.join(self.data_dir, 'ds052_BIDS')):
-            url = 'http://openfmri.s3.amazonaws.com/tarballs/ds052_raw.tgz'
-            opts = {'uncompress': True}
-            files = [('ds052', url, opts)]
-            files = self.fetcher.fetch(files, resume=resume, force=force, verbose=verbose)
-
-            # Move around the files to BIDS format.
-            convert(source_dir=os.path.join(self.data_dir, 'ds052'),
-                    dest_dir=os.path.join(self.data_dir, 'ds052_BIDS'),
-                    nii_handling='link')
-
-
-        # Loop over subjects to extract files.
-        anat_files = []
-        func_files = []
-        for subj_dir in glob.glob(os.path.join(self.data_dir, 'ds052_BIDS', 'sub-*')):
-            anat_files += glob.glob(os.path.join(subj_dir, 'anatomy', '*_T1w_run*.nii.gz'))
-            func_files += glob.glob(os.path.join(subj_dir, 'functional', '*_task-*_bold*.nii.gz'))
-
-            # if not (i == 2 and anat_file == 'highres002.nii.gz') and not i==11]
+        url = 'http://openfmri.s3.amazonaws.com/tarballs/ds052_raw.tgz'
+        opts = {'uncompress': True}
+        files = [('ds052', url, opts)]
+        files = self.fetcher.fetch(files, resume=resume, force=force, verbose=verbose)
+
+        # Move around the files to BIDS format. Conversion is incremental:
+        # only subjects missing or changed since the last run are converted.
+        convert(source_dir=os.path.join(self.data_dir, 'ds052'),
+                dest_dir=os.path.join(self.data_dir, 'ds052_BIDS'),
+                nii_handling='link', n_jobs=n_jobs, force=force)
+
+        # Query the files of all the subjects at once.
+        layout = BidsLayout(os.path.join(self.data_dir, 'ds052_BIDS'))
+        anat_files = layout.get(modality='anatomy', suffix='T1w', run=True,
+                                extension='.nii.gz')
+        func_files = layout.get(modality='functional', suffix='bold',
+                                task=True, extension='.nii.gz')
 
         if preprocess_data:
-            func_files = self.preprocess_files(func_files, anat_files=anat_files)
+            func_files = self.preprocess_files(func_files, anat_files=anat_files,
+                                               n_jobs=n_jobs)
             plt.show()
 
         # return the data
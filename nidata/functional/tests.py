@@ -6,10 +6,13 @@ Test the datasets module
 
 import os
 from nose import with_setup
+from nose.tools import assert_equal, assert_true, assert_raises
 
 from nidata.core import fetchers
 from nidata.core._utils.compat import _basestring
 from nidata.core._utils.testing import (assert_raises_regex)
+from nidata.core.datasets.bids_layout import BidsLayout, parse_entities
+from nidata.core.datasets.materialize import materialize
 from nidata.functional import datasets
 from nidata.core.fetchers.tests.test_fetchers import (get_file_mock, setup_tmpdata, setup_mock,
                                         teardown_tmpdata, get_url_request,
@@ -89,3 +92,153 @@ def test_miyawaki2008():
     assert_equal(len(dataset.mask_roi), 38)
     assert_equal(len(get_url_request().urls), 1)
 
+
+@with_setup(setup_tmpdata, teardown_tmpdata)
+def test_bids_layout():
+    assert_equal(parse_entities('sub-1/anatomy/sub-1_T1w_run01.nii.gz'),
+                 dict(sub='1', ses=None, task=None, run='01',
+                      modality='anatomy', suffix='T1w', extension='.nii.gz'))
+    assert_equal(parse_entities('sub00001/ses105/functional/a.nii.gz')['ses'],
+                 '105')
+
+    root = os.path.join(get_tmpdir(), 'ds_BIDS')
+    for sub in (1, 2):
+        os.makedirs(os.path.join(root, 'sub-%d' % sub, 'functional'))
+        for run in (1, 2, 3, 4):
+            for suffix in ('bold.nii.gz', 'events.tsv'):
+                open(os.path.join(root, 'sub-%d' % sub, 'functional',
+                                  'sub-%d_task-stop_run%02d_%s'
+                                  % (sub, run, suffix)), 'w').close()
+    layout = BidsLayout(root)
+    bold = layout.get(task='stop', suffix='bold', run=range(1, 4))
+    assert_equal(len(bold), 6)
+    assert_true(all(f.endswith('_bold.nii.gz') for f in bold))
+    assert_equal(layout.get(sub=2, run='04', extension='.tsv'),
+                 [os.path.join(root, 'sub-2', 'functional',
+                               'sub-2_task-stop_run04_events.tsv')])
+    assert_equal(layout.entities('run'), ['01', '02', '03', '04'])
+    assert_raises_regex(ValueError, 'Unknown entity', layout.get, foo=1)
+
+    # The stored index is reused, and invalidated by directory changes.
+    layout = BidsLayout(root)
+    assert_equal(len(layout.get(suffix='bold')), 8)
+    new_file = os.path.join(root, 'sub-2', 'functional',
+                            'sub-2_task-go_run01_bold.nii.gz')
+    open(new_file, 'w').close()
+    os.utime(os.path.dirname(new_file), (0, 0))
+    assert_equal(BidsLayout(root).get(task='go'), [new_file])
+
+
+@with_setup(setup_tmpdata, teardown_tmpdata)
+def test_materialize():
+    import nibabel
+    import numpy as np
+    rng = np.random.RandomState(0)
+    func = []
+    for run, n_scans in enumerate((5, 3)):
+        func.append(os.path.join(get_tmpdir(), 'run%d.nii.gz' % run))
+        nibabel.save(nibabel.Nifti1Image(
+            rng.rand(2, 3, 4, n_scans).astype(np.float32), np.eye(4)),
+            func[-1])
+    anat = os.path.join(get_tmpdir(), 'anat.nii')
+    nibabel.save(nibabel.Nifti1Image(np.ones((2, 3, 4), dtype=np.int16),
+                                     np.diag([2, 2, 2, 1])), anat)
+    data = dict(func=func, anat=anat, description='not an image')
+    store_dir = os.path.join(get_tmpdir(), 'store')
+
+    store = materialize(data, store_dir, chunk_size=2, n_jobs=2)
+    assert_equal(store.keys(), ['anat', 'func'])
+    assert_equal(store.offsets('func').tolist(), [0, 5, 8])
+    runs = [np.asarray(nibabel.load(f).dataobj) for f in func]
+    np.testing.assert_array_equal(
+        store.scans('func', 3, 7),
+        np.rollaxis(np.concatenate([runs[0][..., 3:], runs[1][..., :2]],
+                                   axis=3), 3))
+    img = store.img('anat', 0)
+    assert_equal(img.shape, (2, 3, 4))
+    np.testing.assert_array_equal(img.get_affine(), np.diag([2, 2, 2, 1]))
+
+    # Stored images are skipped, changed ones stored again.
+    mtime = os.stat(os.path.join(store_dir, 'func', '00000.npy')).st_mtime
+    os.utime(func[1], (0, 0))
+    store = materialize(data, store_dir, keys=['func'])
+    assert_equal(os.stat(os.path.join(store_dir, 'func',
+                                      '00000.npy')).st_mtime, mtime)
+    assert_equal(store.index['func'][1]['source_stat'][1], 0)
+
+    # Scaled images are stored as their scaled data.
+    scaled = os.path.join(get_tmpdir(), 'scaled.nii')
+    scaled_img = nibabel.Nifti1Image(rng.rand(2, 3, 4).astype(np.float32),
+                                     np.eye(4))
+    scaled_img.set_data_dtype(np.int16)
+    nibabel.save(scaled_img, scaled)
+    assert_true(nibabel.load(scaled).dataobj.slope != 1)
+    store = materialize(dict(scaled=scaled), store_dir)
+    expected = np.asarray(nibabel.load(scaled).dataobj)
+    np.testing.assert_array_equal(store.scans('scaled', 0, 1)[0], expected)
+    img = store.img('scaled', 0)
+    np.testing.assert_array_equal(np.asarray(img.dataobj), expected)
+    assert_equal(img.get_header().get_slope_inter(), (None, None))
+
+
+def _fake_fit_run(func_file, design_matrix, conditions, memory):
+    # Stands for the GLM fit of OpenFMriDataset; runs in worker processes.
+    import nibabel
+    import numpy as np
+    with open(func_file + '.fits', 'a') as fp:
+        fp.write('.')
+    if os.path.exists(func_file + '.fail'):
+        raise ValueError('Fit failed')
+    beta_file = func_file.replace('_bold.nii.gz', '_beta-a.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(np.zeros((2, 2, 2), dtype=np.float32),
+                                     np.eye(4)), beta_file)
+    return [beta_file]
+
+
+@with_setup(setup_tmpdata, teardown_tmpdata)
+def test_openfmri_preprocess_manifest():
+    import nibabel
+    import numpy as np
+    from nidata.functional.poldrack_etal_2001 import datasets as poldrack
+
+    def n_fits(func_file):
+        with open(func_file + '.fits') as fp:
+            return len(fp.read())
+
+    dataset = poldrack.OpenFMriDataset(data_dir=get_tmpdir())
+    func_files = []
+    for run in range(1, 4):
+        func_file = os.path.join(dataset.data_dir, 'sub-01_task-a_run-%02d'
+                                 '_bold.nii.gz' % run)
+        nibabel.save(nibabel.Nifti1Image(
+            np.ones((2, 2, 2, 10), dtype=np.float32), np.eye(4)), func_file)
+        with open(func_file.replace('_bold.nii.gz', '_events.tsv'),
+                  'w') as fp:
+            fp.write('onset\tduration\ttrial_type\n0\t2\ta\n10\t2\ta\n')
+        func_files.append(func_file)
+    open(func_files[1] + '.fail', 'w').close()
+
+    fit_run = poldrack._fit_run
+    poldrack._fit_run = _fake_fit_run
+    try:
+        # The runs fitted next to a failing one are kept.
+        assert_raises(ValueError, dataset.preprocess_files, func_files,
+                      n_jobs=2, max_memory='1G', verbose=-1)
+        os.remove(func_files[1] + '.fail')
+        betas = dataset.preprocess_files(func_files, n_jobs=2,
+                                         max_memory='1G', verbose=-1)
+        assert_equal([n_fits(f) for f in func_files], [1, 2, 1])
+        assert_equal(betas, [f.replace('_bold.nii.gz', '_beta-a.nii.gz')
+                             for f in func_files])
+
+        # Fitted runs are skipped, unless their betas are missing or their
+        # events changed.
+        os.remove(betas[0])
+        events_file = func_files[2].replace('_bold.nii.gz', '_events.tsv')
+        with open(events_file, 'a') as fp:
+            fp.write('20\t2\ta\n')
+        assert_equal(dataset.preprocess_files(func_files, verbose=-1), betas)
+        assert_equal([n_fits(f) for f in func_files], [2, 2, 2])
+        assert_true(os.path.exists(betas[0]))
+    finally:
+        poldrack._fit_run = fit_run
@@ -128,6 +128,9 @@ class BrainomicsDataset(HttpDataset):
     resume: bool
         Whether to resume download of a partly-downloaded file.
 
+    n_jobs: int
+        Number of archives downloaded at once.
+
     verbose: int
         verbose level (0 means no message).
 
@@ -210,9 +213,39 @@ class BrainomicsDataset(HttpDataset):
         "button press vs calculation and sentence listening/reading":
             "auditory&visual motor vs cognitive processing"}
 
+    def _load_ext_vars(self, csv_file, csv_file2):
+        """Join the subject characteristics of both covariates files.
+
+        The joined recarray is cached in the data directory, until one of
+        the CSV files changes.
+        """
+        cache_file = os.path.join(self.data_dir, 'ext_vars.npz')
+        stats = [[os.stat(f).st_size, os.stat(f).st_mtime]
+                 for f in (csv_file, csv_file2)]
+        if os.path.exists(cache_file):
+            try:
+                with np.load(cache_file) as cached:
+                    if cached['source_stats'].tolist() == stats:
+                        return cached['ext_vars'].view(np.recarray)
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+
+        from numpy.lib.recfunctions import join_by
+        csv_data = np.recfromcsv(csv_file, delimiter=';')
+        csv_data2 = np.recfromcsv(csv_file2, delimiter=';')
+        # join_by sorts the output along the key
+        csv_data = join_by('subject_id', csv_data, csv_data2,
+                           usemask=False, asrecarray=True)
+        try:
+            with open(cache_file, 'wb') as fp:
+                np.savez(fp, ext_vars=csv_data, source_stats=stats)
+        except (IOError, OSError):
+            pass
+        return csv_data
+
     def fetch(self, contrasts=None, n_subjects=None, get_tmaps=False,
               get_masks=False, get_anats=False, url=None,
-              resume=True, force=False, verbose=1):
+              resume=True, force=False, n_jobs=4, verbose=1):
         if n_subjects is None:
             n_subjects = 94  # 94 subjects available
         if (n_subjects > 94) or (n_subjects < 1):
@@ -246,9 +279,9 @@ class BrainomicsDataset(HttpDataset):
         # - Brainomics server has no cache (can lead to timeout while the archive
         #   is generated on the remote server)
         # - Local (cached) version of the files can be checked for each contrast
+        # Each archive is restricted to the subjects whose files are missing.
         opts = {'uncompress': True}
         subject_ids = ["S%02d" % s for s in range(1, n_subjects + 1)]
-        subject_id_max = subject_ids[-1]
         data_types = ["c map"]
         if get_tmaps:
             data_types.append("t map")
@@ -259,32 +292,45 @@ class BrainomicsDataset(HttpDataset):
                       "X concerns S, "
                       "X label XL, X identifier XI, "
                       "X format XF, X description XD, "
-                      'S identifier <= "%s", ' % (subject_id_max, ) +
+                      'S identifier IN(%(subjects)s), '
                       'X type IN(%(types)s), X label "%(label)s"')
 
-        urls = ["%sbrainomics_data_%d.zip?rql=%s&vid=data-zip"
-                % (root_url, i,
-                   _urllib.parse.quote(base_query % {"types": rql_types,
-                                              "label": c},
-                                safe=',()'))
+        def archive_url(name, types, label, file_paths):
+            """URL of the archive of the subjects missing any file_paths."""
+            missing = [subject_id for subject_id in subject_ids
+                       if force or not all(
+                           os.path.exists(os.path.join(
+                               self.data_dir, "brainomics_data", subject_id,
+                               file_path))
+                           for file_path in file_paths)]
+            subjects = str.join(", ", ['"%s"' % subject_id
+                                       for subject_id in missing or subject_ids])
+            query = base_query % {"subjects": subjects, "types": types,
+                                  "label": label}
+            return ("%sbrainomics_data_%s.zip?rql=%s&vid=data-zip"
+                    % (root_url, name,
+                       _urllib.parse.quote(query, safe=',()')))
+
+        def file_name(data_type, contrast):
+            return "%s.nii.gz" % str.replace(
+                str.join('_', [data_type, contrast]), ' ', '_')
+
+        urls = [archive_url(i, rql_types, c,
+                            [file_name(data_type, c) for data_type in data_types])
                 for c, i in zip(contrasts_wrapped, contrasts_indices)]
         filenames = []
         for subject_id in subject_ids:
             for data_type in data_types:
                 for contrast_id, contrast in enumerate(contrasts_wrapped):
-                    name_aux = str.replace(
-                        str.join('_', [data_type, contrast]), ' ', '_')
                     file_path = os.path.join(
-                        "brainomics_data", subject_id, "%s.nii.gz" % name_aux)
+                        "brainomics_data", subject_id,
+                        file_name(data_type, contrast))
                     file_tarball_url = urls[contrast_id]
                     filenames.append((file_path, file_tarball_url, opts))
         # Fetch masks if asked by user
         if get_masks:
-            urls.append("%sbrainomics_data_masks.zip?rql=%s&vid=data-zip"
-                        % (root_url,
-                           _urllib.parse.quote(base_query % {"types": '"boolean mask"',
-                                                      "label": "mask"},
-                                        safe=',()')))
+            urls.append(archive_url("masks", '"boolean mask"', "mask",
+                                    ["boolean_mask_mask.nii.gz"]))
             for subject_id in subject_ids:
                 file_path = os.path.join(
                     "brainomics_data", subject_id, "boolean_mask_mask.nii.gz")
@@ -292,11 +338,8 @@ class BrainomicsDataset(HttpDataset):
                 filenames.append((file_path, file_tarball_url, opts))
         # Fetch anats if asked by user
         if get_anats:
-            urls.append("%sbrainomics_data_anats.zip?rql=%s&vid=data-zip"
-                        % (root_url,
-                           _urllib.parse.quote(base_query % {"types": '"normalized T1"',
-                                                      "label": "anatomy"},
-                                        safe=',()')))
+            urls.append(archive_url("anats", '"normalized T1"', "anatomy",
+                                    ["normalized_T1_anat_defaced.nii.gz"]))
             for subject_id in subject_ids:
                 file_path = os.path.join(
                     "brainomics_data", subject_id,
@@ -319,22 +362,15 @@ class BrainomicsDataset(HttpDataset):
         filenames += [("cubicwebexport.csv", url_csv, {}),
                       ("cubicwebexport2.csv", url_csv2, {})]
 
-        # Actual data fetching
-        files = self.fetcher.fetch(filenames, resume=resume, force=force, verbose=verbose)
+        # Actual data fetching: the archives are fetched concurrently.
+        files = self.fetcher.fetch(filenames, resume=resume, force=force,
+                                   verbose=verbose, n_jobs=n_jobs)
         anats = None
         masks = None
         tmaps = None
         # combine data from both covariates files into one single recarray
-        from numpy.lib.recfunctions import join_by
-        ext_vars_file2 = files[-1]
-        csv_data2 = np.recfromcsv(ext_vars_file2, delimiter=';')
-        files = files[:-1]
-        ext_vars_file = files[-1]
-        csv_data = np.recfromcsv(ext_vars_file, delimiter=';')
-        files = files[:-1]
-        # join_by sorts the output along the key
-        csv_data = join_by('subject_id', csv_data, csv_data2,
-                           usemask=False, asrecarray=True)[:n_subjects]
+        csv_data = self._load_ext_vars(files[-2], files[-1])[:n_subjects]
+        files = files[:-2]
         if get_anats:
             anats = files[-n_subjects:]
             files = files[:-n_subjects]
@@ -1,41 +1,203 @@
 """
 """
-from ...core.fetchers import AmazonS3Fetcher, HttpFetcher
+import json
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from ...core.fetchers import AmazonS3Fetcher, HttpFetcher, instrumentation
+from ...core.fetchers.base import md5_sum_file
+from ...core.fetchers.http_fetcher import _chunk_read_, fetch_files
 from ...core.datasets import Dataset
 
 
 class HcpHttpFetcher(HttpFetcher):
+    """Fetcher of HCP files through one authenticated, pooled HTTP session.
+
+    The session id (JSESSIONID) is stored in the data directory, so that
+    other fetchers (e.g. other processes) reuse it while it is valid, and
+    renewed when the server rejects it.
+    """
     dependencies = ['requests']
+    login_url = 'https://db.humanconnectome.org/data/JSESSION'
+    session_ttl = 15 * 60  # seconds of inactivity before the server drops a session
+    pool_size = 16  # connections kept open, e.g. for threaded fetches
 
     def __init__(self, data_dir=None, username=None, passwd=None):
         super(HcpHttpFetcher, self).__init__(data_dir=data_dir, username=username, passwd=passwd)
         self.jsession_id = None
-    def fetch(self, files, force=False, resume=True, check=False, verbose=1):
-        if self.jsession_id is None:
-            # Log in to the website.
+        self.session = None
+        self._lock = threading.Lock()
+        self._last_save = 0
+
+    @property
+    def session_file(self):
+        return os.path.join(self.data_dir, '.hcp_session.json')
+
+    def _get_session(self):
+        if self.session is None:
             import requests
-            resp = requests.post('https://db.humanconnectome.org/data/JSESSION',
-                                 data={},
-                                 auth=(self.username, self.passwd))
-            resp.raise_for_status()
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self.session = session
+        return self.session
+
+    def _load_session_id(self):
+        if not os.path.exists(self.session_file):
+            return None
+        try:
+            with open(self.session_file, 'r') as fp:
+                stored = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+        if (stored.get('login_url') != self.login_url or
+                time.time() - stored['time'] > self.session_ttl):
+            return None
+        return stored['jsession_id']
+
+    def _save_session_id(self):
+        self._last_save = time.time()
+        try:
+            fd = os.open(self.session_file,
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(dict(login_url=self.login_url, time=self._last_save,
+                               jsession_id=self.jsession_id), fp)
+        except (IOError, OSError):
+            pass
+
+    def login(self, expired=None):
+        """Open an HCP session, if not done yet.
+
+        A stored session is reused if still valid. If expired is given
+        (the id of a session rejected by the server), log in again unless
+        another thread already did.
+        """
+        with self._lock:
+            if self.jsession_id is not None and self.jsession_id != expired:
+                return self.jsession_id
 
-            # Get the login information.
-            self.jsession_id = resp.cookies.get('JSESSIONID')
-            if self.jsession_id is None:
-                raise Exception('Failed to create HCP session.')
-            self.username = self.passwd = None  # use session
+            jsession_id = None if expired else self._load_session_id()
+            if jsession_id is None:
+                if self.username is None:
+                    raise Exception('HCP session expired; username and '
+                                    'passwd are required to log in.')
+                # Log in to the website.
+                resp = self._get_session().post(self.login_url,
+                                                data={},
+                                                auth=(self.username, self.passwd))
+                resp.raise_for_status()
 
+                # Get the login information.
+                jsession_id = resp.cookies.get('JSESSIONID')
+                if jsession_id is None:
+                    raise Exception('Failed to create HCP session.')
+
+            self.jsession_id = jsession_id
+            self._get_session().cookies.clear()
+            self._get_session().cookies.set('JSESSIONID', jsession_id)
+            self._save_session_id()
+        return self.jsession_id
+
+    def _get(self, url, **kwargs):
+        """GET within the session, logging in again if it expired."""
+        jsession_id = self.login()
+        resp = self._get_session().get(url, **kwargs)
+        if resp.status_code == 401:
+            resp.close()
+            self.login(expired=jsession_id)
+            resp = self._get_session().get(url, **kwargs)
+        resp.raise_for_status()
+        # The server keeps the session alive while it is used.
+        if time.time() - self._last_save > 60:
+            with self._lock:
+                self._save_session_id()
+        return resp
+
+    def get_json(self, url, params=None):
+        """GET a JSON document (e.g. an XNAT listing) within the session."""
+        return self._get(url, params=params).json()
+
+    def _fetch_file(self, url, target_file, resume=True, overwrite=False,
+                    md5sum=None, verbose=1):
+        """Download a file within the session, resuming a partial download.
+        """
+        if os.path.exists(target_file) and not overwrite:
+            return target_file
+        target_dir = os.path.dirname(target_file)
+        if not os.path.exists(target_dir):
+            try:
+                os.makedirs(target_dir)
+            except OSError:  # created by another thread
+                pass
+
+        temp_file = target_file + '.part'
+        headers = dict()
+        initial_size = 0
+        if resume and not overwrite and os.path.exists(temp_file):
+            initial_size = os.path.getsize(temp_file)
+            headers['Range'] = 'bytes=%d-' % initial_size
+            instrumentation.emit('resume', url=url, offset=initial_size)
+
+        if verbose > 0:
+            print('Downloading data from %s ...' % url)
+        with instrumentation.timed('connect', url=url):
+            resp = self._get(url, headers=headers, stream=True)
+        try:
+            if resp.status_code != 206:  # the server sends the whole file
+                initial_size = 0
+            resp.raw.decode_content = True
+            with open(temp_file, 'ab' if initial_size else 'wb') as local_file:
+                with instrumentation.timed('transfer', url=url,
+                                           file=target_file,
+                                           offset=initial_size) as event:
+                    t_transfer = time.time()
+                    event['bytes'] = _chunk_read_(
+                        resp.raw, local_file, report_hook=(verbose > 0),
+                        initial_size=initial_size,
+                        total_size=resp.headers.get('Content-Length'),
+                        verbose=verbose)
+                    event['throughput'] = event['bytes'] / max(
+                        time.time() - t_transfer, 1e-6)
+        finally:
+            resp.close()
+        os.rename(temp_file, target_file)
+
+        if md5sum is not None:
+            with instrumentation.timed('verify', file=target_file) as event:
+                event['ok'] = md5_sum_file(target_file) == md5sum
+        if md5sum is not None and not event['ok']:
+            raise ValueError("File %s checksum verification has failed."
+                             " Dataset fetching aborted." % target_file)
+        return target_file
+
+    def fetch(self, files, force=False, resume=True, check=False, verbose=1):
         files = self.reformat_files(files)  # allows flexibility
+        self.login()
 
-        # Add the session header
+        files_ = []
         for tgt, src, opts in files:
-            opts['cookies'] = opts.get('cookies', dict())
-            opts['cookies'].update({'JSESSIONID': self.jsession_id})
-
-        return super(HcpHttpFetcher, self).fetch(files=files, force=force, resume=resume, check=check, verbose=verbose)
+            if opts.get('uncompress'):
+                # Archives are handled by fetch_files, with the session cookie.
+                opts['cookies'] = opts.get('cookies', dict())
+                opts['cookies'].update({'JSESSIONID': self.jsession_id})
+                files_ += fetch_files(self.data_dir, [(tgt, src, opts)],
+                                      resume=resume, force=force, verbose=verbose)
+            else:
+                files_.append(self._fetch_file(
+                    src, os.path.join(self.data_dir, tgt), resume=resume,
+                    overwrite=force, md5sum=opts.get('md5sum'), verbose=verbose))
+        return files_
 
 
 class HcpDataset(Dataset):
+    xnat_url = 'https://db.humanconnectome.org/data/archive/projects/HCP_500'
+    s3_prefix = 'HCP/'
+    roster_ttl = 7 * 24 * 3600  # seconds
+
     def __init__(self, data_dir=None, fetcher_type='http', profile_name=None, access_key=None, secret_access_key=None,
                  username=None, passwd=None):
         """fetcher_type: aws or XNAT"""
@@ -53,14 +215,85 @@ class HcpDataset(Dataset):
         else:
             raise NotImplementedError(fetcher_type)
 
-    def get_subject_list(self, n_subjects=500):
+    def _list_xnat_subjects(self, page_size=500, n_jobs=8):
+        """List the subject labels of the XNAT project, page by page.
+
+        The first page gives the number of subjects; the other pages are
+        then requested concurrently.
+        """
+        def get_page(offset):
+            listing = self.fetcher.get_json(
+                self.xnat_url + '/subjects',
+                params=dict(format='json', columns='label',
+                            offset=offset, limit=page_size))
+            return listing['ResultSet']
+
+        first_page = get_page(0)
+        subjects = [r['label'] for r in first_page['Result']]
+        n_total = int(first_page.get('totalRecords', len(subjects)))
+        offsets = list(range(len(subjects), n_total, page_size))
+        if subjects and offsets:
+            pool = ThreadPool(min(n_jobs, len(offsets)))
+            try:
+                for page in pool.map(get_page, offsets):
+                    subjects += [r['label'] for r in page['Result']]
+            finally:
+                pool.close()
+        return subjects
+
+    def _list_s3_subjects(self, n_jobs=8):
+        """List the subject directories of the S3 bucket.
+
+        The listing is split by first digit of the subject ids, and the
+        parts are listed concurrently.
+        """
+        prefixes = [self.s3_prefix + str(digit) for digit in range(10)]
+        pool = ThreadPool(min(n_jobs, len(prefixes)))
+        try:
+            listings = pool.map(self.fetcher.list_prefixes, prefixes)
+        finally:
+            pool.close()
+        return [name[len(self.s3_prefix):].strip('/')
+                for listing in listings for name in listing]
+
+    def get_subject_list(self, n_subjects=500, ttl=None, force=False,
+                         n_jobs=8):
         """Get the list of subject IDs. Depends on the # of subjects,
         which also corresponds to other things (license agreement,
-        type of data available, etc)"""
-        return ['100307']  # 992774']
+        type of data available, etc)
 
-    def fetch(self, n_subjects=1, data_types=None, volume_types=None, force=False, check=True, verbose=1):
+        The roster is listed from XNAT or S3 (depending on the fetcher),
+        and cached in the data directory for ttl seconds (default:
+        roster_ttl).
+        """
+        if ttl is None:
+            ttl = self.roster_ttl
+        roster_file = os.path.join(self.data_dir,
+                                   'subjects_%s.json' % self.fetcher_type)
+        roster = None
+        if not force and os.path.exists(roster_file):
+            with open(roster_file, 'r') as fp:
+                cached = json.load(fp)
+            if time.time() - cached['time'] < ttl:
+                roster = cached['subjects']
+
+        if roster is None:
+            if isinstance(self.fetcher, AmazonS3Fetcher):
+                roster = self._list_s3_subjects(n_jobs=n_jobs)
+            else:
+                roster = self._list_xnat_subjects(n_jobs=n_jobs)
+            roster = sorted(set(roster))
+            with open(roster_file, 'w') as fp:
+                json.dump(dict(time=time.time(), subjects=roster), fp)
+
+        return roster[:n_subjects]
+
+    def fetch(self, n_subjects=1, data_types=None, volume_types=None, force=False, check=True,
+              n_jobs=1, verbose=1):
         """data_types is a list, can contain: anat, diff, func, rest, psyc, bgnd
+
+        The files of all the subjects are planned at once, then fetched by
+        n_jobs threads, one subject at a time per thread.
         """
         if data_types is None:
             data_types = ['anat', 'diff', 'func', 'rest']
@@ -136,19 +369,33 @@ class HcpDataset(Dataset):
 
             return files
 
-        # Build a list of files to fetch
-        src_files = []
+        # Build the list of files to fetch, per subject.
+        plan = []
         for subj_id in subj_ids[:n_subjects]:
+            src_files = []
             for dat_type in data_types:
                 for vol_type in volume_types:
                     src_files += get_files(dat_type=dat_type, vol_type=vol_type)
 
-        # Massage paths, based on fetcher type.
-        files = []
-        for src_file in src_files:
-            if isinstance(self.fetcher, HttpFetcher):
-                files.append((src_file, 'https://db.humanconnectome.org/data/archive/projects/HCP_500/subjects/' + src_file))
-            elif isinstance(self.fetcher, AmazonS3Fetcher):
-                files.append((src_file, 'HCP/' + src_file))
+            # Massage paths, based on fetcher type.
+            files = []
+            for src_file in src_files:
+                if isinstance(self.fetcher, HttpFetcher):
+                    files.append((src_file, self.xnat_url + '/subjects/' + src_file))
+                elif isinstance(self.fetcher, AmazonS3Fetcher):
+                    files.append((src_file, self.s3_prefix + src_file))
+            plan.append(files)
+
+        def fetch_subject(files):
+            return self.fetcher.fetch(files, force=force, check=check, verbose=verbose)
+
+        if n_jobs == 1 or len(plan) < 2:
+            return [f for files in plan for f in fetch_subject(files)]
 
-        return self.fetcher.fetch(files, force=force, check=check, verbose=verbose)
+        if isinstance(self.fetcher, HcpHttpFetcher):
+            self.fetcher.login()  # once, for all the threads
+        pool = ThreadPool(min(n_jobs, len(plan)))
+        try:
+            return [f for fetched in pool.map(fetch_subject, plan) for f in fetched]
+        finally:
+            pool.close()
@@ -3,13 +3,12 @@ A data loader utility for downloading fMRI data from OpenfMRI.org
 
 Adapted by: Alison Campbell
 """
-import glob
 import os
-from collections import defaultdict
 
 from sklearn.datasets.base import Bunch
 
 from ...core.datasets import HttpDataset
+from ...core.datasets.bids_layout import BidsLayout
 from ...core.fetchers import readmd5_sum_file
 
 
@@ -38,7 +37,8 @@ class MyConnectome2015Dataset(HttpDataset):
             session_ids = []
             for data_type in data_types:
                 session_ids += all_session_ids[data_type]
-
+        session_ids = set(int(s[3:]) if str(s).startswith('ses') else s
+                          for s in session_ids)
 
         # First, construct the relevant urls
         files = []
@@ -62,30 +62,32 @@ class MyConnectome2015Dataset(HttpDataset):
                 'ds031_set06.tgz': range(73, 85),
                 'ds031_set07.tgz': range(85, 98),
                 'ds031_set08.tgz': range(98, 105),}
+            subj_dir = os.path.join(self.data_dir, 'ds031', 'sub00001')
+            existing = set()
+            if not force and os.path.isdir(subj_dir):
+                existing = set(os.listdir(subj_dir))
             for zip_file, sess_range in sess_to_file_map.items():
-                if set(session_ids).intersection(set(sess_range)):
-                    uncompressed_dir = 'ds031/sub00001/ses%03d' % sess_range[0]
+                # Only the missing sessions are extracted from each tarball;
+                # the tarball is kept to extract other sessions later on.
+                missing = sorted(set('ses%03d' % sess for sess in
+                                     session_ids.intersection(sess_range))
+                                 - existing)
+                if missing:
                     remote_url = base_url + zip_file
-                    files += [(uncompressed_dir, remote_url, opts)]
+                    files += [('ds031/sub00001/' + missing[0], remote_url,
+                               dict(uncompress=True, members=missing))]
 
         # Now, fetch the files.
         self.fetcher.fetch(files, resume=resume, force=force, verbose=verbose, delete_archive=False)
         
         # Group the data according to modality.
-        out_dict = defaultdict(lambda: [])
-        for session_path in glob.glob(os.path.join(self.data_dir, 'ds031', 'sub00001', 'ses*')):
-            session_dirname = os.path.basename(session_path)
-            if (session_dirname not in session_ids and
-                int(session_dirname[3:]) not in session_ids):
-                continue
-
-            for data_type in data_types:
-                data_type_path = os.path.join(session_path, data_type)
-                if not os.path.exists(data_type_path):
-                    continue
-
-                for img_path in glob.glob(os.path.join(data_type_path, '*.nii.gz')):
-                    out_dict[data_type].append(img_path)
+        layout = BidsLayout(os.path.join(self.data_dir, 'ds031', 'sub00001'))
+        out_dict = dict()
+        for data_type in data_types:
+            img_paths = layout.get(ses=session_ids, modality=data_type,
+                                   extension='.nii.gz')
+            if img_paths:
+                out_dict[data_type] = img_paths
 
         # return the data
-        return Bunch(**dict(out_dict))
+        return Bunch(**out_dict)
@@ -0,0 +1,154 @@
+"""
+Test the datasets module
+"""
+# License: simplified BSD
+
+import json
+import os
+import threading
+
+from nose import with_setup
+from nose.tools import assert_equal, assert_true
+
+from nidata.core._utils.compat import _urllib
+from nidata.multimodal.hcp.datasets import HcpDataset
+from nidata.core.fetchers.tests.test_fetchers import (setup_tmpdata,
+                                                      teardown_tmpdata,
+                                                      get_tmpdir)
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+class XnatStandIn(object):
+    """Local stand-in of the HCP XNAT server, serving canned listings.
+
+    Answers POST /data/JSESSION with a new session cookie, and, within a
+    valid session (401 otherwise), GET /data/archive/projects/HCP_500/subjects
+    with the (paged) subject listing and GET of the paths in self.files.
+    Requests are logged in self.requests.
+    """
+    project_path = '/data/archive/projects/HCP_500'
+
+    def __init__(self, subjects, files=None):
+        self.subjects = subjects
+        self.files = files or dict()
+        self.requests = []
+        self.n_sessions = 0
+        self.jsession_id = None
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                stand_in.requests.append(('POST', self.path))
+                stand_in.n_sessions += 1
+                stand_in.jsession_id = 'canned%d' % stand_in.n_sessions
+                self.send_response(200)
+                self.send_header('Set-Cookie', 'JSESSIONID=%s; Path=/'
+                                 % stand_in.jsession_id)
+                self.end_headers()
+
+            def _reply(self, code, body=b''):
+                self.send_response(code)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                stand_in.requests.append(('GET', self.path))
+                cookie = 'JSESSIONID=%s' % stand_in.jsession_id
+                if cookie not in self.headers.get('Cookie', ''):
+                    return self._reply(401)
+                path, _, query = self.path.partition('?')
+                if path in stand_in.files:
+                    return self._reply(200, stand_in.files[path])
+                if path != stand_in.project_path + '/subjects':
+                    return self._reply(404)
+                params = dict(_urllib.parse.parse_qsl(query))
+                offset = int(params.get('offset', 0))
+                limit = int(params.get('limit', len(stand_in.subjects)))
+                page = stand_in.subjects[offset:offset + limit]
+                body = json.dumps({'ResultSet': {
+                    'totalRecords': str(len(stand_in.subjects)),
+                    'Result': [dict(label=s) for s in page]}})
+                self._reply(200, body.encode('utf-8'))
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def expire(self):
+        """Drop the current session."""
+        self.jsession_id = None
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _stand_in_dataset(stand_in):
+    dataset = HcpDataset(data_dir=get_tmpdir(), username='user',
+                         passwd='passwd')
+    dataset.xnat_url = stand_in.url + stand_in.project_path
+    dataset.fetcher.login_url = stand_in.url + '/data/JSESSION'
+    return dataset
+
+
+@with_setup(setup_tmpdata, teardown_tmpdata)
+def test_hcp_subject_list():
+    subjects = [str(100000 + 7 * i) for i in range(1234)]
+    stand_in = XnatStandIn(subjects)
+    try:
+        dataset = _stand_in_dataset(stand_in)
+        assert_equal(dataset.get_subject_list(n_subjects=3), subjects[:3])
+        # One login, then the first page and the 2 others
+        assert_equal(len(stand_in.requests), 4)
+        assert_equal(stand_in.requests[0], ('POST', '/data/JSESSION'))
+        assert_true(os.path.exists(os.path.join(dataset.data_dir,
+                                                'subjects_http.json')))
+
+        # The roster is cached...
+        assert_equal(dataset.get_subject_list(n_subjects=2000), subjects)
+        assert_equal(len(stand_in.requests), 4)
+
+        # ... until it expires.
+        assert_equal(len(dataset.get_subject_list(ttl=0)), 500)
+        assert_equal(len(stand_in.requests), 7)
+    finally:
+        stand_in.close()
+
+
+@with_setup(setup_tmpdata, teardown_tmpdata)
+def test_hcp_session():
+    data_path = '/100307/unprocessed/3T/Diffusion/100307_3T_DWI_dir95_LR.bval'
+    stand_in = XnatStandIn(['100307'], files={
+        XnatStandIn.project_path + '/subjects' + data_path: b'0 1000 2000'})
+    try:
+        dataset = _stand_in_dataset(stand_in)
+        fetched = dataset.fetcher.fetch(
+            [(data_path[1:], dataset.xnat_url + '/subjects' + data_path)],
+            verbose=0)
+        with open(fetched[0], 'rb') as fp:
+            assert_equal(fp.read(), b'0 1000 2000')
+        assert_equal(stand_in.n_sessions, 1)
+
+        # Another fetcher (e.g. in another process) reuses the stored session
+        dataset = _stand_in_dataset(stand_in)
+        assert_equal(dataset.get_subject_list(), ['100307'])
+        assert_equal(stand_in.n_sessions, 1)
+
+        # An expired session is renewed transparently.
+        stand_in.expire()
+        assert_equal(dataset.get_subject_list(force=True), ['100307'])
+        assert_equal(stand_in.n_sessions, 2)
+        assert_equal([r[0] for r in stand_in.requests[-3:]],
+                     ['GET', 'POST', 'GET'])
+    finally:
+        stand_in.close()
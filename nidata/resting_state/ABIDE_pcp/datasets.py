@@ -96,6 +96,10 @@ class AbidePcpDataset(HttpDataset):
     7 (2013).
     """
 
+    # The fcp-indi bucket is served both path-style and virtual-hosted-style.
+    mirrors = {'https://s3.amazonaws.com/fcp-indi/':
+               ['https://fcp-indi.s3.amazonaws.com/']}
+
     def fetch(self, n_subjects=None, pipeline='cpac',
               band_pass_filtering=False, global_signal_regression=False,
               derivatives=['func_preproc'],